@@ -0,0 +1,112 @@
+"""
+Benchmark of the vehicle_locations write path, against an in-memory SQLite 
+database: the former ORM bulk mappings path (NaN replacement, a dict per row, 
+bulk_insert_mappings) vs DatabaseWrapper.write_dataframe. 
+
+Reports the time per 10k rows, split between parameter conversion and the 
+full write, the peak memory allocated on the way, and the number of memory
+blocks allocated by the call and still held when it returns (e.g. the 
+converted parameters). 
+
+Usage:
+    python benchmarks/write_path.py [num_rows]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "data_pipeline")]
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+from database import DatabaseWrapper
+from db_tables import Base, VehicleLocations
+
+
+def make_vehicle_locations_df(num_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    read_time = pd.Timestamp("2022-02-08 08:00") + pd.to_timedelta(
+                    rng.integers(0, 3600, num_rows), unit="s")
+    df = pd.DataFrame({
+        "route_tag": rng.integers(1, 200, num_rows).astype(str),
+        "predictable": rng.random(num_rows) < 0.95,
+        "heading": rng.integers(0, 360, num_rows),
+        "speed_kmhr": rng.integers(0, 60, num_rows),
+        "lat": 43.6 + rng.random(num_rows) * 0.2,
+        "lon": -79.5 + rng.random(num_rows) * 0.3,
+        "id": np.arange(num_rows).astype(str),
+        "direction_tag": np.where(rng.random(num_rows) < 0.1, None, "506_0_506"),
+        "agency_tag": "ttc",
+        "read_time": read_time,
+    })
+    df["key"] = df["id"] + "_" + df["read_time"].dt.strftime("%Y-%m-%d %H:%M")
+    return df
+
+
+def make_db():
+    engine = sqlalchemy.create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    return DatabaseWrapper(session=sessionmaker(bind=engine)())
+
+
+def convert_with_mappings(db, df):
+    return df.replace([np.nan], [None]).to_dict("records")
+
+
+def convert_with_columns(db, df):
+    return list(zip(*db._get_column_values(df, list(df.columns), bool_as_int=False)))
+
+
+def write_with_mappings(db, df):
+    db.session.bulk_insert_mappings(VehicleLocations, convert_with_mappings(db, df))
+    db.session.commit()
+
+
+def write_with_columns(db, df):
+    db.write_dataframe("vehicle_locations", df)
+
+
+def measure(function, df, repeat=5):
+    """Best time over fresh databases, and the peak memory and number of 
+    blocks left allocated by one call."""
+
+    times = []
+    for _ in range(repeat):
+        db = make_db()
+        start = time.perf_counter()
+        function(db, df)
+        times.append(time.perf_counter() - start)
+
+    db = make_db()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = function(db, df)
+    after = tracemalloc.take_snapshot()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    # The snapshots themselves are not traced. 
+    num_blocks = sum(stat.count_diff for stat in after.compare_to(before, "lineno"))
+
+    return min(times), peak_bytes, num_blocks
+
+
+if __name__ == "__main__":
+
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    df = make_vehicle_locations_df(num_rows)
+    scale = 10000 / num_rows
+
+    print(f"{num_rows} rows, times per 10k rows")
+    for name, function in [("convert, mappings", convert_with_mappings),
+                           ("convert, columns", convert_with_columns),
+                           ("write, mappings", write_with_mappings),
+                           ("write, columns", write_with_columns)]:
+        seconds, peak_bytes, num_blocks = measure(function, df)
+        print(f"{name:<20} {seconds * scale * 1000:8.1f} ms  {peak_bytes / 2**20:8.1f} MB peak"
+              f"  {num_blocks:9d} blocks held")
@@ -0,0 +1,401 @@
+"""
+Real-time detection of slowdowns on the transit graph.
+
+Each collection cycle gives one reading per active vehicle. Readings are
+located along the stops of their direction, and the times at which a vehicle
+passes each stop are interpolated between consecutive readings. Two stops
+passed in a row give a live traversal time on the transit graph edge joining
+them, which is compared to the historical travel time distribution of the
+edge at that hour of the week (see transit_statistics).
+
+An edge is flagged when the median of its live traversal times over a recent
+window is both far in the upper tail of the distribution (above the
+threshold quantile) and far from its center in robust units, i.e.
+
+    z = (live - median) / (IQR / 1.349)
+
+is above the z threshold. The IQR scale makes z behave like a standard score
+on normal data while ignoring the long tail of historical delays.
+"""
+import datetime
+import numpy as np
+import pandas as pd
+import time
+from route_geometry import project_to_meters
+from transit_statistics import TransitStatistics
+from utils.queries import load_sql_file
+
+
+class AnomalyDetector:
+    """
+    Streaming slowdown detector over vehicle readings.
+
+    The detector keeps the last reading and last stop passed of each vehicle,
+    so each cycle only needs the new readings. It can also be run on a window
+    of past readings at once, e.g. from a fresh process (see from_database).
+
+    Usage:
+        detector = AnomalyDetector(stops_df, stats)
+        detector.add_vehicle_locations(df_locations)   # each cycle
+        df_anomalies = detector.detect()
+    """
+
+    gap_seconds = 600             # readings further apart start a new trip
+    max_backtrack_meters = 200    # larger moves backwards start a new trip
+    max_distance_to_route = 200   # readings further from their direction are ignored
+    window_minutes = 15           # live traversal times kept for detection
+
+    threshold_quantile = 0.95
+    z_threshold = 3.0
+    min_live_samples = 2
+    min_history_samples = 20
+    min_scale_seconds = 5         # about the resolution of the sketches
+    max_cache_age_seconds = 3600  # thresholds and loaded hours are refreshed after
+
+    def __init__(self, stops_df, stats):
+        """
+        Args:
+            stops_df (dataframe): Stops with direction_tag, stop_tag, lat, lon,
+                                  stop_order columns, see get_all_stops_data.sql.
+            stats (TransitStatistics): Historical travel time distributions.
+                                       Hours missing from it are loaded on
+                                       demand when it has a database.
+        """
+        self.stats = stats
+        self._loaded_hours = {hour for _, hour in stats.sketches}
+        self._thresholds = {}   # (edge_key, hour_of_week) -> (median, q_threshold, scale)
+        self._cache_started = time.monotonic()
+        self._set_direction_geometry(stops_df)
+
+        self._last_readings = pd.DataFrame(
+            {"id": pd.Series(dtype=object), "direction": pd.Series(dtype=np.int64),
+             "progress": pd.Series(dtype=np.float64), "time": pd.Series(dtype=np.float64)})
+        self._last_crossings = {}   # vehicle id -> (flat stop index, time)
+        self._observations = pd.DataFrame(
+            {"edge_key": pd.Series(dtype=object), "hour_of_week": pd.Series(dtype=np.int64),
+             "seconds": pd.Series(dtype=np.float64), "time": pd.Series(dtype=np.float64)})
+
+    @classmethod
+    def from_database(cls, db, source="vehicle_locations", now=None):
+        """Build a detector from the stops and statistics of the database, 
+        and replay the readings of the last window and trip gap, so that 
+        trips in progress are located. Meant for a cold start: a running 
+        detector only needs the readings of each new cycle.
+
+        Args:
+            db (DatabaseWrapper): Database wrapper.
+            source (str, optional): Table of vehicle readings, either 
+                                    'vehicle_locations' or 
+                                    'vehicle_locations_compact'.
+                                    Defaults to 'vehicle_locations'.
+            now (datetime, optional): End of the readings replayed. 
+                                      Defaults to now.
+
+        Returns:
+            AnomalyDetector: The detector.
+        """
+        detector = cls(db.query(load_sql_file("get_all_stops_data.sql")), TransitStatistics(db))
+
+        now = now or datetime.datetime.now()
+        since = now - datetime.timedelta(minutes=cls.window_minutes, seconds=cls.gap_seconds)
+        detector.add_vehicle_locations(db.get_vehicle_locations_since(since, source=source))
+        return detector
+
+    def _set_direction_geometry(self, stops_df):
+        """Helper function to __init__. Lay the stops of all directions out
+        as padded (num_directions, max_num_stops) arrays of planar coordinates
+        and distances along the direction, plus a flat array of the
+        distances, offset per direction so that it is sorted overall."""
+
+        df = stops_df.dropna(subset=["lat", "lon", "stop_order"]) \
+                     .sort_values(["direction_tag", "stop_order"])
+        self.direction_tags = np.array(sorted(df.direction_tag.unique()), dtype=object)
+        self.direction_ids = {tag: i for i, tag in enumerate(self.direction_tags)}
+
+        # Local equirectangular projection, in meters.
+        self._lat0 = df.lat.mean() if len(df) else 0.0
+        self._lon0 = df.lon.mean() if len(df) else 0.0
+        x, y = self._project(df.lat.to_numpy(), df.lon.to_numpy())
+
+        direction = df.direction_tag.map(self.direction_ids).to_numpy()
+        position = df.groupby("direction_tag").cumcount().to_numpy()
+        num_stops = np.bincount(direction, minlength=len(self.direction_tags))
+        shape = (len(self.direction_tags), max(num_stops.max(initial=0), 2))
+
+        self._stop_x = np.full(shape, np.nan)
+        self._stop_y = np.full(shape, np.nan)
+        self._stop_x[direction, position] = x
+        self._stop_y[direction, position] = y
+
+        leg_lengths = np.hypot(np.diff(self._stop_x, axis=1), np.diff(self._stop_y, axis=1))
+        self._stop_distance = np.concatenate(
+            [np.zeros((shape[0], 1)), np.nancumsum(leg_lengths, axis=1)], axis=1)
+        self._stop_distance[np.isnan(self._stop_x)] = np.nan
+
+        # Flat stops, in direction then stop order, with sorted offset distances.
+        self._direction_offset = np.nan_to_num(
+            np.nanmax(self._stop_distance, axis=1, initial=0)).cumsum() + np.arange(shape[0]) * 1000.0
+        self._direction_offset = np.concatenate([[0.0], self._direction_offset[:-1]])
+        self._flat_distance = self._stop_distance[direction, position] \
+                              + self._direction_offset[direction]
+        self._flat_direction = direction
+        self._flat_stop_tag = df.stop_tag.to_numpy(dtype=object)
+
+    def _project(self, lat, lon):
+        """Map (lat, lon) in degrees to planar coordinates in meters, see
+        route_geometry.project_to_meters."""
+
+        return project_to_meters(lat, lon, self._lat0, self._lon0)
+
+    def get_progress(self, direction, lat, lon):
+        """Locate readings along their direction: project each reading on
+        the nearest leg between consecutive stops.
+
+        Args:
+            direction (np.ndarray): Direction id of each reading.
+            lat, lon (np.ndarray): Coordinates of each reading.
+
+        Returns:
+            tuple(np.ndarray, np.ndarray): Distance along the direction and
+                                           distance to the direction, in meters.
+        """
+        x, y = self._project(lat, lon)
+        x, y = x[:, None], y[:, None]
+
+        x1, y1 = self._stop_x[direction, :-1], self._stop_y[direction, :-1]
+        dx = self._stop_x[direction, 1:] - x1
+        dy = self._stop_y[direction, 1:] - y1
+        length_squared = dx * dx + dy * dy
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t = np.clip(((x - x1) * dx + (y - y1) * dy) / length_squared, 0, 1)
+        t = np.nan_to_num(t)   # repeated stops have zero length legs
+        distance = np.hypot(x1 + t * dx - x, y1 + t * dy - y)
+        distance[np.isnan(distance)] = np.inf
+
+        leg = distance.argmin(axis=1)
+        rows = np.arange(len(leg))
+        progress = self._stop_distance[direction, leg] \
+                   + t[rows, leg] * np.sqrt(length_squared[rows, leg])
+        return progress, distance[rows, leg]
+
+    def add_vehicle_locations(self, df_locations):
+        """Fold a batch of vehicle readings into the live traversal times.
+
+        Args:
+            df_locations (dataframe): Readings with id, direction_tag, lat, lon,
+                                      read_time columns, e.g. a collection
+                                      cycle of the vehicle_locations table.
+
+        Returns:
+            dataframe: New live traversal times, with edge_key, hour_of_week,
+                       seconds, time columns (time in epoch seconds, at the
+                       end of the edge).
+        """
+        df = df_locations[df_locations.direction_tag.isin(self.direction_ids)]
+        df = df.dropna(subset=["lat", "lon", "read_time"])
+
+        direction = df.direction_tag.map(self.direction_ids).to_numpy(dtype=np.int64)
+        progress, distance = self.get_progress(direction,
+                                               df.lat.to_numpy(dtype=np.float64),
+                                               df.lon.to_numpy(dtype=np.float64))
+        readings = pd.DataFrame({
+            "id": df.id.to_numpy(dtype=object),
+            "direction": direction,
+            "progress": progress,
+            "time": pd.to_datetime(df.read_time).to_numpy(dtype="datetime64[ns]")
+                                                .astype(np.int64) / 1e9
+        })[distance <= self.max_distance_to_route]
+
+        readings = pd.concat([self._last_readings, readings], ignore_index=True) \
+                     .drop_duplicates(subset=["id", "time"], keep="first") \
+                     .sort_values(["id", "time"], kind="stable") \
+                     .reset_index(drop=True)
+        if readings.empty:
+            return self._observations.iloc[:0]
+
+        readings["trip"] = self._get_trip_numbers(readings)
+        crossings = self._get_crossings(readings)
+        observations = self._get_traversal_times(readings, crossings)
+
+        self._last_readings = readings.groupby("id", sort=False).tail(1) \
+                                      .drop(columns="trip")
+        latest_time = readings.time.max()
+        self._observations = pd.concat([self._observations, observations], ignore_index=True)
+        self._observations = self._observations[
+            self._observations.time >= latest_time - 60 * self.window_minutes]
+
+        return observations
+
+    def _get_trip_numbers(self, readings):
+        """Helper function to add_vehicle_locations. Number the trips of
+        readings sorted by vehicle and time: a trip ends when the vehicle
+        changes direction, stops reporting for a while, or jumps backwards."""
+
+        ids = readings.id.to_numpy()
+        direction = readings.direction.to_numpy()
+        progress = readings.progress.to_numpy()
+        time = readings.time.to_numpy()
+
+        is_same_trip = ((ids[1:] == ids[:-1])
+                        & (direction[1:] == direction[:-1])
+                        & (time[1:] - time[:-1] <= self.gap_seconds)
+                        & (progress[1:] >= progress[:-1] - self.max_backtrack_meters))
+        return np.concatenate([[0], np.cumsum(~is_same_trip)])
+
+    def _get_crossings(self, readings):
+        """Helper function to add_vehicle_locations. Interpolate the times
+        at which vehicles pass stops between consecutive readings of a trip."""
+
+        trip = readings.trip.to_numpy()
+        direction = readings.direction.to_numpy()
+        progress = readings.progress.to_numpy()
+        time = readings.time.to_numpy()
+
+        pairs = np.flatnonzero((trip[1:] == trip[:-1]) & (progress[1:] > progress[:-1]))
+        p0, p1 = progress[pairs], progress[pairs + 1]
+        t0, t1 = time[pairs], time[pairs + 1]
+        offset = self._direction_offset[direction[pairs]]
+
+        # Stops with distance in (p0, p1] are passed between the readings, and
+        # the first stop is passed when leaving it.
+        first = np.searchsorted(self._flat_distance, np.where(p0 > 0, p0, -1.0) + offset,
+                                side="right")
+        last = np.searchsorted(self._flat_distance, p1 + offset, side="right")
+        num_crossed = last - first
+
+        pair = np.repeat(np.arange(len(pairs)), num_crossed)
+        stop = np.repeat(first - np.cumsum(num_crossed) + num_crossed, num_crossed) \
+               + np.arange(num_crossed.sum())
+        fraction = (self._flat_distance[stop] - offset[pair] - p0[pair]) / (p1 - p0)[pair]
+
+        return pd.DataFrame({
+            "id": readings.id.to_numpy()[pairs][pair],
+            "trip": trip[pairs][pair],
+            "stop": stop,
+            "time": t0[pair] + np.clip(fraction, 0, 1) * (t1 - t0)[pair]
+        })
+
+    def _get_traversal_times(self, readings, crossings):
+        """Helper function to add_vehicle_locations. Get the traversal times
+        of the edges between consecutive stops passed on a trip, including
+        the last stop passed in previous batches, and keep the last stop 
+        passed on each vehicle's current trip."""
+
+        # The last stop passed belongs to the trip of the vehicle's last
+        # reading, which is the first reading of the vehicle in this batch.
+        first_trips = readings.groupby("id", sort=False).trip.first()
+        previous = pd.DataFrame(
+            [(vehicle_id, first_trips[vehicle_id], stop, time)
+             for vehicle_id, (stop, time) in self._last_crossings.items()
+             if vehicle_id in first_trips.index],
+            columns=["id", "trip", "stop", "time"])
+        crossings = pd.concat([previous, crossings], ignore_index=True) \
+                      .sort_values(["trip", "time"], kind="stable")
+
+        trip = crossings.trip.to_numpy(dtype=np.int64)
+        stop = crossings.stop.to_numpy(dtype=np.int64)
+        time = crossings.time.to_numpy(dtype=np.float64)
+
+        is_edge = (trip[1:] == trip[:-1]) & (stop[1:] == stop[:-1] + 1) \
+                  & (self._flat_direction[stop[1:]] == self._flat_direction[stop[:-1]])
+        edges = np.flatnonzero(is_edge)
+        departure = pd.to_datetime(time[edges], unit="s")
+
+        last_trips = readings.groupby("id", sort=False).trip.last()
+        last = crossings.groupby("id", sort=False).tail(1)
+        last = last[last.trip.to_numpy() == last_trips.reindex(last.id).to_numpy()]
+        for vehicle_id in last_trips.index:
+            self._last_crossings.pop(vehicle_id, None)
+        self._last_crossings.update(zip(last.id, zip(last.stop, last.time)))
+
+        stop1, stop2 = stop[edges], stop[edges + 1]
+        edge_key = (pd.Series(self._flat_stop_tag[stop1], dtype=object) + "_"
+                    + pd.Series(self._flat_stop_tag[stop2], dtype=object) + "_"
+                    + pd.Series(self.direction_tags[self._flat_direction[stop1]], dtype=object))
+
+        return pd.DataFrame({
+            "edge_key": edge_key.to_numpy(dtype=object),
+            "hour_of_week": (departure.dayofweek * 24 + departure.hour).to_numpy(dtype=np.int64),
+            "seconds": time[edges + 1] - time[edges],
+            "time": time[edges + 1]
+        })
+
+    def detect(self, detected_at=None):
+        """Compare the live traversal times of the window to the historical
+        distributions, and flag slowdowns.
+
+        Args:
+            detected_at (datetime, optional): Time of detection recorded.
+                                              Defaults to the latest reading.
+
+        Returns:
+            dataframe: Anomalies with edge_key, detected_at, hour_of_week,
+                       live_seconds, expected_seconds, threshold_seconds,
+                       z_score, num_samples columns, as in the anomalies table.
+        """
+        if detected_at is None:
+            latest = self._last_readings.time.max() if len(self._last_readings) else 0
+            detected_at = pd.to_datetime(latest, unit="s").floor("s")
+
+        # A long running detector picks up statistics updated since it started.
+        if time.monotonic() - self._cache_started > self.max_cache_age_seconds:
+            self._thresholds.clear()
+            if self.stats.db is not None:
+                self._loaded_hours.clear()
+            self._cache_started = time.monotonic()
+
+        df = self._observations
+        self._load_missing_hours(df.hour_of_week.unique())
+
+        thresholds = [self._get_thresholds(edge_key, hour_of_week)
+                      for edge_key, hour_of_week in zip(df.edge_key, df.hour_of_week)]
+        df = df.assign(
+            expected_seconds=[t[0] for t in thresholds],
+            threshold_seconds=[t[1] for t in thresholds],
+            scale=[t[2] for t in thresholds]
+        ).dropna(subset=["expected_seconds"])
+        df["z_score"] = (df.seconds - df.expected_seconds) / df.scale
+
+        df = df.sort_values("time").groupby("edge_key").agg(
+                hour_of_week=("hour_of_week", "last"),
+                live_seconds=("seconds", "median"),
+                expected_seconds=("expected_seconds", "median"),
+                threshold_seconds=("threshold_seconds", "median"),
+                z_score=("z_score", "median"),
+                num_samples=("seconds", "size")
+            ).reset_index()
+
+        is_anomaly = ((df.num_samples >= self.min_live_samples)
+                      & (df.live_seconds > df.threshold_seconds)
+                      & (df.z_score >= self.z_threshold))
+        df = df[is_anomaly].copy()
+        df.insert(1, "detected_at", detected_at)
+
+        return df.sort_values("z_score", ascending=False).reset_index(drop=True)
+
+    def _load_missing_hours(self, hours_of_week):
+        """Helper function to detect. Load distributions for hours of the
+        week not seen yet, when the statistics are backed by a database."""
+
+        missing = sorted({int(h) for h in hours_of_week} - self._loaded_hours)
+        if missing and self.stats.db is not None:
+            self.stats.load(hours_of_week=missing)
+        self._loaded_hours.update(missing)
+
+    def _get_thresholds(self, edge_key, hour_of_week):
+        """Helper function to detect. Get the median, threshold quantile and
+        robust scale of an edge's travel times at an hour of the week, or
+        nans without enough history. Cached, except for nans, so that edges
+        are picked up as their history grows."""
+
+        key = (edge_key, hour_of_week)
+        if key not in self._thresholds:
+            sketch = self.stats.get_sketch(edge_key, hour_of_week)
+            if sketch is None or sketch.num_samples < self.min_history_samples:
+                return (np.nan, np.nan, np.nan)
+            iqr = sketch.quantile(0.75) - sketch.quantile(0.25)
+            self._thresholds[key] = (sketch.quantile(0.5),
+                                     sketch.quantile(self.threshold_quantile),
+                                     max(iqr / 1.349, self.min_scale_seconds))
+        return self._thresholds[key]
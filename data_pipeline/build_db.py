@@ -3,8 +3,8 @@ Scripts to create database schema and populate some initial tables.
 """
 import argparse
 import db_connection
-from db_tables import Base, Agencies
-from sqlalchemy import inspect
+from db_tables import Base, Agencies, VIEWS
+from sqlalchemy import inspect, text
 from utils.configs import get_transit_config
 
 
@@ -36,6 +36,33 @@ if __name__ == "__main__":
 
     Base.metadata.create_all(engine, checkfirst=True)
 
+    # Add nullable columns added to tables which already existed, e.g. the 
+    # distinct counts of vehicle_locations_hourly (rebuild it with -rh). 
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing_columns = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns or not column.nullable:
+                    continue
+                if args.verbose:
+                    print(f"Adding column {table.name}.{column.name}.")
+                conn.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(
+                                      table.name, column.name, 
+                                      column.type.compile(dialect=engine.dialect))))
+
+    # Create indexes added to tables which already existed. 
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+    # Create or refresh the views. 
+    with engine.begin() as conn:
+        for view_name, view_definition in VIEWS.items():
+            if args.verbose:
+                print(f"Creating view {view_name}.")
+            conn.execute(text(view_definition))
+
     # The agencies table simply holds the tag for our chosen agency.
     config = get_transit_config()
     agency_tag = config["agency_tag"]  
@@ -0,0 +1,160 @@
+"""
+Changes between two versions of the transit configuration.
+
+A transit config refresh is compared against the stored directions and stops
+before it is written, and the differences are recorded in the
+transit_config_changes table: one row per added, removed or changed direction
+or stop row. The connections and transit graph builders read the changes
+they have not applied yet, and only recompute what the changes touch: the
+neighborhoods of moved, added and removed stops, and the edge chains of the
+directions whose stops changed.
+"""
+import datetime
+import pandas as pd
+
+
+class TransitConfigDiff:
+    """
+    Added, removed and changed rows of the directions and stops tables.
+
+    Usage:
+        diff = TransitConfigDiff.compare(stored, fresh)
+        db.refresh_tables({..., "transit_config_changes": diff.changes})
+
+        diff = TransitConfigDiff(db.get_pending_transit_config_changes("connections"))
+        stop_tags = diff.get_moved_stop_tags()
+    """
+
+    # Columns compared, by table. Rows are matched on the primary key.
+    compared_columns = {
+        "directions": ["tag", "title", "name", "route_tag", "branch"],
+        "stops": ["tag", "title", "lat", "lon", "route_tag", "direction_tag",
+                  "stop_along_direction"],
+    }
+    primary_keys = {"directions": "tag", "stops": "key"}
+
+    change_columns = ["detected_at", "table_name", "key", "route_tag", "direction_tag",
+                      "stop_tag", "change", "changed_columns",
+                      "connections_applied", "graph_applied"]
+
+    def __init__(self, changes):
+        """
+        Args:
+            changes (dataframe): Changes, in the format of the
+                                 transit_config_changes table.
+        """
+        self.changes = changes
+
+    @classmethod
+    def compare(cls, stored, fresh, scope_column="route_tag", detected_at=None):
+        """Compare fresh directions and stops to the stored ones. Only the
+        scopes (e.g. routes) present in the fresh data are compared, so that
+        routes missing from a partial refresh don't show up as removed.
+
+        Args:
+            stored (dict): Stored 'directions' and 'stops' dataframes.
+            fresh (dict): Fresh 'directions' and 'stops' dataframes.
+            scope_column (str, optional): Column scoping the comparison.
+                                          Defaults to 'route_tag'.
+            detected_at (datetime, optional): Time recorded on the changes.
+                                              Defaults to now.
+
+        Returns:
+            TransitConfigDiff: The changes.
+        """
+        if detected_at is None:
+            detected_at = datetime.datetime.now().replace(microsecond=0)
+
+        df_list = []
+        for tablename, columns in cls.compared_columns.items():
+            df_stored, df_fresh = stored.get(tablename), fresh.get(tablename)
+            if df_fresh is None or df_fresh.empty:
+                continue
+            if df_stored is None:
+                df_stored = pd.DataFrame(columns=df_fresh.columns)
+
+            scopes = df_fresh[scope_column].dropna().unique()
+            df_stored = df_stored[df_stored[scope_column].isin(scopes)]
+            df_list.append(cls._compare_table(tablename, columns, df_stored, df_fresh))
+
+        changes = pd.concat(df_list, ignore_index=True) if df_list \
+            else pd.DataFrame(columns=cls.change_columns[1:])
+        changes.insert(0, "detected_at", detected_at)
+        changes["connections_applied"] = False
+        changes["graph_applied"] = False
+
+        return cls(changes[cls.change_columns])
+
+    @classmethod
+    def _compare_table(cls, tablename, columns, df_stored, df_fresh):
+        """Helper function to compare. Get the changes of a single table."""
+
+        primary_key = cls.primary_keys[tablename]
+        selected = list(dict.fromkeys([primary_key] + columns))
+        df = pd.merge(df_stored.drop_duplicates(subset=primary_key)[selected],
+                      df_fresh.drop_duplicates(subset=primary_key, keep="last")[selected],
+                      on=primary_key, how="outer", suffixes=("_stored", "_fresh"),
+                      indicator=True)
+
+        is_changed = pd.DataFrame({
+            col: ~((df[col + "_stored"] == df[col + "_fresh"])
+                   | (df[col + "_stored"].isna() & df[col + "_fresh"].isna()))
+            for col in columns if col != primary_key
+        })
+        changed_columns = is_changed.apply(
+            lambda row: ",".join(row.index[row.to_numpy()]), axis=1) \
+            if len(df) else pd.Series(dtype=object)
+
+        change = df["_merge"].map({"left_only": "removed", "right_only": "added",
+                                   "both": "changed"})
+        is_kept = (change != "changed") | (changed_columns != "")
+
+        # Describe rows by their fresh values, or stored ones when removed.
+        def get_column(col):
+            if col == primary_key:
+                return df[col]
+            return df[col + "_fresh"].where(change != "removed", df[col + "_stored"])
+
+        stop_tag = get_column("tag") if tablename == "stops" else None
+        direction_tag = get_column("direction_tag") if tablename == "stops" else get_column("tag")
+
+        changes = pd.DataFrame({
+            "table_name": tablename,
+            "key": df[primary_key].astype(str),
+            "route_tag": get_column("route_tag"),
+            "direction_tag": direction_tag,
+            "stop_tag": stop_tag,
+            "change": change,
+            "changed_columns": changed_columns.where(change == "changed", None),
+        })
+        return changes[is_kept.to_numpy()].reset_index(drop=True)
+
+    def is_empty(self):
+        return self.changes.empty
+
+    def get_moved_stop_tags(self):
+        """Get the tags of the stops added, removed or moved, whose
+        connections to nearby stops must be recomputed.
+
+        Returns:
+            List[str]: Stop tags.
+        """
+        df = self.changes[self.changes.table_name == "stops"]
+        is_moved = (df.change != "changed") \
+            | df.changed_columns.fillna("").str.contains("lat|lon")
+        return sorted(df[is_moved].stop_tag.dropna().unique())
+
+    def get_rechained_direction_tags(self):
+        """Get the tags of the directions added or removed, or whose sequence
+        of stops changed, whose edge chains must be rebuilt in the transit
+        graph.
+
+        Returns:
+            List[str]: Direction tags.
+        """
+        df = self.changes
+        is_direction = (df.table_name == "directions") & (df.change != "changed")
+        is_stop = (df.table_name == "stops") & (
+            (df.change != "changed")
+            | df.changed_columns.fillna("").str.contains("stop_along_direction|direction_tag"))
+        return sorted(df[is_direction | is_stop].direction_tag.dropna().unique())
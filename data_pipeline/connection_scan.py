@@ -0,0 +1,441 @@
+"""
+Connection Scan journey planning over the schedules table.
+
+The schedules of a service class (e.g. 'wkd') are compiled into a timetable
+of elementary connections: a vehicle leaving a stop at some time and
+reaching the next stop of its trip at a later time. Connections are stored
+as parallel NumPy arrays sorted by departure time, which can be saved to
+.npy files and memory-mapped back. Walking transfers come from the
+connections table.
+
+Times are seconds since midnight of the service day, as in the schedules
+(which may run past 24:00 for late trips). Stops are trimmed stop tags, as
+the nodes of the transit graph (see routing.trim_stop_tags).
+"""
+import bisect
+import os
+import numpy as np
+import pandas as pd
+from routing import trim_stop_tags
+
+
+class ConnectionTimetable:
+    """
+    Elementary connections of a service class, with a Connection Scan
+    Algorithm (CSA) query API.
+
+    Usage:
+        timetable = ConnectionTimetable.from_database(db, service_class="wkd")
+        timetable.save(path)
+
+        timetable = ConnectionTimetable.load(path)
+        arrival, legs = timetable.earliest_arrival("14260", "5292", 8 * 3600)
+        df_profile = timetable.profile("14260", "5292", 8 * 3600, 9 * 3600)
+    """
+
+    walking_speed_mps = 1.3
+    scan_chunk_size = 8192   # connections converted to lists at a time
+
+    array_names = ("dep_stop", "arr_stop", "dep_time", "arr_time", "trip",
+                   "footpath_indptr", "footpath_targets", "footpath_seconds",
+                   "stops", "trips")
+
+    def __init__(self, dep_stop, arr_stop, dep_time, arr_time, trip,
+                 footpath_indptr, footpath_targets, footpath_seconds,
+                 stops, trips):
+        """
+        Args:
+            dep_stop, arr_stop (np.ndarray): Stop ids of each connection.
+            dep_time, arr_time (np.ndarray): Times of each connection, in
+                                             seconds. Sorted by dep_time.
+            trip (np.ndarray): Trip id of each connection.
+            footpath_indptr (np.ndarray): CSR row pointers of the footpaths,
+                                          of length num_stops + 1.
+            footpath_targets (np.ndarray): Target stop id of each footpath.
+            footpath_seconds (np.ndarray): Walking time of each footpath.
+            stops (np.ndarray): Stop tag of each stop id.
+            trips (np.ndarray): Label of each trip id, as
+                                '<route_tag>_<block_id>_<first departure>'.
+        """
+        self.dep_stop = dep_stop
+        self.arr_stop = arr_stop
+        self.dep_time = dep_time
+        self.arr_time = arr_time
+        self.trip = trip
+        self.footpath_indptr = footpath_indptr
+        self.footpath_targets = footpath_targets
+        self.footpath_seconds = footpath_seconds
+        self.stops = stops
+        self.trips = trips
+        self.stop_ids = {tag: i for i, tag in enumerate(stops)}
+
+        self._footpaths = [
+            list(zip(footpath_targets[start:end].tolist(),
+                     footpath_seconds[start:end].tolist()))
+            for start, end in zip(footpath_indptr[:-1].tolist(),
+                                  footpath_indptr[1:].tolist())
+        ]
+
+    @property
+    def num_connections(self):
+        return len(self.dep_time)
+
+    @classmethod
+    def from_database(cls, db, service_class):
+        """Compile the timetable of a service class from the schedules and
+        connections tables.
+
+        Args:
+            db (DatabaseWrapper): Database wrapper.
+            service_class (str): Service class, e.g. 'wkd', 'sat', 'sun'.
+
+        Returns:
+            ConnectionTimetable: The timetable.
+        """
+        return cls.compile(
+                    schedules_df=db.get_schedules_dataframe(service_class),
+                    connections_df=db.get_connections_dataframe())
+
+    @classmethod
+    def compile(cls, schedules_df, connections_df=None):
+        """Compile schedules into elementary connections.
+
+        Schedule rows are in timetable order (i.e. ordered by key), where each
+        block's timetable row lists the stops of one trip. Consecutive rows of
+        a block on the same route direction belong to the same trip until a
+        stop repeats. Stops without a time (epoch_time of -1) are skipped.
+        Only the latest schedule class of each route is used.
+
+        Args:
+            schedules_df (dataframe): Schedules of a single service class, in
+                                      the format of the schedules table.
+            connections_df (dataframe, optional): Walking connections, in the
+                                                  format of the connections table.
+
+        Returns:
+            ConnectionTimetable: The timetable.
+        """
+        df = schedules_df.sort_values("key", kind="stable")
+        is_latest = df.schedule_class == df.groupby("route_tag").schedule_class.transform("max")
+        df = df[is_latest].reset_index(drop=True)
+
+        # Split rows into trips.
+        block_columns = ["route_tag", "schedule_class", "direction_name", "block_id"]
+        is_new_run = (df[block_columns] != df[block_columns].shift()).any(axis=1)
+        df["run"] = is_new_run.cumsum()
+        df["trip_number"] = df.groupby(["run", "stop_tag"]).cumcount()
+        df = df[df.epoch_time >= 0]
+
+        df["stop"] = trim_stop_tags(df.stop_tag.astype(str))
+        df["time"] = (df.epoch_time // 1000).astype(np.int64)
+        df["trip"] = df.groupby(["run", "trip_number"], sort=False).ngroup()
+
+        # Consecutive stops on a trip form a connection.
+        df = df.sort_values(["trip", "time"], kind="stable")
+        next_df = df.shift(-1)
+        is_connection = ((df.trip == next_df.trip) & (df.stop != next_df.stop)).to_numpy()
+
+        connections = pd.DataFrame({
+            "dep_stop": df.stop.to_numpy()[is_connection],
+            "arr_stop": next_df.stop.to_numpy()[is_connection],
+            "dep_time": df.time.to_numpy()[is_connection],
+            "arr_time": next_df.time.to_numpy()[is_connection].astype(np.int64),
+            "trip": df.trip.to_numpy()[is_connection],
+        }).sort_values(["dep_time", "arr_time"], kind="stable")
+
+        # Label trips by route, block and first departure, e.g. '506_1234_21300'.
+        trip_info = df.groupby("trip")[["route_tag", "block_id"]].first()
+        first_departures = connections.groupby("trip").dep_time.min().reindex(
+                                trip_info.index, fill_value=-1)
+        trips = (trip_info.route_tag.astype(str) + "_" + trip_info.block_id.astype(str)
+                 + "_" + first_departures.astype(str)).to_numpy(dtype=str)
+
+        footpaths = cls._get_footpaths_df(connections_df)
+        stops = np.unique(np.concatenate([
+                    connections.dep_stop.to_numpy(dtype=str),
+                    connections.arr_stop.to_numpy(dtype=str),
+                    footpaths.stop1.to_numpy(dtype=str),
+                    footpaths.stop2.to_numpy(dtype=str)]))
+        stop_index = pd.Index(stops)
+
+        footpath_sources = stop_index.get_indexer(footpaths.stop1)
+        order = np.argsort(footpath_sources, kind="stable")
+        footpath_indptr = np.zeros(len(stops) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(footpath_sources, minlength=len(stops)),
+                  out=footpath_indptr[1:])
+
+        return cls(
+            dep_stop=stop_index.get_indexer(connections.dep_stop).astype(np.int32),
+            arr_stop=stop_index.get_indexer(connections.arr_stop).astype(np.int32),
+            dep_time=connections.dep_time.to_numpy(dtype=np.int32),
+            arr_time=connections.arr_time.to_numpy(dtype=np.int32),
+            trip=connections.trip.to_numpy(dtype=np.int32),
+            footpath_indptr=footpath_indptr,
+            footpath_targets=stop_index.get_indexer(footpaths.stop2)[order].astype(np.int32),
+            footpath_seconds=footpaths.seconds.to_numpy(dtype=np.int32)[order],
+            stops=stops,
+            trips=trips)
+
+    @classmethod
+    def _get_footpaths_df(cls, connections_df):
+        """Helper function to compile. Get walking transfers between trimmed
+        stops, with their walking time in seconds."""
+
+        if connections_df is None or connections_df.empty:
+            return pd.DataFrame({"stop1": [], "stop2": [], "seconds": []})
+
+        footpaths = pd.DataFrame({
+            "stop1": trim_stop_tags(connections_df.stop1.astype(str)),
+            "stop2": trim_stop_tags(connections_df.stop2.astype(str)),
+            "seconds": np.ceil(connections_df.distance_meters.astype(float)
+                               / cls.walking_speed_mps).astype(np.int64)
+        })
+        footpaths = footpaths[footpaths.stop1 != footpaths.stop2]
+        return footpaths.groupby(["stop1", "stop2"], as_index=False).seconds.min()
+
+    def save(self, path):
+        """Save the timetable arrays as .npy files in the path directory.
+
+        Args:
+            path (str): Directory, created if needed.
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in self.array_names:
+            np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a timetable saved with save. Connection arrays are memory-mapped
+        by default, so only the scanned parts are read from disk.
+
+        Args:
+            path (str): Directory of the timetable.
+            mmap (bool, optional): Memory-map the arrays. Defaults to True.
+
+        Returns:
+            ConnectionTimetable: The timetable.
+        """
+        mmap_mode = "r" if mmap else None
+        arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+                  for name in cls.array_names}
+        return cls(**arrays)
+
+    def _iter_connections(self, start, stop, reverse=False):
+        """Iterate over the connections in positions [start, stop), converting
+        them to Python values one chunk at a time.
+
+        Yields:
+            tuple: (position, dep_stop, arr_stop, dep_time, arr_time, trip).
+        """
+        chunk_starts = range(start, stop, self.scan_chunk_size)
+        if reverse:
+            chunk_starts = reversed(chunk_starts)
+
+        for chunk_start in chunk_starts:
+            chunk_stop = min(chunk_start + self.scan_chunk_size, stop)
+            chunk = zip(range(chunk_start, chunk_stop),
+                        self.dep_stop[chunk_start:chunk_stop].tolist(),
+                        self.arr_stop[chunk_start:chunk_stop].tolist(),
+                        self.dep_time[chunk_start:chunk_stop].tolist(),
+                        self.arr_time[chunk_start:chunk_stop].tolist(),
+                        self.trip[chunk_start:chunk_stop].tolist())
+            yield from (reversed(list(chunk)) if reverse else chunk)
+
+    def earliest_arrival(self, source_tag, target_tag, departure_time):
+        """Find the earliest arrival at the target stop when leaving the
+        source stop at departure_time.
+
+        Args:
+            source_tag (str): Source stop, i.e. trimmed stop tag.
+            target_tag (str): Target stop, i.e. trimmed stop tag.
+            departure_time (int): Departure time, in seconds since midnight.
+
+        Returns:
+            (int, List[dict]): Arrival time in seconds and the legs of the
+                               journey, or (None, []) if the target can't be
+                               reached. Legs have keys mode ('trip' or 'walk'),
+                               trip, from_stop, to_stop, departure, arrival.
+        """
+        source = self.stop_ids[source_tag]
+        target = self.stop_ids[target_tag]
+        num_stops = len(self.stops)
+        footpaths = self._footpaths
+
+        arrival = np.full(num_stops, np.inf)
+        via_connection = np.full(num_stops, -1)      # connection reaching each stop
+        via_walk = np.full(num_stops, -1)            # or stop walked from
+        boarded_at = np.full(len(self.trips), self.num_connections)  # first connection used
+
+        arrival[source] = departure_time
+        for stop, seconds in footpaths[source]:
+            if departure_time + seconds < arrival[stop]:
+                arrival[stop] = departure_time + seconds
+                via_walk[stop] = source
+
+        # Connections are scanned by chunks. In each chunk, only connections on 
+        # a boarded trip or leaving a reached stop need a look; these are found
+        # with array operations, and the search is repeated until no more 
+        # connections of the chunk are enabled (e.g. by a transfer in the chunk).
+        start = int(np.searchsorted(self.dep_time, departure_time, side="left"))
+        for chunk_start in range(start, self.num_connections, self.scan_chunk_size):
+            chunk_stop = min(chunk_start + self.scan_chunk_size, self.num_connections)
+            dep_time = np.asarray(self.dep_time[chunk_start:chunk_stop])
+            if arrival[target] <= dep_time[0]:
+                break
+
+            positions = np.arange(chunk_start, chunk_stop)
+            dep_stop = np.asarray(self.dep_stop[chunk_start:chunk_stop])
+            trip = np.asarray(self.trip[chunk_start:chunk_stop])
+            is_scanned = np.zeros(len(positions), dtype=bool)
+
+            while True:
+                is_enabled = ((boarded_at[trip] <= positions) 
+                              | (arrival[dep_stop] <= dep_time))
+                is_new = is_enabled & ~is_scanned & (dep_time < arrival[target])
+                if not is_new.any():
+                    break
+                is_scanned |= is_new
+
+                for i in positions[is_new].tolist():
+                    self._scan_connection(i, arrival, via_connection, via_walk, 
+                                          boarded_at) 
+
+        if arrival[target] == np.inf:
+            return None, []
+
+        return int(arrival[target]), self._get_journey_legs(
+                    source, target, arrival, via_connection, via_walk, boarded_at)
+
+    def _scan_connection(self, i, arrival, via_connection, via_walk, boarded_at):
+        """Helper function to earliest_arrival. Take connection i, which is 
+        on a boarded trip or leaves from a reached stop, and update the 
+        arrival times at its arrival stop and the stops within walking 
+        distance."""
+
+        trip = self.trip[i]
+        if i < boarded_at[trip]:
+            boarded_at[trip] = i
+
+        arr_stop = self.arr_stop[i]
+        arr = self.arr_time[i]
+        if arr < arrival[arr_stop]:
+            arrival[arr_stop] = arr
+            via_connection[arr_stop] = i
+            via_walk[arr_stop] = -1
+
+            for stop, seconds in self._footpaths[arr_stop]:
+                if arr + seconds < arrival[stop]:
+                    arrival[stop] = arr + seconds
+                    via_connection[stop] = -1
+                    via_walk[stop] = arr_stop
+
+    def _get_journey_legs(self, source, target, arrival, via_connection, via_walk,
+                          boarded_at):
+        """Helper function to earliest_arrival. Trace the journey back from the
+        target."""
+
+        legs = []
+        stop = target
+        while stop != source:
+            if via_walk[stop] >= 0:
+                from_stop = int(via_walk[stop])
+                legs.append({"mode": "walk", "trip": None,
+                             "from_stop": self.stops[from_stop],
+                             "to_stop": self.stops[stop],
+                             "departure": int(arrival[from_stop]),
+                             "arrival": int(arrival[stop])})
+            else:
+                alight = int(via_connection[stop])
+                board = int(boarded_at[self.trip[alight]])
+                from_stop = int(self.dep_stop[board])
+                legs.append({"mode": "trip", "trip": self.trips[self.trip[alight]],
+                             "from_stop": self.stops[from_stop],
+                             "to_stop": self.stops[stop],
+                             "departure": int(self.dep_time[board]),
+                             "arrival": int(self.arr_time[alight])})
+            stop = from_stop
+
+        return legs[::-1]
+
+    def profile(self, source_tag, target_tag, start_time, end_time,
+                max_journey_seconds=3 * 60 * 60):
+        """Find all Pareto-optimal journeys leaving the source stop between
+        start_time and end_time: for each, no other journey leaves later and
+        arrives earlier. Runs a reverse connection scan.
+
+        Args:
+            source_tag (str): Source stop, i.e. trimmed stop tag.
+            target_tag (str): Target stop, i.e. trimmed stop tag.
+            start_time (int): Earliest departure, in seconds since midnight.
+            end_time (int): Latest departure, in seconds since midnight.
+            max_journey_seconds (int, optional): Longest journey considered;
+                                                 connections leaving later than
+                                                 end_time + max_journey_seconds
+                                                 are not scanned. Defaults to 3h.
+
+        Returns:
+            dataframe: Journeys with departure and arrival columns (in seconds),
+                       sorted by departure.
+        """
+        source = self.stop_ids[source_tag]
+        target = self.stop_ids[target_tag]
+        num_stops = len(self.stops)
+
+        # Walking time to the target, and footpaths leading into each stop.
+        walk_to_target = [np.inf] * num_stops
+        walk_to_target[target] = 0
+        incoming_footpaths = [[] for _ in range(num_stops)]
+        for stop, paths in enumerate(self._footpaths):
+            for next_stop, seconds in paths:
+                incoming_footpaths[next_stop].append((stop, seconds))
+                if next_stop == target:
+                    walk_to_target[stop] = min(walk_to_target[stop], seconds)
+
+        # Pareto profile of each stop: departures and arrivals, both increasing.
+        departures = [[] for _ in range(num_stops)]
+        arrivals = [[] for _ in range(num_stops)]
+        trip_arrival = {}   # trip -> earliest arrival at target when on board
+
+        start = int(np.searchsorted(self.dep_time, start_time, side="left"))
+        stop = int(np.searchsorted(self.dep_time, end_time + max_journey_seconds,
+                                   side="right"))
+        for i, dep_stop, arr_stop, dep, arr, trip in self._iter_connections(
+                                            start, stop, reverse=True):
+
+            stop_departures = departures[arr_stop]
+            position = bisect.bisect_left(stop_departures, arr)
+            arrival = min(arr + walk_to_target[arr_stop],
+                          trip_arrival.get(trip, np.inf),
+                          arrivals[arr_stop][position] if position < len(stop_departures)
+                          else np.inf)
+            if arrival == np.inf:
+                continue
+
+            if arrival < trip_arrival.get(trip, np.inf):
+                trip_arrival[trip] = arrival
+
+            self._add_to_profile(departures[dep_stop], arrivals[dep_stop], dep, arrival)
+            for stop, seconds in incoming_footpaths[dep_stop]:
+                self._add_to_profile(departures[stop], arrivals[stop],
+                                     dep - seconds, arrival)
+
+        df = pd.DataFrame({"departure": departures[source],
+                           "arrival": arrivals[source]})
+        df = df[df.departure.between(start_time, end_time)]
+        return df.astype(int).reset_index(drop=True)
+
+    def _add_to_profile(self, stop_departures, stop_arrivals, departure, arrival):
+        """Helper function to profile. Insert a (departure, arrival) pair in a
+        stop's Pareto profile, unless an entry leaving no earlier arrives no
+        later, and remove the entries it dominates."""
+
+        position = bisect.bisect_left(stop_departures, departure)
+        if position < len(stop_departures) and stop_arrivals[position] <= arrival:
+            return
+
+        first_kept = position
+        while first_kept > 0 and stop_arrivals[first_kept - 1] >= arrival:
+            first_kept -= 1
+
+        stop_departures[first_kept:position] = [departure]
+        stop_arrivals[first_kept:position] = [arrival]
@@ -0,0 +1,101 @@
+"""
+Data quality counters of vehicle location batches.
+
+Each batch of readings is checked once at collection, column by column with
+pandas, for missing values, stale readings, coordinates outside the network
+and duplicate keys. The counts are added to the hour of collection in the
+vehicle_locations_quality table (see DatabaseWrapper.add_vehicle_locations_quality),
+so data quality queries read one row per hour instead of scanning every
+reading.
+"""
+import numpy as np
+import pandas as pd
+
+
+class VehicleLocationsQuality:
+    """
+    Quality counts of batches of vehicle locations.
+
+    Usage:
+        quality = VehicleLocationsQuality.from_database(db)
+        df_counts = quality.get_counts_df(df_locations, time_of_extraction)
+        db.add_vehicle_locations_quality(df_counts)
+    """
+
+    # Columns of the vehicle_locations table whose missing values are counted.
+    null_columns = ["route_tag", "direction_tag", "predictable", "heading",
+                    "speed_kmhr", "lat", "lon", "id", "read_time"]
+
+    def __init__(self, bbox=None, max_report_age_seconds=300):
+        """
+        Args:
+            bbox (tuple, optional): Bounding box (latmin, latmax, lonmin, lonmax)
+                                    of the network. Defaults to None, where
+                                    coordinates are not checked.
+            max_report_age_seconds (int, optional): Readings reported longer
+                                                    before collection are
+                                                    stale. Defaults to 300.
+        """
+        self.bbox = bbox
+        self.max_report_age_seconds = max_report_age_seconds
+
+    @classmethod
+    def from_database(cls, db, margin_degrees=0.01, **kwargs):
+        """Check coordinates against the bounding box of all routes, grown by
+        a margin.
+
+        Args:
+            db (DatabaseWrapper): Database wrapper.
+            margin_degrees (float, optional): Margin around the routes.
+                                              Defaults to 0.01 degrees (~1km).
+            **kwargs: See __init__.
+
+        Returns:
+            VehicleLocationsQuality: The counters.
+        """
+        df = db.get_routes_dataframe()
+        bbox = None
+        if df[["latmin", "latmax", "lonmin", "lonmax"]].notna().all(axis=1).any():
+            bbox = (df.latmin.min() - margin_degrees, df.latmax.max() + margin_degrees,
+                    df.lonmin.min() - margin_degrees, df.lonmax.max() + margin_degrees)
+
+        return cls(bbox=bbox, **kwargs)
+
+    def get_counts_df(self, df, time_of_extraction):
+        """Count the quality issues of a batch of readings.
+
+        Args:
+            df (dataframe): Readings in the format of the vehicle_locations
+                            table, before any filtering.
+            time_of_extraction (datetime): Time at which the batch was
+                                           collected.
+
+        Returns:
+            dataframe: Single row in the format of the vehicle_locations_quality
+                       table: hour, batches, readings, a <column>_null count
+                       per column, stale_readings, out_of_bbox and
+                       duplicate_keys.
+        """
+        counts = {"hour": pd.Timestamp(time_of_extraction).floor("H").to_pydatetime(),
+                  "batches": 1,
+                  "readings": len(df)}
+
+        is_null = df.reindex(columns=self.null_columns).isna()
+        counts.update({f"{column}_null": int(is_null[column].sum())
+                       for column in self.null_columns})
+
+        min_read_time = pd.Timestamp(time_of_extraction) \
+                        - pd.Timedelta(seconds=self.max_report_age_seconds)
+        counts["stale_readings"] = int((pd.to_datetime(df.read_time) < min_read_time).sum())
+
+        counts["out_of_bbox"] = 0
+        if self.bbox is not None:
+            latmin, latmax, lonmin, lonmax = self.bbox
+            lat = df.lat.to_numpy(dtype=np.float64)
+            lon = df.lon.to_numpy(dtype=np.float64)
+            is_outside = (lat < latmin) | (lat > latmax) | (lon < lonmin) | (lon > lonmax)
+            counts["out_of_bbox"] = int(is_outside.sum())
+
+        counts["duplicate_keys"] = int(df.key.duplicated().sum())
+
+        return pd.DataFrame([counts])
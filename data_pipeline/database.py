@@ -1,12 +1,34 @@
 """
 Database wrapper class. Automatically handles queries as batched queries.  
 """
+import contextlib
+import datetime
+import io
+import os
+import tempfile
 import pandas as pd
 import numpy as np 
 import db_tables 
 import db_connection 
 import sqlalchemy
 from sqlalchemy.inspection import inspect 
+from utils.queries import get_named_query
+
+
+# Compact column types for scans of the vehicle_locations tables, for use
+# as the dtypes argument of DatabaseWrapper.iter_query. 
+VEHICLE_LOCATIONS_DTYPES = {
+    "route_tag": "category",
+    "direction_tag": "category",
+    "agency_tag": "category",
+    "id": "category",
+    "predictable": "boolean",
+    "heading": "Int16",
+    "speed_kmhr": "Int16",
+    "lat": "float32",
+    "lon": "float32",
+    "read_time": "datetime64[ns]",
+}
 
 
 class DatabaseWrapper:
@@ -18,15 +40,34 @@ class DatabaseWrapper:
             "routes": db_tables.Routes,
             "directions": db_tables.Directions,
             "stops": db_tables.Stops, 
+            "route_paths": db_tables.RoutePaths,
             "schedules": db_tables.Schedules,
             "vehicles": db_tables.Vehicles,
             "vehicles_validation": db_tables.VehiclesValidation,
             "vehicle_locations": db_tables.VehicleLocations, 
             "vehicle_locations_validation": db_tables.VehicleLocationsValidation, 
+            "predictions": db_tables.Predictions,
+            "vehicle_dim": db_tables.VehicleDimension,
+            "route_dim": db_tables.RouteDimension,
+            "direction_dim": db_tables.DirectionDimension,
+            "vehicle_locations_compact": db_tables.VehicleLocationsCompact,
+            "vehicle_locations_hourly": db_tables.VehicleLocationsHourly,
+            "vehicle_locations_quality": db_tables.VehicleLocationsQuality,
+            "off_route_readings": db_tables.OffRouteReadings,
+            "segment_time_distributions": db_tables.SegmentTimeDistributions,
+            "anomalies": db_tables.Anomalies,
+            "transit_config_changes": db_tables.TransitConfigChanges,
             "connections": db_tables.Connections,
             "transit_graph": db_tables.TransitGraph 
         }
 
+        # Cache of dimension values to integer surrogate keys, by table name.
+        # See insert_vehicle_locations_compact. 
+        self.dimension_ids = {} 
+
+        # Engine allowing LOAD DATA LOCAL INFILE, see bulk_load_dataframe. 
+        self.bulk_load_engine = None 
+
     def connect(self):
         """Get a database connection.
 
@@ -35,107 +76,696 @@ class DatabaseWrapper:
         """
         return db_connection.create_engine().connect() 
 
-    def _check_if_primary_key_in_table(self, tablename, key):
-        """Helper function for insert_dataframe_in_table method.
-        This is used to check for known keys before inserting duplicates.
+    def start_session(self):
+        self.session = db_connection.create_session()
+
+    def insert_dataframe_in_table(self, tablename, dataframe):
+        """Insert dataframe in database, updating existing primary keys. 
+        Assumes the dataframe format matches the type of the table. See 
+        write_dataframe.
 
         Args:
-            tablename (str): Name of ORM table.
-            key: Primary key for that table, of the intended type. 
+            tablename (str): Name of database table, e.g. 'routes'.
+            dataframe (dataframe): Table of values to be inserted. 
+        """
 
-        Returns:
-            bool: Whether key is in database table. 
+        self.write_dataframe(tablename, dataframe) 
+
+    def update_dataframe_in_table(self, tablename, dataframe):
+        """Update dataframe in database.  
+
+        Args:
+            tablename (str): Name of database table, e.g. 'routes'.
+            dataframe (dataframe): Table of values to be updated. 
         """
 
-        table = self.db_tables[tablename]  # ORM table  
-        primary_key = inspect(table).primary_key[0].name   
+        if dataframe is None:
+            return 
 
-        result = self.session.query(getattr(table, primary_key)).filter(
-                        getattr(table, primary_key)==key)
+        if self.session is None:
+            self.start_session() 
 
-        exists_bool = self.session.query(result.exists()).scalar() 
-        return exists_bool 
+        df = dataframe.astype(object).where(dataframe.notna(), None)  # NaN, NaT, <NA> to NULL 
+        table = self.db_tables[tablename]         # ORM table  
 
-    def start_session(self):
-        self.session = db_connection.create_session()
+        self.session.bulk_update_mappings(table, df.to_dict("records"))  
+        self.session.commit() 
 
-    def insert_dataframe_in_table(self, tablename, dataframe):
-        """Insert dataframe in database, updating existing primary keys. 
-        Assumes the dataframe format matches the type of the table. 
+    def upsert_dataframe_in_table(self, tablename, dataframe):
+        """Insert dataframe in database, updating rows whose primary key already 
+        exists, e.g. on tables with composite primary keys. Same as 
+        insert_dataframe_in_table, see write_dataframe. 
 
         Args:
-            tablename (str): Name of database table, e.g. 'routes'.
+            tablename (str): Name of database table, e.g. 'segment_time_distributions'.
             dataframe (dataframe): Table of values to be inserted. 
         """
 
-        if dataframe is None:
+        self.write_dataframe(tablename, dataframe) 
+
+    def write_dataframe(self, tablename, dataframe, batch_size=10000, increment=False):
+        """Insert dataframe in database, updating rows whose primary key already 
+        exists. This is the write path behind insert_dataframe_in_table and
+        upsert_dataframe_in_table. 
+
+        Rows are handed to the DBAPI driver as parameter tuples with a single
+        upsert statement per batch (executemany). Parameters are converted 
+        column by column, with missing values set to None from each column's
+        mask, so neither a copy of the dataframe nor a dict per row is built.
+
+        Args:
+            tablename (str): Name of database table, e.g. 'vehicle_locations'.
+            dataframe (dataframe): Table of values to be inserted. Columns 
+                                   which are not in the table are ignored. 
+            batch_size (int, optional): Number of rows per executemany. 
+                                        Defaults to 10000. 
+            increment (bool, optional): Add the values to those of existing 
+                                        rows instead of replacing them, e.g.
+                                        for counters. Defaults to False. 
+        """
+
+        if dataframe is None or dataframe.empty:
             return 
 
         if self.session is None:
             self.start_session() 
 
-        df = dataframe.replace([np.nan], [None]) 
-        table = self.db_tables[tablename]  # ORM table  
+        table = self.db_tables[tablename].__table__ 
+        columns = [column.name for column in table.columns if column.name in dataframe.columns]
+        primary_keys = [column.name for column in table.primary_key.columns] 
+
+        conn = self.session.connection() 
+        statement = self._get_merge_statement(
+                        conn.dialect.name, table.name, 
+                        self._quote_identifiers(conn, columns), 
+                        self._quote_identifiers(conn, primary_keys), 
+                        paramstyle=conn.dialect.paramstyle, increment=increment) 
+
+        rows = list(zip(*self._get_column_values(dataframe, columns, bool_as_int=False)))
+        cursor = conn.connection.cursor() 
+        try:
+            for start in range(0, len(rows), batch_size):
+                cursor.executemany(statement, rows[start:start + batch_size]) 
+        finally:
+            cursor.close() 
+
+        self.session.commit() 
+
+    def replace_rows(self, tablename, dataframe, deletes):
+        """Delete rows of a table, then write dataframe in their place, in a
+        single transaction. Used to rebuild part of a derived table, e.g. the
+        connections of the stops which moved. 
 
-        # Split primary keys according to which already exist in table.
-        # We bulk update the existing keys, and bulk insert the new ones.
-        primary_key = inspect(table).primary_key[0].name   
+        Args:
+            tablename (str): Name of database table, e.g. 'connections'.
+            dataframe (dataframe): Table of values to be inserted, see 
+                                   write_dataframe. May be empty.
+            deletes (List[tuple]): Pairs of named delete queries and their 
+                                   params. List params are expanded, e.g. 
+                                   into IN clauses.
+        """
 
-        known_keys = filter(
-                        lambda k: self._check_if_primary_key_in_table(tablename, k),
-                        df[primary_key].values 
-                        )
-        known_keys = list(known_keys) 
+        if self.session is None:
+            self.start_session() 
 
-        df_known_keys = df[df[primary_key].isin(known_keys)]  
-        df_unknown_keys = df[~df[primary_key].isin(known_keys)]  
-         
-        self.session.bulk_update_mappings(
-            table, df_known_keys.to_dict("records"))  
+        try:
+            for query_name, params in deletes:
+                statement = get_named_query(query_name).bindparams(*[
+                    sqlalchemy.bindparam(name, expanding=True) 
+                    for name, value in params.items() if isinstance(value, list)]) 
+                self.session.execute(statement, params) 
 
-        self.session.bulk_insert_mappings(
-            table, df_unknown_keys.to_dict("records")) 
+            self.write_dataframe(tablename, dataframe) 
+
+        except Exception as e:
+            self.session.rollback() 
+            raise e 
 
         self.session.commit() 
 
-    def update_dataframe_in_table(self, tablename, dataframe):
-        """Update dataframe in database.  
+    def insert_vehicle_locations_compact(self, dataframe):
+        """Insert vehicle locations in the compact layout (the 
+        vehicle_locations_compact fact table and its dimension tables), 
+        updating readings already stored for the same vehicle and minute. 
 
         Args:
-            tablename (str): Name of database table, e.g. 'routes'.
-            dataframe (dataframe): Table of values to be updated. 
+            dataframe (dataframe): Vehicle locations, in the format of the 
+                                   'vehicle_locations' table. 
         """
 
-        if dataframe is None:
+        if dataframe is None or dataframe.empty:
             return 
 
         if self.session is None:
             self.start_session() 
 
-        df = dataframe.replace([np.nan], [None])  # input validation 
-        table = self.db_tables[tablename]         # ORM table  
+        df = dataframe.drop_duplicates(subset="key", keep="last") 
+
+        # Map ids and tags to their integer keys, registering new ones. The
+        # keys found are only cached once the facts are committed, since new
+        # dimension rows are rolled back with them on failure. 
+        new_ids = {} 
+        try:
+            agency_by_vehicle = df.set_index("id")["agency_tag"].to_dict() 
+            vehicle_int = self._get_dimension_ids(
+                                "vehicle_dim", "id", df["id"], new_ids,
+                                extra_columns=lambda v: {"agency_tag": agency_by_vehicle[v]})
+            route_int = self._get_dimension_ids("route_dim", "tag", df["route_tag"], new_ids)
+            direction_int = self._get_dimension_ids("direction_dim", "tag", 
+                                                    df["direction_tag"], new_ids)
+
+            read_time = pd.to_datetime(df["read_time"]) 
+            df_compact = pd.DataFrame({
+                "vehicle_int": vehicle_int.values,
+                "read_time_bucket": read_time.values.astype("datetime64[m]").astype("int64"),
+                "route_int": route_int.values,
+                "direction_int": direction_int.values,
+                "predictable": df["predictable"].values,
+                "heading": df["heading"].values,
+                "speed_kmhr": df["speed_kmhr"].values,
+                "lat": df["lat"].values,
+                "lon": df["lon"].values,
+                "read_time": read_time.values 
+            })
+            df_compact = df_compact.drop_duplicates(
+                            subset=["vehicle_int", "read_time_bucket"], keep="last")
+
+            # Readings already stored for the same (vehicle, minute) are updated.
+            self.write_dataframe("vehicle_locations_compact", df_compact)  
+
+        except Exception as e:
+            self.session.rollback() 
+            raise e 
+
+        for tablename, ids in new_ids.items():
+            self.dimension_ids.setdefault(tablename, {}).update(ids) 
+
+    def bulk_load_dataframe(self, tablename, dataframe, batch_size=100000):
+        """Insert a large dataframe in database, updating existing primary keys.
+        Meant for backfills (e.g. re-importing archived days), where the ORM
+        bulk mappings are too slow. 
+
+        Each batch is written to a tab-separated buffer and loaded into a
+        temporary staging table with the dialect's native bulk loader: 
+        LOAD DATA LOCAL INFILE on MySQL, COPY on Postgres, and an executemany
+        on other dialects (e.g. SQLite). The staging table is then merged into
+        the table with a single upsert statement. All batches are written in 
+        a single transaction, rolled back on failure. 
+
+        On MySQL, the load runs on an engine of its own allowing local infile 
+        (see db_connection.create_engine), rather than on the session. 
+
+        Args:
+            tablename (str): Name of database table, e.g. 'vehicle_locations'.
+            dataframe (dataframe): Table of values to be inserted, with the 
+                                   columns of the table.  
+            batch_size (int, optional): Number of rows per staging load. 
+                                        Defaults to 100000. 
+        """
+
+        if dataframe is None or dataframe.empty:
+            return 
+
+        if self.session is None:
+            self.start_session() 
+
+        table = self.db_tables[tablename].__table__ 
+        columns = [column.name for column in table.columns] 
+        primary_keys = [column.name for column in table.primary_key.columns]  
+
+        # Rows sharing a key would make the merge fail on Postgres.
+        df = dataframe[columns].drop_duplicates(subset=primary_keys, keep="last") 
+
+        staging = "{}_staging".format(table.name) 
+        dialect = self.session.get_bind().dialect.name 
+
+        if dialect == "mysql":
+            if self.bulk_load_engine is None:
+                self.bulk_load_engine = db_connection.create_engine(local_infile=True) 
+            with self.bulk_load_engine.connect() as conn:
+                try:
+                    with conn.begin():
+                        self._load_batches(conn, table.name, staging, df, 
+                                           columns, primary_keys, batch_size) 
+                finally:
+                    # Temporary tables outlive a rollback, on the pooled connection.
+                    self._drop_staging_table(conn, dialect, staging) 
+            return 
+
+        try:
+            self._load_batches(self.session.connection(), table.name, staging, df, 
+                               columns, primary_keys, batch_size) 
+        except Exception as e:
+            self.session.rollback() 
+            with contextlib.suppress(sqlalchemy.exc.SQLAlchemyError):
+                self._drop_staging_table(self.session.connection(), dialect, staging) 
+                self.session.commit() 
+            raise e 
+
+        self.session.commit() 
+
+    def _load_batches(self, conn, tablename, staging, df, columns, primary_keys, batch_size):
+        """Helper function to bulk_load_dataframe. Load the batches of df in 
+        the staging table, and merge each into the table."""
+
+        dialect = conn.dialect.name 
+        values_by_column = self._get_column_values(df, columns) 
+        columns = self._quote_identifiers(conn, columns) 
+        primary_keys = self._quote_identifiers(conn, primary_keys) 
+        for start in range(0, len(df), batch_size):
+            batch = [values[start:start + batch_size] for values in values_by_column]
+
+            self._create_staging_table(conn, dialect, tablename, staging) 
+            self._load_into_staging_table(conn, dialect, staging, columns, batch) 
+            conn.execute(sqlalchemy.text(self._get_merge_statement(
+                dialect, tablename, columns, primary_keys, source=staging))) 
+            self._drop_staging_table(conn, dialect, staging) 
+
+    def refresh_tables(self, dataframes, scope_columns=None):
+        """Merge dataframes into their tables in a single transaction, so that
+        readers see either none or all of the changes. Each dataframe is bulk
+        loaded into a staging table, then merged into its table, updating 
+        existing primary keys. 
+
+        With a scope column (e.g. route_tag), a dataframe is taken as the 
+        complete new content of its table for the scope values it contains:
+        rows of those scopes missing from the dataframe are deleted. Rows of 
+        other scopes, e.g. routes which failed to download, are left as is.
+
+        Args:
+            dataframes (dict): Map of table names to dataframes, in the format
+                               of the table. Tables are merged in order.
+            scope_columns (dict, optional): Map of table names to the column 
+                                            scoping the deletion of rows missing
+                                            from their dataframe. Other tables 
+                                            are only merged. Defaults to no 
+                                            deletion.
+        """
+
+        if self.session is None:
+            self.start_session() 
+
+        conn = self.session.connection() 
+        dialect = conn.dialect.name 
+        scope_columns = scope_columns or {} 
+
+        try:
+            for tablename, dataframe in dataframes.items():
+                if dataframe is None or dataframe.empty:
+                    continue 
+
+                table = self.db_tables[tablename].__table__ 
+                columns = [column.name for column in table.columns 
+                           if column.name in dataframe.columns] 
+                primary_keys = [column.name for column in table.primary_key.columns]  
+                df = dataframe[columns].drop_duplicates(subset=primary_keys, keep="last") 
+
+                staging = "{}_staging".format(table.name) 
+                values_by_column = self._get_column_values(df, columns) 
+                quoted_columns = self._quote_identifiers(conn, columns) 
+                quoted_keys = self._quote_identifiers(conn, primary_keys) 
+
+                self._create_staging_table(conn, dialect, table.name, staging) 
+                self._load_into_staging_table(conn, dialect, staging, 
+                                              quoted_columns, values_by_column) 
+                conn.execute(sqlalchemy.text(self._get_merge_statement(
+                    dialect, table.name, quoted_columns, quoted_keys, source=staging))) 
+
+                scope_column = scope_columns.get(tablename) 
+                if scope_column is not None:
+                    self._delete_rows_missing_from_staging(
+                        conn, table.name, staging, quoted_keys, scope_column, 
+                        df[scope_column].dropna().unique().tolist()) 
+
+                self._drop_staging_table(conn, dialect, staging) 
+
+        except Exception as e:
+            self.session.rollback() 
+            raise e 
 
-        self.session.bulk_update_mappings(table, df.to_dict("records"))  
         self.session.commit() 
 
-    def query(self, query, chunksize=1000):
+    def _delete_rows_missing_from_staging(self, conn, tablename, staging, primary_keys,
+                                          scope_column, scope_values):
+        """Helper function to refresh_tables. Delete the rows of tablename in 
+        the given scopes whose primary key is not in the staging table. The 
+        staging table is referenced once, as MySQL can't reopen temporary 
+        tables within a statement."""
+
+        if not scope_values:
+            return 
+
+        key_match = " AND ".join("{0}.{2} = {1}.{2}".format(staging, tablename, key) 
+                                 for key in primary_keys) 
+        statement = sqlalchemy.text(
+            "DELETE FROM {0} WHERE {1} IN :scope_values "
+            "AND NOT EXISTS (SELECT 1 FROM {2} WHERE {3})".format(
+                tablename, scope_column, staging, key_match)
+        ).bindparams(sqlalchemy.bindparam("scope_values", expanding=True)) 
+
+        conn.execute(statement, {"scope_values": scope_values}) 
+
+    def _quote_identifiers(self, conn, names):
+        """Quote the column names which need it in raw SQL for the connection's
+        dialect, e.g. reserved words such as key on MySQL."""
+
+        preparer = conn.dialect.identifier_preparer 
+        return [preparer.quote(name) for name in names] 
+
+    def _get_column_values(self, df, columns, bool_as_int=True):
+        """Helper function to the bulk write paths. Convert 
+        columns of df to lists of the values read by the bulk loaders and 
+        drivers: ISO strings for datetimes, 0/1 (or bool) for booleans, and 
+        None for missing values. 
+
+        Args:
+            df (dataframe): Values to convert.
+            columns (List[str]): Columns of df to convert. 
+            bool_as_int (bool, optional): Convert booleans to 0/1, as read by
+                                          the text bulk loaders. Defaults to True.
+
+        Returns:
+            List[list]: Values of each column. 
+        """
+
+        values_by_column = [] 
+        for column in columns:
+            values = df[column]
+            is_missing = values.isna().to_numpy() 
+
+            if pd.api.types.is_datetime64_any_dtype(values):
+                converted = [v.replace("T", " ") for v in 
+                             np.datetime_as_string(values.to_numpy(), unit="us")]
+            elif pd.api.types.is_bool_dtype(values) and bool_as_int:
+                converted = values.fillna(False).astype(int).tolist() 
+            elif pd.api.types.is_bool_dtype(values):
+                converted = [bool(v) if v is not pd.NA else None for v in values] 
+            elif (values.dtype == object and 
+                    pd.api.types.infer_dtype(values, skipna=True) not in ("string", "empty")):
+                converted = [self._serialize_value_for_bulk_load(v, bool_as_int) 
+                             for v in values] 
+            else:
+                converted = values.tolist() 
+
+            if is_missing.any():
+                converted = [None if missing else v 
+                             for v, missing in zip(converted, is_missing)] 
+            values_by_column.append(converted) 
+
+        return values_by_column 
+
+    def _serialize_value_for_bulk_load(self, value, bool_as_int=True):
+        """Helper function to _get_column_values, for mixed object columns."""
+
+        if isinstance(value, (bool, np.bool_)):
+            return int(value) if bool_as_int else bool(value) 
+        if isinstance(value, datetime.datetime):
+            return value.strftime("%Y-%m-%d %H:%M:%S.%f") 
+        return value 
+
+    def _create_staging_table(self, conn, dialect, tablename, staging):
+        """Helper function to bulk_load_dataframe and refresh_tables. Create an empty temporary 
+        table with the columns of tablename."""
+
+        self._drop_staging_table(conn, dialect, staging) 
+
+        if dialect == "mysql":
+            statement = "CREATE TEMPORARY TABLE {0} LIKE {1}"
+        elif dialect == "postgresql":
+            statement = "CREATE TEMPORARY TABLE {0} (LIKE {1})"
+        else:
+            statement = "CREATE TEMPORARY TABLE {0} AS SELECT * FROM {1} WHERE 0"
+
+        conn.execute(sqlalchemy.text(statement.format(staging, tablename))) 
+
+    def _drop_staging_table(self, conn, dialect, staging):
+        """Helper function to bulk_load_dataframe and refresh_tables. Drop the staging table. On 
+        MySQL, only DROP TEMPORARY TABLE avoids an implicit commit."""
+
+        if dialect == "mysql":
+            statement = "DROP TEMPORARY TABLE IF EXISTS {}"
+        else:
+            statement = "DROP TABLE IF EXISTS {}"
+
+        conn.execute(sqlalchemy.text(statement.format(staging)))
+
+    def _load_into_staging_table(self, conn, dialect, staging, columns, values_by_column):
+        """Helper function to bulk_load_dataframe and refresh_tables. Load rows in the staging 
+        table with the dialect's native bulk loader, given the values of each
+        of its (quoted) columns."""
+
+        column_list = ", ".join(columns) 
+
+        if dialect == "mysql":
+            # LOAD DATA LOCAL reads from a file on the client side. 
+            with tempfile.NamedTemporaryFile("w", suffix=".tsv", delete=False) as f:
+                f.write(self._to_tsv(values_by_column))  
+            try:
+                conn.execute(sqlalchemy.text(
+                    "LOAD DATA LOCAL INFILE '{}' INTO TABLE {} "
+                    "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' "
+                    "LINES TERMINATED BY '\\n' ({})".format(
+                        f.name.replace("\\", "/"), staging, column_list)))
+            finally:
+                os.remove(f.name) 
+
+        elif dialect == "postgresql":
+            buffer = io.StringIO(self._to_tsv(values_by_column)) 
+            cursor = conn.connection.cursor() 
+            try:
+                cursor.copy_expert(
+                    "COPY {} ({}) FROM STDIN WITH (FORMAT text)".format(
+                        staging, column_list), buffer) 
+            finally:
+                cursor.close() 
+
+        else:
+            placeholders = ", ".join(["?" if conn.dialect.paramstyle == "qmark" 
+                                      else "%s"] * len(columns)) 
+            cursor = conn.connection.cursor() 
+            try:
+                cursor.executemany(
+                    "INSERT INTO {} ({}) VALUES ({})".format(
+                        staging, column_list, placeholders), 
+                    list(zip(*values_by_column))) 
+            finally:
+                cursor.close() 
+
+    def _to_tsv(self, columns):
+        """Helper function to _load_into_staging_table. Format the columns as 
+        the text read by LOAD DATA and COPY: tab-separated, with backslash-
+        escaped special characters and \\N for missing values."""
+
+        formatted_columns = [] 
+        for values in columns:
+            text = [None if v is None else str(v) for v in values] 
+
+            # Escaping is skipped for the (usual) columns which don't need it.
+            all_text = "".join(v for v in text if v is not None) 
+            if any(char in all_text for char in "\\\t\n\r"):
+                text = [None if v is None else self._escape_for_tsv(v) for v in text]
+
+            formatted_columns.append(["\\N" if v is None else v for v in text]) 
+
+        return "".join("\t".join(row) + "\n" for row in zip(*formatted_columns)) 
+
+    def _escape_for_tsv(self, value):
+        """Helper function to _to_tsv. Backslash-escape special characters."""
+
+        for char, escaped in (("\\", "\\\\"), ("\t", "\\t"), 
+                              ("\n", "\\n"), ("\r", "\\r")):
+            value = value.replace(char, escaped) 
+        return value 
+
+    def _get_merge_statement(self, dialect, tablename, columns, primary_keys, 
+                             source=None, paramstyle="format", increment=False):
+        """Get the SQL upserting rows in tablename, updating the rows whose 
+        primary key already exists. Rows are either all rows of a source 
+        table, or a row of bound parameters. 
+
+        Args:
+            dialect (str): Name of the SQL dialect, e.g. 'mysql'.
+            tablename (str): Name of the target table. 
+            columns (List[str]): Columns to write. 
+            primary_keys (List[str]): Primary key columns of tablename. 
+            source (str, optional): Name of a source table with the same 
+                                    columns. Defaults to a row of parameters.
+            paramstyle (str, optional): DBAPI paramstyle of the parameters, 
+                                        e.g. 'qmark'. Defaults to 'format'.
+            increment (bool, optional): Add the values to those of existing 
+                                        rows instead of replacing them. 
+                                        Defaults to False.
+
+        Returns:
+            str: SQL statement. 
+        """
+
+        column_list = ", ".join(columns) 
+        update_columns = [col for col in columns if col not in primary_keys] 
+
+        if source is not None:
+            # SQLite needs a WHERE clause to parse an upsert from a SELECT.
+            rows = "SELECT {0} FROM {1} WHERE 1 = 1".format(column_list, source) 
+        else:
+            placeholder = "?" if paramstyle == "qmark" else "%s" 
+            rows = "VALUES ({})".format(", ".join([placeholder] * len(columns)))
+
+        if dialect == "mysql":
+            if not update_columns:
+                return "INSERT IGNORE INTO {0} ({1}) {2}".format(tablename, column_list, rows)
+            return "INSERT INTO {0} ({1}) {2} ON DUPLICATE KEY UPDATE {3}".format(
+                tablename, column_list, rows, 
+                ", ".join(("{0} = {0} + VALUES({0})" if increment else "{0} = VALUES({0})")
+                          .format(col) for col in update_columns))
+
+        # Postgres and SQLite share the upsert syntax. 
+        if not update_columns:
+            return "INSERT INTO {0} ({1}) {2} ON CONFLICT ({3}) DO NOTHING".format(
+                tablename, column_list, rows, ", ".join(primary_keys))
+        return "INSERT INTO {0} ({1}) {2} ON CONFLICT ({3}) DO UPDATE SET {4}".format(
+            tablename, column_list, rows, ", ".join(primary_keys), 
+            ", ".join(("{0} = {1}.{0} + excluded.{0}" if increment else "{0} = excluded.{0}")
+                      .format(col, tablename) for col in update_columns))
+
+    def _get_dimension_ids(self, tablename, column, values, new_ids, extra_columns=None):
+        """Helper function to insert_vehicle_locations_compact. Map values of 
+        a dimension table column (e.g. vehicle ids) to their integer keys, 
+        inserting values not yet in the table. 
+
+        Keys are read from the cache of committed mappings, or else from the
+        table, within the session's transaction. Values inserted concurrently
+        by another writer (a unique key violation) are read back instead. 
+
+        Args:
+            tablename (str): Name of the dimension table, e.g. 'vehicle_dim'.
+            column (str): Name of the value column, e.g. 'id'. 
+            values (Series): Values to map. Missing values map to None.
+            new_ids (dict): Mappings not cached yet, by table name, to be 
+                            cached once the transaction is committed. Updated
+                            with the mappings read from the table.
+            extra_columns (callable, optional): Returns the other columns of a
+                                                new row, given its value. 
+
+        Returns:
+            Series: Integer keys, aligned with values. 
+        """
+        table = self.db_tables[tablename]
+        id_column = inspect(table).primary_key[0].name
+        cache = self.dimension_ids.get(tablename, {}) 
+        found = new_ids.setdefault(tablename, {}) 
+
+        values = values.astype(object).where(values.notna(), None)
+        missing = [v for v in values.dropna().unique() if v not in cache]
+
+        def look_up(missing):
+            for start in range(0, len(missing), 500):
+                batch = missing[start:start + 500] 
+                rows = self.session.query(
+                            getattr(table, column), getattr(table, id_column)
+                        ).filter(getattr(table, column).in_(batch)).all()
+                found.update(dict(rows)) 
+            return [v for v in missing if v not in found]
+
+        def insert(missing):
+            rows = [{column: v, **(extra_columns(v) if extra_columns else {})} 
+                    for v in missing]
+            with self.session.begin_nested():
+                self.session.bulk_insert_mappings(table, rows)
+
+        missing = look_up(missing) 
+        if missing:
+            try:
+                insert(missing) 
+            except sqlalchemy.exc.IntegrityError:
+                # Another writer registered some of the values first; the 
+                # savepoint is rolled back, and only the others are inserted.
+                missing = look_up(missing)
+                if missing:
+                    insert(missing) 
+            look_up(missing) 
+
+        # Built as a list so that keys stay integers next to missing values.
+        return pd.Series([cache.get(v, found.get(v)) if v is not None else None 
+                          for v in values], index=values.index, dtype=object) 
+
+    def add_vehicle_locations_quality(self, dataframe):
+        """Add the quality counts of a batch of vehicle locations to the 
+        counts of their hour in the vehicle_locations_quality table. A single
+        upsert increments the counts, so that collectors writing the same 
+        hour concurrently add up. 
+
+        Args:
+            dataframe (dataframe): Counts in the format of the table, one row
+                                   per hour, see data_quality.VehicleLocationsQuality.
+        """
+
+        self.write_dataframe("vehicle_locations_quality", dataframe, increment=True) 
+
+    def query(self, query, params=None, chunksize=10000, dtypes=None):
         """Fetch result of a SELECT query from database. Uses batch querying.
         Essentially a wrapper for pd.read_sql(). 
 
         Args:
-            query (str): SQL SELECT query to read. 
-            chunksize (int, optional): Size used for batch querying. Defaults to 1000.
+            query (str or TextClause): SQL SELECT query to read, e.g. a named 
+                                       query from utils.queries.  
+            params (dict, optional): Values for the query's bound parameters.
+            chunksize (int, optional): Size used for batch querying. Defaults to 10000.
+            dtypes (dict, optional): Column types to convert to, see iter_query.
 
         Returns:
             dataframe: Result of the SELECT query. 
         """
 
+        df = pd.concat(self.iter_query(query, params=params, chunksize=chunksize,
+                                       dtypes=dtypes))
+
+        # Categories may differ between chunks, in which case concatenation 
+        # falls back to object columns. We convert these once more. 
+        if dtypes:
+            df = self._apply_dtypes(df, dtypes) 
+
+        return df 
+
+    def iter_query(self, query, params=None, chunksize=10000, dtypes=None,
+                   as_records=False):
+        """Stream the result of a SELECT query from database, chunk by chunk.
+        Only one chunk is held in memory at a time, so large tables (e.g. 
+        vehicle_locations) can be processed in constant memory. 
+
+        The connection stays open until the generator is exhausted or closed.
+
+        Args:
+            query (str or TextClause): SQL SELECT query to read. 
+            params (dict, optional): Values for the query's bound parameters.
+            chunksize (int, optional): Number of rows per chunk. Defaults to 10000.
+            dtypes (dict, optional): Map of column names to types applied to 
+                                     each chunk, e.g. VEHICLE_LOCATIONS_DTYPES. 
+                                     Columns absent from the result are ignored.
+            as_records (bool, optional): Yield NumPy record arrays instead of 
+                                         dataframes. Defaults to False. 
+
+        Yields:
+            dataframe (or np.recarray): Chunk of the result of the SELECT query.
+        """
+
         with self.connect().execution_options(stream_results=True) as conn:
-            df_list = [] 
-            for chunk_dataframe in pd.read_sql(query, conn, chunksize=chunksize): 
-                df_list.append(chunk_dataframe) 
+            chunks = pd.read_sql(query, conn, params=params, chunksize=chunksize)
+            for chunk_dataframe in chunks: 
 
-        return pd.concat(df_list)
+                if dtypes:
+                    chunk_dataframe = self._apply_dtypes(chunk_dataframe, dtypes)
+
+                if as_records:
+                    yield chunk_dataframe.to_records(index=False) 
+                else:
+                    yield chunk_dataframe 
+
+    def _apply_dtypes(self, df, dtypes):
+        """Helper function to iter_query. Convert the columns of df present in
+        the dtypes map to their given type."""
+
+        dtypes = {col: dtype for col, dtype in dtypes.items() if col in df.columns}
+        return df.astype(dtypes) if dtypes else df 
 
     def get_agency_tag(self):
         """Get the agency tag from database (e.g. 'ttc'). This is mainly used
@@ -148,7 +778,7 @@ class DatabaseWrapper:
             str: Agency tag.
         """
 
-        df = self.query("SELECT tag FROM agencies")  
+        df = self.query(get_named_query("agency_tag"))  
         return df.tag.values[0] 
 
     def get_route_list(self, agency_tag):
@@ -160,8 +790,8 @@ class DatabaseWrapper:
             List[str]: List containing all route tags. 
         """
 
-        df = self.query(
-            f"SELECT DISTINCT tag FROM routes where agency_tag='{agency_tag}'")
+        df = self.query(get_named_query("route_list"),
+                        params={"agency_tag": agency_tag})
         route_list = list(df.tag.unique()) 
 
         # Tags are str by default, but may actually be integers depending on agency.
@@ -181,8 +811,8 @@ class DatabaseWrapper:
             List[str]: List of all direction tags.  
         """
 
-        df = self.query(
-            f"SELECT DISTINCT tag FROM directions WHERE agency_tag='{agency_tag}'") 
+        df = self.query(get_named_query("direction_list"),
+                        params={"agency_tag": agency_tag}) 
         direction_list = list(df.tag.unique()) 
 
         return direction_list 
@@ -195,14 +825,8 @@ class DatabaseWrapper:
             dataframe: Stops dataframe with tag, lat, lon columns. 
         """
 
-        df = self.query(
-            f""" 
-             SELECT DISTINCT tag, lat, lon
-             FROM stops
-             WHERE agency_tag='{agency_tag}'
-             ORDER BY 2,3
-            """
-            )
+        df = self.query(get_named_query("stop_coords"),
+                        params={"agency_tag": agency_tag})
 
         return df 
 
@@ -213,27 +837,21 @@ class DatabaseWrapper:
             dataframe: Stops dataframe with stop_tag, direction_tag,
                        and stop_along_direction column. 
         """
-        request = f""" 
-                    SELECT routes.title as route,
-                           routes.tag as route_tag,
-                           directions.title as direction,
-                           directions.tag as direction_tag,
-                           directions.name as heading,
-                           stops.title as stop,
-                           stops.tag as stop_tag,
-                           stops.lat as stop_lat,
-                           stops.lon as stop_long,
-                           stops.stop_along_direction as stop_number
-               
-                      FROM routes
-                      INNER JOIN directions ON directions.route_tag = routes.tag
-                      INNER JOIN stops      ON stops.direction_tag = directions.tag
-            
-                     WHERE routes.agency_tag='{agency_tag}'
-                       AND directions.tag='{direction_tag}'
-                     ORDER BY stop_number
-                   """
-        return self.query(request)  
+        return self.query(get_named_query("stops_along_direction"),
+                          params={"agency_tag": agency_tag,
+                                  "direction_tag": direction_tag})  
+
+    def get_route_stop_tags_dataframe(self, agency_tag):
+        """Get all distinct (route_tag, stop_tag) pairs from the stops table. 
+
+        Returns:
+            dataframe: Dataframe with route_tag, stop_tag columns. 
+        """
+
+        df = self.query(get_named_query("route_stop_tags"),
+                        params={"agency_tag": agency_tag})
+
+        return df 
 
     def get_connections_dataframe(self):
         """Fetch the entire connections table.
@@ -241,13 +859,192 @@ class DatabaseWrapper:
         Returns:
             dataframe: The connections table as a dataframe.   
         """
-        return self.query("SELECT * FROM connections") 
+        return self.query(get_named_query("connections")) 
+
+    def get_routes_dataframe(self):
+        """Fetch the entire routes table.
+
+        Returns:
+            dataframe: The routes table as a dataframe.   
+        """
+        return self.query(get_named_query("routes")) 
+
+    def get_directions_dataframe(self):
+        """Fetch the entire directions table.
+
+        Returns:
+            dataframe: The directions table as a dataframe.   
+        """
+        return self.query(get_named_query("directions")) 
+
+    def get_stops_dataframe(self):
+        """Fetch the entire stops table.
+
+        Returns:
+            dataframe: The stops table as a dataframe.   
+        """
+        return self.query(get_named_query("stops")) 
+
+    def get_route_paths_dataframe(self):
+        """Fetch the path points of all directions, in order along each 
+        direction.
+
+        Returns:
+            dataframe: Dataframe with direction_tag, path_id, 
+                       path_along_direction, point_along_path, lat, lon columns. 
+        """
+        return self.query(get_named_query("route_paths")) 
+
+    def get_pending_transit_config_changes(self, target):
+        """Fetch the transit config changes not yet applied to a derived table.
+
+        Args:
+            target (str): Either 'connections' or 'graph'. 
+
+        Returns:
+            dataframe: Dataframe in the format of the transit_config_changes 
+                       table. 
+        """
+        return self.query(get_named_query("pending_transit_config_changes_{}".format(target)),
+                          params={"false": False}) 
+
+    def mark_transit_config_changes_applied(self, target, until):
+        """Mark the transit config changes detected up to a given time as 
+        applied to a derived table. 
+
+        Args:
+            target (str): Either 'connections' or 'graph'. 
+            until (datetime): Latest detection time marked. 
+        """
+
+        if self.session is None:
+            self.start_session() 
+
+        self.session.execute(get_named_query("mark_transit_config_changes_{}".format(target)),
+                             {"true": True, "false": False, "until": until}) 
+        self.session.commit() 
+
+    def get_segment_time_distributions_dataframe(self, hours_of_week=None):
+        """Fetch travel time sketches from the segment_time_distributions table.
+
+        Args:
+            hours_of_week (List[int], optional): Hours of the week to fetch.
+                                                 Defaults to all.
+
+        Returns:
+            dataframe: Dataframe with edge_key, hour_of_week, num_samples, 
+                       sketch columns. 
+        """
+
+        if hours_of_week is None:
+            return self.query(get_named_query("segment_time_distributions"))
+
+        stmt = get_named_query("segment_time_distributions_by_hour").bindparams(
+                    sqlalchemy.bindparam("hours_of_week", expanding=True)) 
+        return self.query(stmt, params={
+                    "hours_of_week": [int(h) for h in hours_of_week]}) 
+
+    def get_anomalies_dataframe(self, since):
+        """Fetch the anomalies detected since a given time. 
+
+        Args:
+            since (datetime): Earliest detection time fetched.
+
+        Returns:
+            dataframe: Dataframe in the format of the anomalies table, 
+                       sorted by detected_at. 
+        """
+        return self.query(get_named_query("anomalies_since"), 
+                          params={"since": since}) 
+
+    def get_vehicle_locations_since(self, since, source="vehicle_locations"):
+        """Fetch the vehicle readings taken since a given time, e.g. the 
+        last few collection cycles. 
+
+        Args:
+            since (datetime): Earliest read time fetched.
+            source (str, optional): Table read, either 'vehicle_locations' or 
+                                    'vehicle_locations_compact'. 
+                                    Defaults to 'vehicle_locations'.
+
+        Returns:
+            dataframe: Readings with id, direction_tag, lat, lon, read_time 
+                       columns, sorted by id and read_time. 
+        """
+        return self.query(get_named_query("{}_since".format(source)), 
+                          params={"since": since}) 
+
+    def get_vehicle_location_keys_since(self, since, source="vehicle_locations"):
+        """Fetch the keys of the vehicle readings taken since a given time, 
+        e.g. to seed a filter of recently written keys. 
+
+        Args:
+            since (datetime): Earliest read time fetched.
+            source (str, optional): Table read, either 'vehicle_locations' or 
+                                    'vehicle_locations_compact', whose keys 
+                                    are rebuilt from the vehicle id and 
+                                    minute bucket. Defaults to 'vehicle_locations'.
+
+        Returns:
+            Series: Keys of the readings, in the format of the vehicle_locations
+                    table's key. 
+        """
+        df = self.query(get_named_query("{}_keys_since".format(source)), 
+                        params={"since": since}) 
+        if source == "vehicle_locations":
+            return df["key"] 
+
+        minute = pd.to_datetime(df["read_time_bucket"].astype("int64"), unit="m") 
+        return df["id"].astype(str) + "_" + minute.dt.strftime("%Y-%m-%d %H:%M") 
+
+    def get_vehicle_locations_quality_dataframe(self, since):
+        """Fetch the hourly data quality counts of vehicle locations since a 
+        given time, see add_vehicle_locations_quality. 
+
+        Args:
+            since (datetime): Earliest hour fetched.
+
+        Returns:
+            dataframe: Dataframe in the format of the vehicle_locations_quality 
+                       table, sorted by hour. 
+        """
+        return self.query(get_named_query("vehicle_locations_quality_since"), 
+                          params={"since": since}) 
+
+    def get_service_classes(self):
+        """Get the list of distinct service classes in the schedules table,
+        e.g. ['sat', 'sun', 'wkd'].
+        """
+        df = self.query(get_named_query("service_classes"))
+        return sorted(df.service_class.dropna().unique()) 
+
+    def get_schedules_dataframe(self, service_class):
+        """Fetch the schedules of a service class, in timetable order. 
+
+        Args:
+            service_class (str): Service class, e.g. 'wkd'. 
+
+        Returns:
+            dataframe: Schedules with schedule_class, service_class, route_tag,
+                       direction_name, block_id, stop_tag, epoch_time, key 
+                       columns. 
+        """
+        return self.query(get_named_query("schedules_by_service_class"),
+                          params={"service_class": service_class}) 
+
+    def get_transit_graph_dataframe(self):
+        """Fetch the entire transit_graph table.
+
+        Returns:
+            dataframe: The transit_graph table as a dataframe.   
+        """
+        return self.query(get_named_query("transit_graph")) 
 
     def get_known_vehicle_ids(self, agency_tag):
         """Fetch list of all known vehicle ids for the agency."""
 
-        df_vehicles = self.query(
-            f"SELECT DISTINCT id FROM vehicles WHERE agency_tag='{agency_tag}'")
+        df_vehicles = self.query(get_named_query("known_vehicle_ids"),
+                                 params={"agency_tag": agency_tag})
         return list(df_vehicles.id.unique()) 
 
     def get_active_vehicle_ids(self, agency_tag, num_days=7): 
@@ -256,16 +1053,59 @@ class DatabaseWrapper:
         """
         prior_days = num_days - 1
 
-        df_vehicles = self.query(
-            f"""SELECT DISTINCT id   
-                  FROM vehicles 
-                 WHERE agency_tag='{agency_tag}'
-                 AND last_seen_active >= SUBDATE(CURRENT_DATE(), INTERVAL {prior_days} DAY)
-            """)  
+        df_vehicles = self.query(get_named_query("active_vehicle_ids"),
+                                 params={"agency_tag": agency_tag,
+                                         "prior_days": prior_days})  
         return df_vehicles.id.to_list() 
 
     def get_validation_vehicle_ids(self, agency_tag):
         """Fetch all vehicle ids from the vehicles_validation table."""
 
-        df_vehicles = self.query("SELECT DISTINCT id FROM vehicles_validation")
-        return df_vehicles.id.to_list() 
\ No newline at end of file
+        df_vehicles = self.query(get_named_query("validation_vehicle_ids"))
+        return df_vehicles.id.to_list() 
+
+    def delete_vehicle_locations_before(self, first_date_kept, source="vehicle_locations"):
+        """Delete all vehicle location entries read before first_date_kept. 
+
+        Args:
+            first_date_kept (str): Date formatted as 'YYYY-MM-DD'. 
+            source (str, optional): Table deleted from, either 'vehicle_locations'
+                                    or 'vehicle_locations_compact'. 
+                                    Defaults to 'vehicle_locations'.
+        """
+
+        if self.session is None:
+            self.start_session() 
+
+        query_name = "delete_old_vehicle_locations" if source == "vehicle_locations" \
+                     else "delete_old_{}".format(source)
+        self.session.execute(get_named_query(query_name),
+                             {"first_date_kept": first_date_kept})
+        self.session.commit()
+
+    def refresh_vehicle_locations_hourly(self, hours, source="vehicle_locations"):
+        """Recompute the vehicle_locations_hourly rollup for the given hours.
+        Each hour is aggregated from a range scan of the source table on 
+        read_time, and replaces the hour's previous rollup rows. 
+
+        Args:
+            hours (iterable): Datetimes of the hours to refresh, e.g. the 
+                              hours touched by a collection cycle. Each is
+                              truncated to the start of its hour. 
+            source (str, optional): Table aggregated, either 'vehicle_locations'
+                                    or 'vehicle_locations_compact'. 
+                                    Defaults to 'vehicle_locations'.
+        """
+
+        if self.session is None:
+            self.start_session() 
+
+        rollup_query = get_named_query("{}_hourly_rollup".format(source)) 
+        for hour in sorted({pd.Timestamp(h).floor("H") for h in hours}):
+            params = {"hour": hour.to_pydatetime(), 
+                      "next_hour": (hour + pd.Timedelta(hours=1)).to_pydatetime()}
+
+            self.session.execute(get_named_query("delete_vehicle_locations_hourly"), params)
+            self.session.execute(rollup_query, params) 
+
+        self.session.commit() 
@@ -6,15 +6,41 @@ from sqlalchemy.orm import sessionmaker
 from utils.configs import get_db_config
 
 
-def create_engine():
+def create_engine(local_infile=False):
     """Wrapper for the sqlalchemy.create_engine function, instantiated
     with the database config.  
 
+    Args:
+        local_infile (bool, optional): Allow LOAD DATA LOCAL INFILE on MySQL, 
+                                       which lets the server read any local 
+                                       file of the client. Only for the engine
+                                       of DatabaseWrapper.bulk_load_dataframe.
+                                       Defaults to False.
+
     Returns:
         engine: sqlalchemy Engine object.  
     """
+    db_config = get_db_config() 
     arg = "{db_type}+{con}://{usr}:{pw}@{host}/{db}"
-    return sqlalchemy.create_engine(arg.format(**get_db_config())) 
+    connect_args = get_local_infile_connect_args(db_config) if local_infile else {}
+    return sqlalchemy.create_engine(arg.format(**db_config), connect_args=connect_args) 
+
+def get_local_infile_connect_args(db_config):
+    """Get the driver arguments allowing LOAD DATA LOCAL INFILE on MySQL, 
+    used by DatabaseWrapper.bulk_load_dataframe. 
+
+    Args:
+        db_config (dict): Database config, see utils.configs.get_db_config.
+
+    Returns:
+        dict: Keyword arguments for the DBAPI connect function. 
+    """
+    if db_config["db_type"] != "mysql":
+        return {} 
+
+    if db_config["con"] == "mysqlconnector":
+        return {"allow_local_infile": True}
+    return {"local_infile": True}  # pymysql, mysqldb 
 
 def create_session(): 
     """Create a sqlalchemy.orm session to talk to the database. 
@@ -1,42 +1,139 @@
-"""  
+"""
 Context manager for an AWS EC2 database remote connection.
-""" 
+
+A single SSH tunnel and connection pool are kept alive per process by the
+TunnelManager, so that successive Connection blocks (e.g. notebook queries)
+don't pay for an SSH handshake and a new database connection each time.
+"""
+import atexit
+import threading
+import time
 import sqlalchemy
 from sshtunnel import SSHTunnelForwarder
 from utils.configs import get_db_config, get_ssh_tunnel_config
 
 
-class Connection: 
+class TunnelManager:
     """
-    Context manager for an AWS EC2 database remote connection.
+    Keeps one SSH tunnel to the EC2 instance alive, along with a pooled
+    sqlalchemy engine connecting through it.
 
-    Usage: 
-        with Connection() as conn:
-            df = pd.read_sql(query, conn)
+    The tunnel is opened lazily on first use, health-checked at most every
+    health_check_interval seconds, and reopened (with a fresh engine) when
+    it is found down. Pooled connections are pinged before use, so stale
+    connections are replaced transparently. Everything is closed at exit.
+
+    Usage:
+        engine = get_tunnel_manager().get_engine()
     """
 
-    def __init__(self): 
-        self.tunnel = SSHTunnelForwarder(**get_ssh_tunnel_config())
+    def __init__(self, pool_size=5, max_overflow=5, health_check_interval=30):
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.health_check_interval = health_check_interval   # seconds
+        self.tunnel = None
+        self.engine = None
+        self._last_health_check = None
+        self._lock = threading.Lock()
+
+    def get_engine(self):
+        """Get the engine connecting through the tunnel, (re)opening the
+        tunnel if it is not up.
+
+        Returns:
+            engine: sqlalchemy Engine object.
+        """
+        with self._lock:
+            if not self._is_healthy():
+                self._reconnect()
+            return self.engine
+
+    def close(self):
+        """Dispose of the connection pool and close the tunnel."""
+
+        if self.engine is not None:
+            self.engine.dispose()
+            self.engine = None
+
+        if self.tunnel is not None:
+            self.tunnel.stop()
+            self.tunnel = None
+
+    def _is_healthy(self):
+        """Check that the tunnel is up. Checks are throttled by the
+        health_check_interval, since they cost a local connection attempt."""
+
+        if self.tunnel is None or self.engine is None or not self.tunnel.is_active:
+            return False
+
+        now = time.monotonic()
+        if (self._last_health_check is not None
+                and now - self._last_health_check < self.health_check_interval):
+            return True
 
-    def __enter__(self):
-        self.tunnel.__enter__()
-        self.conn = None
+        try:
+            self.tunnel.check_tunnels()
+            is_up = all(self.tunnel.tunnel_is_up.values())
+        except Exception:
+            is_up = False
+
+        self._last_health_check = now
+        return is_up
+
+    def _reconnect(self):
+        """Open a new tunnel and an engine pooling connections through it."""
+
+        self.close()
+
+        self.tunnel = SSHTunnelForwarder(**get_ssh_tunnel_config())
+        self.tunnel.start()
         try:
             db_config = get_db_config()
             db_config["port"] = str(self.tunnel.local_bind_port)
 
-            self.conn = sqlalchemy.create_engine(
+            self.engine = sqlalchemy.create_engine(
                 "{db_type}+{con}://{usr}:{pw}@{host}:{port}/{db}".format(
-                **db_config)
-                ).connect()
-            return self.conn
+                **db_config),
+                pool_size=self.pool_size,
+                max_overflow=self.max_overflow,
+                pool_pre_ping=True
+                )
 
         except Exception as e:
-            self.tunnel.__exit__(None, None, None)
+            self.close()
             raise e
 
+        self._last_health_check = time.monotonic()
+
+
+_tunnel_manager = TunnelManager()
+atexit.register(_tunnel_manager.close)
+
+
+def get_tunnel_manager():
+    """Get the process-wide TunnelManager instance."""
+    return _tunnel_manager
+
+
+class Connection:
+    """
+    Context manager for an AWS EC2 database remote connection.
+
+    Connections are taken from the pool of the process-wide TunnelManager,
+    and returned to it on exit; the tunnel itself stays open.
+
+    Usage:
+        with Connection() as conn:
+            df = pd.read_sql(query, conn)
+    """
+
+    def __init__(self, tunnel_manager=None):
+        self.tunnel_manager = tunnel_manager or get_tunnel_manager()
+        self.conn = None
+
+    def __enter__(self):
+        self.conn = self.tunnel_manager.get_engine().connect()
+        return self.conn
+
     def __exit__(self, exc_type, exc_value, traceback):
-        try:
-            self.conn.__exit__(exc_type, exc_value, traceback)
-        finally:
-            self.tunnel.__exit__(exc_type, exc_value, traceback) 
+        self.conn.close()  # returns the connection to the pool
@@ -1,11 +1,17 @@
 """
 Database table information for the sqlalchemy ORM.
 """
-from sqlalchemy import Column
-from sqlalchemy.types import Integer, Float, String, DateTime, Boolean
+from sqlalchemy import Column, ForeignKey
+from sqlalchemy.types import Integer, BigInteger, SmallInteger, Float, String, DateTime, Boolean, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
 
+# Small surrogate keys. SQLite only autoincrements INTEGER primary keys.
+SmallIntegerKey = SmallInteger().with_variant(Integer(), "sqlite")
+
+# Single precision (4 bytes) floats. Float(32) maps to an 8 byte DOUBLE in MySQL.
+Float32 = Float(precision=24)
+
 
 # --------------------------- TABLES ---------------------------------------
 class Agencies(Base):
@@ -52,6 +58,22 @@ class Stops(Base):
     agency_tag = Column(String(255)) 
 
 
+class RoutePaths(Base):
+    """Points of the street geometry paths of each direction, as listed in
+    routeConfig responses. See route_geometry.RouteGeometry."""
+    __tablename__ = 'route_paths'
+
+    key = Column(String(255), primary_key=True, autoincrement=False)  # path_id + point number
+    path_id = Column(String(255))
+    direction_tag = Column(String(255), index=True) 
+    path_along_direction = Column(Integer)      # order of the path on the direction
+    point_along_path = Column(Integer)          # starts at 1
+    lat = Column(Float(32))
+    lon = Column(Float(32))
+    route_tag = Column(String(255)) 
+    agency_tag = Column(String(255)) 
+
+
 class Schedules(Base):
     __tablename__ = 'schedules'
 
@@ -87,10 +109,126 @@ class VehicleLocations(Base):
     lat = Column(Float(32)) 
     lon = Column(Float(32))
     id = Column(String(255))
+    direction_tag = Column(String(255), index=True)
+    agency_tag = Column(String(255))
+    read_time = Column(DateTime, index=True)
+    key = Column(String(255), primary_key=True) 
+
+
+class VehicleLocationsHourly(Base):
+    """Hourly rollup of vehicle_locations, for monitoring queries. Distinct 
+    vehicles don't add up across directions or routes, so the distinct counts
+    of the route and of the whole hour are repeated on each row."""
+    __tablename__ = 'vehicle_locations_hourly'
+
+    hour = Column(DateTime, primary_key=True)
+    route_tag = Column(String(255), primary_key=True)
+    direction_tag = Column(String(255), primary_key=True)  # '' when unknown
+    reads_taken = Column(Integer)
+    vehicles_seen = Column(Integer)          # distinct over the route direction
+    route_vehicles_seen = Column(Integer)    # distinct over the route
+    hour_vehicles_seen = Column(Integer)     # distinct over all routes
+    first_read_time = Column(DateTime)
+    last_read_time = Column(DateTime)
+
+
+class OffRouteReadings(Base):
+    """Vehicle readings further from their reported direction than the 
+    ingestion tolerance. See route_index.RouteIndex."""
+    __tablename__ = 'off_route_readings'
+
+    key = Column(String(255), primary_key=True)     # as in vehicle_locations
+    id = Column(String(255))
+    route_tag = Column(String(255))
+    direction_tag = Column(String(255))
+    lat = Column(Float(32))
+    lon = Column(Float(32))
+    read_time = Column(DateTime, index=True)
+
+
+class VehicleLocationsQuality(Base):
+    """Hourly data quality counts of the vehicle location batches collected,
+    accumulated at collection. See data_quality.VehicleLocationsQuality."""
+    __tablename__ = 'vehicle_locations_quality'
+
+    hour = Column(DateTime, primary_key=True)   # hour of collection
+    batches = Column(Integer)
+    readings = Column(Integer)
+    route_tag_null = Column(Integer)
+    direction_tag_null = Column(Integer)
+    predictable_null = Column(Integer)
+    heading_null = Column(Integer)
+    speed_kmhr_null = Column(Integer)
+    lat_null = Column(Integer)
+    lon_null = Column(Integer)
+    id_null = Column(Integer)
+    read_time_null = Column(Integer)
+    stale_readings = Column(Integer)
+    out_of_bbox = Column(Integer)
+    duplicate_keys = Column(Integer)
+
+
+class Predictions(Base):
+    __tablename__ = 'predictions'
+
+    route_tag = Column(String(255))
+    stop_tag = Column(String(255))
     direction_tag = Column(String(255))
+    vehicle_id = Column(String(255))
+    block_id = Column(String(255))
+    trip_tag = Column(String(255))
+    is_departure = Column(Boolean)
+    affected_by_layover = Column(Boolean)
+    seconds = Column(Integer)
+    epoch_time = Column(BigInteger)
+    predicted_time = Column(DateTime)
     agency_tag = Column(String(255))
     read_time = Column(DateTime)
-    key = Column(String(255), primary_key=True) 
+    key = Column(String(255), primary_key=True)
+
+
+# ----------------- COMPACT VEHICLE LOCATIONS LAYOUT -----------------------
+# Vehicle locations stored with integer surrogate keys: tags and ids live 
+# once in dimension tables, and the fact table holds small integer columns. 
+# The fact primary key is (vehicle, minute of reading), which matches the 
+# deduplication of the vehicle_locations key (vehicle id + read_time to the 
+# minute). See VEHICLE_LOCATIONS_COMPACT_VIEW for the original column layout.
+class VehicleDimension(Base):
+    __tablename__ = 'vehicle_dim'
+
+    vehicle_int = Column(Integer, primary_key=True, autoincrement=True)
+    id = Column(String(255), unique=True)
+    agency_tag = Column(String(255)) 
+
+
+class RouteDimension(Base):
+    __tablename__ = 'route_dim'
+
+    route_int = Column(SmallIntegerKey, primary_key=True, autoincrement=True)
+    tag = Column(String(255), unique=True) 
+
+
+class DirectionDimension(Base):
+    __tablename__ = 'direction_dim'
+
+    direction_int = Column(SmallIntegerKey, primary_key=True, autoincrement=True)
+    tag = Column(String(255), unique=True)
+
+
+class VehicleLocationsCompact(Base):
+    __tablename__ = 'vehicle_locations_compact'
+
+    vehicle_int = Column(Integer, ForeignKey('vehicle_dim.vehicle_int'), 
+                         primary_key=True, autoincrement=False)
+    read_time_bucket = Column(Integer, primary_key=True, autoincrement=False)  # minutes since epoch
+    route_int = Column(SmallIntegerKey, ForeignKey('route_dim.route_int'))
+    direction_int = Column(SmallIntegerKey, ForeignKey('direction_dim.direction_int'))
+    predictable = Column(Boolean)
+    heading = Column(SmallInteger)
+    speed_kmhr = Column(SmallInteger)
+    lat = Column(Float32)
+    lon = Column(Float32)
+    read_time = Column(DateTime, index=True)
 
 
 class VehiclesValidation(Base):
@@ -142,4 +280,73 @@ class TransitGraph(Base):
     is_connection = Column(Boolean) 
 
 
+class SegmentTimeDistributions(Base):
+    """Travel time sketches on transit_graph edges, by hour of the week.
+    See transit_statistics.SegmentTimeHistogram for the sketch format."""
+    __tablename__ = 'segment_time_distributions'
+
+    edge_key = Column(String(255), primary_key=True) 
+    hour_of_week = Column(SmallInteger, primary_key=True, autoincrement=False)  # 0 is Monday 00:00
+    num_samples = Column(Integer) 
+    sketch = Column(LargeBinary) 
+    updated_at = Column(DateTime) 
+
+
+class Anomalies(Base):
+    """Slowdowns detected on transit_graph edges, with the live and historical
+    travel times compared. See anomalies.AnomalyDetector."""
+    __tablename__ = 'anomalies'
+
+    edge_key = Column(String(255), primary_key=True) 
+    detected_at = Column(DateTime, primary_key=True, index=True) 
+    hour_of_week = Column(SmallInteger)     # 0 is Monday 00:00
+    live_seconds = Column(Float)            # median over the detection window
+    expected_seconds = Column(Float)        # historical median 
+    threshold_seconds = Column(Float)       # historical threshold quantile
+    z_score = Column(Float) 
+    num_samples = Column(Integer)           # live traversals in the window
+
+
+class TransitConfigChanges(Base):
+    """Rows added, removed or changed in the directions and stops tables by a
+    transit config refresh, and whether the connections and transit_graph 
+    tables were rebuilt for them yet. See config_diff.TransitConfigDiff."""
+    __tablename__ = 'transit_config_changes'
+
+    detected_at = Column(DateTime, primary_key=True) 
+    table_name = Column(String(255), primary_key=True)      # 'directions' or 'stops'
+    key = Column(String(255), primary_key=True)             # primary key of the row
+    route_tag = Column(String(255)) 
+    direction_tag = Column(String(255)) 
+    stop_tag = Column(String(255)) 
+    change = Column(String(255))                            # 'added', 'removed' or 'changed'
+    changed_columns = Column(String(255))                   # comma separated, on changes
+    connections_applied = Column(Boolean, index=True) 
+    graph_applied = Column(Boolean, index=True) 
+
+
+# --------------------------- VIEWS ----------------------------------------
+# Compatibility view exposing the compact layout with the columns of the
+# vehicle_locations table, so existing queries can run against it. 
+VEHICLE_LOCATIONS_COMPACT_VIEW = """
+CREATE OR REPLACE VIEW vehicle_locations_compact_view AS
+SELECT routes.tag                   AS route_tag,
+       loc.predictable              AS predictable,
+       loc.heading                  AS heading,
+       loc.speed_kmhr               AS speed_kmhr,
+       loc.lat                      AS lat,
+       loc.lon                      AS lon,
+       vehicles.id                  AS id,
+       directions.tag               AS direction_tag,
+       vehicles.agency_tag          AS agency_tag,
+       loc.read_time                AS read_time,
+       CONCAT(vehicles.id, '_', DATE_FORMAT(loc.read_time, '%Y-%m-%d %H:%i')) AS `key`
+  FROM vehicle_locations_compact loc
+  INNER JOIN vehicle_dim vehicles ON vehicles.vehicle_int = loc.vehicle_int
+  LEFT JOIN route_dim routes ON routes.route_int = loc.route_int
+  LEFT JOIN direction_dim directions ON directions.direction_int = loc.direction_int
+"""
 
+VIEWS = {
+    "vehicle_locations_compact_view": VEHICLE_LOCATIONS_COMPACT_VIEW,
+}
@@ -0,0 +1,264 @@
+"""
+Map matching of vehicle readings onto the geometry of their direction.
+
+Each reading is projected onto the nearest segment of its direction's
+simplified polyline (see route_geometry), giving its distance along the
+direction. Candidate segments come from a grid bucket index: every segment is
+registered in the grid cells within max_distance_meters of it, keyed by
+direction, so a reading is only compared to the few segments of its own
+direction listed in its cell. The whole batch is matched at once with NumPy.
+
+With readings and stops located along the direction, the time of visit of a
+trip at each stop is a 1-D interpolation of read times over distances.
+"""
+import numpy as np
+import pandas as pd
+from route_geometry import project_to_meters
+
+
+class MapMatcher:
+    """
+    Projection of readings onto direction polylines, with a grid segment index.
+
+    Usage:
+        matcher = MapMatcher(RouteGeometry.load(path))
+        df = matcher.match_dataframe(df_locations)   # adds distance_along_meters
+        times_df = matcher.get_times_at_stops_df(trips_df, stops_df)
+    """
+
+    chunk_size = 500000     # readings matched at a time, bounds the candidate pairs
+    cell_bits = 20          # bits per cell coordinate in the index keys
+
+    def __init__(self, geometry, cell_size_meters=200, max_distance_meters=100):
+        """
+        Args:
+            geometry (RouteGeometry): Polylines of the directions.
+            cell_size_meters (float, optional): Side of the grid cells.
+                                                Defaults to 200 meters.
+            max_distance_meters (float, optional): Readings further from their
+                                                   direction are not matched.
+                                                   Defaults to 100 meters.
+        """
+        self.cell_size_meters = cell_size_meters
+        self.max_distance_meters = max_distance_meters
+        self.direction_tags = geometry.direction_tags
+        self.direction_ids = {tag: i for i, tag in enumerate(self.direction_tags)}
+
+        polylines = [geometry.get_polyline(tag) for tag in self.direction_tags]
+        all_lat = np.concatenate([lat for lat, _, _ in polylines] + [np.zeros(0)])
+        all_lon = np.concatenate([lon for _, lon, _ in polylines] + [np.zeros(0)])
+        self._lat0 = all_lat.mean() if len(all_lat) else 0.0
+        self._lon0 = all_lon.mean() if len(all_lon) else 0.0
+
+        self._set_segments(polylines)
+        self._set_index()
+
+    def _set_segments(self, polylines):
+        """Helper function to __init__. Lay out the segments of all polylines
+        as flat arrays of planar start points, vectors, and distances along
+        their direction."""
+
+        direction, x1, y1, dx, dy, start, length = ([] for _ in range(7))
+        for i, (lat, lon, distance_meters) in enumerate(polylines):
+            if len(lat) < 2:
+                continue
+            x, y = project_to_meters(lat, lon, self._lat0, self._lon0)
+            direction.append(np.full(len(x) - 1, i))
+            x1.append(x[:-1])
+            y1.append(y[:-1])
+            dx.append(np.diff(x))
+            dy.append(np.diff(y))
+            start.append(distance_meters[:-1])
+            length.append(np.diff(distance_meters))
+
+        def concat(arrays, dtype=np.float64):
+            return np.concatenate(arrays).astype(dtype) if arrays else np.zeros(0, dtype=dtype)
+
+        self._seg_direction = concat(direction, np.int64)
+        self._seg_x1, self._seg_y1 = concat(x1), concat(y1)
+        self._seg_dx, self._seg_dy = concat(dx), concat(dy)
+        self._seg_start, self._seg_length = concat(start), concat(length)
+
+    def _set_index(self):
+        """Helper function to __init__. Register each segment in the cells
+        overlapping its bounding box grown by max_distance_meters, as sorted
+        (cell key, segment) arrays."""
+
+        margin = self.max_distance_meters
+        x2, y2 = self._seg_x1 + self._seg_dx, self._seg_y1 + self._seg_dy
+        cx0 = self._get_cells(np.minimum(self._seg_x1, x2) - margin)
+        cx1 = self._get_cells(np.maximum(self._seg_x1, x2) + margin)
+        cy0 = self._get_cells(np.minimum(self._seg_y1, y2) - margin)
+        cy1 = self._get_cells(np.maximum(self._seg_y1, y2) + margin)
+
+        # Enumerate the cells of each bounding box.
+        width, height = cx1 - cx0 + 1, cy1 - cy0 + 1
+        counts = width * height
+        segment = np.repeat(np.arange(len(counts)), counts)
+        position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cx = cx0[segment] + position // height[segment]
+        cy = cy0[segment] + position % height[segment]
+
+        keys = self._get_keys(self._seg_direction[segment], cx, cy)
+        order = np.argsort(keys, kind="stable")
+        self._index_keys = keys[order]
+        self._index_segments = segment[order]
+
+    def _get_cells(self, coordinate):
+        return np.floor(coordinate / self.cell_size_meters).astype(np.int64)
+
+    def _get_keys(self, direction, cx, cy):
+        """Combine direction ids and cell coordinates into int64 keys."""
+
+        offset = 1 << (self.cell_bits - 1)
+        return (direction.astype(np.int64) << (2 * self.cell_bits)) \
+            | ((cx + offset) << self.cell_bits) | (cy + offset)
+
+    def match(self, direction_tags, lat, lon, return_bearing=False):
+        """Project readings onto the polyline of their direction.
+
+        Args:
+            direction_tags (array-like): Direction tag of each reading.
+            lat, lon (array-like): Coordinates of each reading.
+            return_bearing (bool, optional): Also return the compass bearing
+                                             of the direction where matched.
+                                             Defaults to False.
+
+        Returns:
+            tuple(np.ndarray, np.ndarray): Distance along the direction and
+                distance to the direction, in meters. Both are NaN for
+                readings of unknown directions or further than
+                max_distance_meters from their direction. With
+                return_bearing, a third array of bearings in degrees
+                clockwise from north.
+        """
+        direction = pd.Series(np.asarray(direction_tags, dtype=object)) \
+                      .map(self.direction_ids).to_numpy(dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+
+        along = np.full(len(lat), np.nan)
+        to_route = np.full(len(lat), np.nan)
+        bearing = np.full(len(lat), np.nan)
+        known = np.flatnonzero(~np.isnan(direction) & ~np.isnan(lat) & ~np.isnan(lon))
+
+        for start in range(0, len(known), self.chunk_size):
+            points = known[start:start + self.chunk_size]
+            along[points], to_route[points], bearing[points] = self._match_points(
+                direction[points].astype(np.int64), lat[points], lon[points])
+
+        return (along, to_route, bearing) if return_bearing else (along, to_route)
+
+    def _match_points(self, direction, lat, lon):
+        """Helper function to match, over readings of known directions."""
+
+        x, y = project_to_meters(lat, lon, self._lat0, self._lon0)
+        keys = self._get_keys(direction, self._get_cells(x), self._get_cells(y))
+
+        # Candidate (reading, segment) pairs from the readings' cells.
+        first = np.searchsorted(self._index_keys, keys, side="left")
+        counts = np.searchsorted(self._index_keys, keys, side="right") - first
+        point = np.repeat(np.arange(len(keys)), counts)
+        position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        segment = self._index_segments[np.repeat(first, counts) + position]
+
+        # Project readings onto their candidate segments.
+        dx, dy = self._seg_dx[segment], self._seg_dy[segment]
+        px, py = x[point] - self._seg_x1[segment], y[point] - self._seg_y1[segment]
+        length_squared = dx * dx + dy * dy
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t = np.nan_to_num(np.clip((px * dx + py * dy) / length_squared, 0, 1))
+        distance = np.hypot(px - t * dx, py - t * dy)
+
+        # Keep the nearest segment of each reading. Candidates of a reading
+        # are contiguous, so the minimum is reduced over each run of pairs.
+        has_candidates = counts > 0
+        min_distance = np.minimum.reduceat(distance, (np.cumsum(counts) - counts)[has_candidates]) \
+            if len(distance) else np.zeros(0)
+        is_nearest = np.flatnonzero(distance == np.repeat(min_distance, counts[has_candidates]))
+        is_first = np.ones(len(is_nearest), dtype=bool)
+        is_first[1:] = point[is_nearest[1:]] != point[is_nearest[:-1]]
+        nearest = is_nearest[is_first]
+        point = point[nearest]
+
+        along = np.full(len(keys), np.nan)
+        to_route = np.full(len(keys), np.nan)
+        bearing = np.full(len(keys), np.nan)
+        is_close = distance[nearest] <= self.max_distance_meters
+        point, nearest = point[is_close], nearest[is_close]
+        along[point] = self._seg_start[segment[nearest]] \
+                       + t[nearest] * self._seg_length[segment[nearest]]
+        to_route[point] = distance[nearest]
+        bearing[point] = np.degrees(np.arctan2(dx[nearest], dy[nearest])) % 360
+        return along, to_route, bearing
+
+    def match_dataframe(self, df):
+        """Map match a dataframe of readings.
+
+        Args:
+            df (dataframe): Readings with direction_tag, lat, lon columns,
+                            e.g. a batch of the vehicle_locations table.
+
+        Returns:
+            dataframe: Copy of df with distance_along_meters and
+                       distance_to_route_meters columns.
+        """
+        along, to_route = self.match(df.direction_tag, df.lat, df.lon)
+        return df.assign(distance_along_meters=along, distance_to_route_meters=to_route)
+
+    def get_times_at_stops_df(self, trips_df, stops_df):
+        """Interpolate the time of visit of each trip at the stops of its
+        direction, from the read times at the trip's distances along the
+        direction. Distances are made non-decreasing along each trip, and
+        stops outside the stretch covered by a trip are left out.
+
+        All trips are interpolated in one pass: distances are offset by trip,
+        so that the readings of all trips form a single increasing sequence.
+
+        Args:
+            trips_df (dataframe): Readings segmented into trips, with
+                                  vehicle_id, direction_tag, lat, lon,
+                                  read_time, trip_id columns, see
+                                  segment_vehicle_locations_into_trips.sql.
+            stops_df (dataframe): Stops with direction_tag, stop_tag, lat,
+                                  lon, stop_order columns, see
+                                  get_all_stops_data.sql.
+
+        Returns:
+            dataframe: Times at stops with columns stop_tag, lat, lon,
+                       stop_order, read_time, vehicle_id, direction_tag,
+                       trip_id, or None if there are no times.
+        """
+        trip_columns = ["vehicle_id", "direction_tag", "trip_id"]
+        readings = self.match_dataframe(trips_df).dropna(
+                        subset=["distance_along_meters", "read_time"])
+        stops = self.match_dataframe(stops_df.dropna(subset=["lat", "lon"])).dropna(
+                        subset=["distance_along_meters"])
+        if readings.empty or stops.empty:
+            return None
+
+        readings = readings.sort_values(trip_columns + ["read_time"], kind="stable")
+        readings["trip"] = readings.groupby(trip_columns, sort=False).ngroup()
+        readings["distance"] = readings.groupby("trip").distance_along_meters.cummax()
+
+        # Offset trips beyond the longest direction, so that distances increase overall.
+        trip_offset = 2 * np.nanmax(np.abs(self._seg_start + self._seg_length)) + 1
+        xp = readings.distance.to_numpy() + readings.trip.to_numpy() * trip_offset
+        fp = pd.to_datetime(readings.read_time).to_numpy(dtype="datetime64[ns]") \
+                                               .astype(np.int64).astype(np.float64)
+
+        trips = readings.groupby("trip").agg(
+                    vehicle_id=("vehicle_id", "first"), direction_tag=("direction_tag", "first"),
+                    trip_id=("trip_id", "first"), min_distance=("distance", "min"),
+                    max_distance=("distance", "max")).reset_index()
+        df = pd.merge(trips, stops[["direction_tag", "stop_tag", "lat", "lon", "stop_order",
+                                    "distance_along_meters"]], on="direction_tag")
+        df = df[df.distance_along_meters.between(df.min_distance, df.max_distance)]
+        if df.empty:
+            return None
+
+        x = df.distance_along_meters.to_numpy() + df.trip.to_numpy() * trip_offset
+        df = df.assign(read_time=pd.to_datetime(np.interp(x, xp, fp).astype(np.int64)))
+
+        columns = ["stop_tag", "lat", "lon", "stop_order", "read_time"] + trip_columns
+        return df.sort_values(trip_columns + ["stop_order"])[columns].reset_index(drop=True)
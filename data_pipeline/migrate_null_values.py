@@ -0,0 +1,81 @@
+"""
+One-off migration of the 'None' strings stored for missing values by earlier
+versions of the parsers, which converted nullable columns with astype("str").
+String columns are set to NULL where they hold 'None', and 'None' rows of the
+route and direction dimension tables are dropped, their facts pointing to NULL.
+
+Safe to run more than once.
+
+Historical 'predictable' values can't be fixed: the same parsers converted the
+'true'/'false' strings of the API with astype("bool"), which makes any
+non-empty string true, so every stored reading is predictable. Only readings
+stored since the parsers were fixed are reliable.
+"""
+import argparse
+import db_connection
+from db_tables import Base
+from sqlalchemy import String, text
+
+
+# Dimension tables whose 'None' rows are dropped: table, key column, value column.
+DIMENSIONS = [
+    ("route_dim", "route_int", "tag"),
+    ("direction_dim", "direction_int", "tag"),
+]
+
+
+def migrate_none_strings_to_null(engine, verbose=False):
+    """Replace the 'None' strings of all tables by NULL. Each column is
+    updated in its own transaction.
+
+    Args:
+        engine (Engine): SQLAlchemy engine of the database.
+        verbose (bool, optional): Print the number of rows changed per column.
+                                  Defaults to False.
+
+    Returns:
+        dict: Number of rows changed (set to NULL, or dropped from the
+              dimension tables), by 'table.column'.
+    """
+    num_updated = {}
+
+    # Facts first, so that the dimension rows are no longer referenced.
+    for tablename, key_column, value_column in DIMENSIONS:
+        with engine.begin() as conn:
+            conn.execute(text(
+                "UPDATE vehicle_locations_compact SET {1} = NULL WHERE {1} IN "
+                "(SELECT {1} FROM {0} WHERE {2} = 'None')".format(
+                    tablename, key_column, value_column)))
+            result = conn.execute(text("DELETE FROM {} WHERE {} = 'None'".format(
+                                           tablename, value_column)))
+            num_updated[f"{tablename}.{value_column}"] = result.rowcount
+
+    for table in Base.metadata.sorted_tables:
+        for column in table.columns:
+            if not isinstance(column.type, String) or column.primary_key:
+                continue
+
+            with engine.begin() as conn:
+                preparer = conn.dialect.identifier_preparer
+                result = conn.execute(text("UPDATE {0} SET {1} = NULL WHERE {1} = 'None'".format(
+                                               preparer.quote(table.name),
+                                               preparer.quote(column.name))))
+                name = f"{table.name}.{column.name}"
+                num_updated[name] = num_updated.get(name, 0) + result.rowcount
+
+    if verbose:
+        for name, count in num_updated.items():
+            if count:
+                print(f"{name}: {count} 'None' values removed.")
+
+    return num_updated
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="increase output verbosity")
+    args = parser.parse_args()
+
+    migrate_none_strings_to_null(db_connection.create_engine(), verbose=args.verbose)
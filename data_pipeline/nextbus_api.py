@@ -4,8 +4,122 @@ Classes to handle interfacing with the NextBus Web API.
 See more information at 
 https://retro.umoiq.com/xmlFeedDocs/NextBusXMLFeed.pdf
 """ 
+import collections
 import datetime
+import itertools
+import json
+import random
+import time
 import requests
+from requests.adapters import HTTPAdapter
+
+# Optional faster json decoder, falling back to the standard library. 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional incremental json decoder, used to stream large responses. 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+class NextBusAPIError(Exception):
+    """Raised when a request to the NextBus API fails after all retries, 
+    or is refused because the endpoint's circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for a single API endpoint. 
+
+    After failure_threshold consecutive failed requests the circuit opens,
+    and requests to the endpoint are refused for reset_timeout seconds. 
+    Afterwards a single trial request is let through (half-open state): 
+    success closes the circuit again, failure re-opens it. 
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0 
+        self.opened_at = None
+
+    def is_open(self):
+        if self.opened_at is None:
+            return False 
+        return time.monotonic() - self.opened_at < self.reset_timeout
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic() 
+
+
+class TransferStats:
+    """
+    Statistics on the data transferred from the API. 
+
+    Wire bytes are the bytes received over the network (i.e. compressed when
+    the response uses gzip), which is what counts against the API rate limit
+    of 2MB/20sec. Content bytes are the decoded body sizes. 
+    """
+
+    def __init__(self, window_seconds=20):
+        self.window_seconds = window_seconds
+        self.num_requests = 0 
+        self.wire_bytes = 0 
+        self.content_bytes = 0 
+        self._window = collections.deque()   # (timestamp, wire_bytes) pairs
+
+    def record(self, wire_bytes, content_bytes):
+        self.num_requests += 1
+        self.wire_bytes += wire_bytes
+        self.content_bytes += content_bytes
+        self._window.append((time.monotonic(), wire_bytes)) 
+
+    def get_wire_bytes_in_window(self):
+        """Wire bytes received over the last window_seconds."""
+
+        cutoff = time.monotonic() - self.window_seconds
+        while self._window and self._window[0][0] < cutoff:
+            self._window.popleft() 
+        return sum(num_bytes for _, num_bytes in self._window) 
+
+
+def create_session(pool_size=1):
+    """Create a requests session for the NextBus API. 
+
+    The session keeps up to pool_size connections to the API host alive for 
+    reuse, and asks for gzip transfer encoding to reduce the bytes sent over
+    the wire. The pipeline makes its requests one at a time, so a single 
+    connection is reused throughout; a larger pool only helps when the 
+    session is shared between threads. 
+
+    Args:
+        pool_size (int, optional): Number of pooled connections. Defaults to 1.
+
+    Returns:
+        session: requests.Session instance. 
+    """
+    session = requests.Session() 
+
+    # Retries are handled by NextBusAPI, hence max_retries=0 here. 
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    session.headers.update({
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive" 
+    })
+    return session
 
 
 class NextBusAPI:
@@ -18,9 +132,11 @@ class NextBusAPI:
     -----------------------------------------------------------------------
     Note: 
 
-    'predictions' & 'predictionsForMultiStops' endpoints are not supported currently.
+    'predictionsForMultiStops' requests are batched per route, see 
+    get_predictions_response_dicts_from_web. 
     'messages' endpoint only supports fetching messages for all routes.  
-    'routeConfig' only supports the verbose endpoint for now.
+    'routeConfig' only supports the verbose endpoint for now. Multiple routes
+    can be requested at once, see get_route_config_response_dicts_from_web.
 
     -----------------------------------------------------------------------
     API Rate Limit (from the documentation):   
@@ -36,11 +152,40 @@ class NextBusAPI:
     Maximum number of predictions per stop for prediction commands: 5
     Maximum timespan for "vehicleLocations" command: 5min
 
+    -----------------------------------------------------------------------
+    Error handling: 
+
+    Each request has a timeout, and failed requests (connection errors, 
+    timeouts, 5xx and 429 http errors, non-json bodies or retryable API 
+    errors) are retried with jittered exponential backoff. An endpoint 
+    failing repeatedly is paused by its circuit breaker. Other 4xx errors 
+    and API errors which can't be retried (e.g. an unknown vehicle) are 
+    raised right away, and don't count towards the circuit breaker. When a
+    request can't be completed, NextBusAPIError is raised. 
+
     """
 
-    def __init__(self, session=None, verbose=False):
-        self.session = session 
+    # Maximum routes per "routeConfig" command, as per the rate limits above.
+    max_routes_per_route_config = 100
+
+    # Maximum stops per route for the "predictionsForMultiStops" command.
+    max_stops_per_predictions_for_multi_stops = 150
+
+    def __init__(self, session=None, verbose=False, timeout=10, max_retries=3,
+                 backoff_base=0.5, backoff_max=8, failure_threshold=5,
+                 reset_timeout=60, circuit_breakers=None, stats=None):
+        # Without a session we create our own, so that connections are 
+        # still reused between requests. 
+        self.session = session if session is not None else create_session()
+        self.stats = stats if stats is not None else TransferStats()
         self.verbose = verbose
+        self.timeout = timeout                # seconds, per request
+        self.max_retries = max_retries        # retries after the first attempt
+        self.backoff_base = backoff_base      # seconds
+        self.backoff_max = backoff_max        # seconds
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout    # seconds
+        self.circuit_breakers = circuit_breakers if circuit_breakers is not None else {}
         self.endpoints = {
             "agencyList": ("https://retro.umoiq.com/service/publicJSONFeed"
                            "?command=agencyList"), 
@@ -52,10 +197,24 @@ class NextBusAPI:
                             "&a={agency_tag}"
                             "&r={route_tag}"
                             "&verbose"),    
+            "routeConfigMultiRoutes": ("https://retro.umoiq.com/service/publicJSONFeed"
+                                       "?command=routeConfig"
+                                       "&a={agency_tag}"
+                                       "{route_params}"
+                                       "&verbose"),
             "schedule": ("https://retro.umoiq.com/service/publicJSONFeed"
                           "?command=schedule"
                           "&a={agency_tag}"
                           "&r={route_tag}"), 
+            "predictions": ("https://retro.umoiq.com/service/publicJSONFeed"
+                            "?command=predictions"
+                            "&a={agency_tag}"
+                            "&r={route_tag}"
+                            "&s={stop_tag}"),
+            "predictionsForMultiStops": ("https://retro.umoiq.com/service/publicJSONFeed"
+                                         "?command=predictionsForMultiStops"
+                                         "&a={agency_tag}"
+                                         "{stop_params}"),
             "messages": ("https://retro.umoiq.com/service/publicJSONFeed"
                         "?command=messages" 
                         "&a={agency_tag}"), 
@@ -82,17 +241,433 @@ class NextBusAPI:
 
         Returns:
             response_dict: response object parsed into json. 
+
+        Raises:
+            NextBusAPIError: If the request fails after all retries, or the
+                             endpoint's circuit breaker is open. 
         """
         url = self.endpoints[endpoint_name].format(**kwarg) 
+        return self._request_with_retries(endpoint_name, url, self._get)
 
-        if self.verbose:
-            now = datetime.datetime.now().strftime("%H:%M:%S %h %d")
-            print("API call at {time} ~ {url}".format(time=now, url=url))
+    def iter_response_items_from_web(self, endpoint_name, prefix, **kwarg):
+        """Incrementally decode a response, yielding the items found at prefix
+        as they are decoded. This keeps large responses (e.g. schedules) from
+        being materialized in full before parsing. 
+
+        The prefix follows the ijson syntax, where 'item' stands for the 
+        elements of a list, e.g. prefix='route.item' yields each schedule of
+        a schedule response. A dict found where a list is expected is yielded 
+        as a single item, as the API does for single element lists. 
+
+        If ijson is not installed, the response is decoded in full and the
+        items are then yielded from the decoded dict. 
+
+        Args:
+            endpoint_name (str): Name corresponding to the 'command' type. 
+            prefix (str): Path to the items to yield, e.g. 'route.item'. 
+
+        Kwargs: 
+            Arguments expected by the NextBus API (e.g. route_tag). 
+
+        Yields:
+            item: Decoded json object found at prefix. 
+
+        Raises:
+            NextBusAPIError: If the request fails after all retries, the 
+                             endpoint's circuit breaker is open, the body is 
+                             an API error, or the stream is interrupted or 
+                             malformed. 
+        """
+        if ijson is None:
+            response_dict = self.get_response_dict_from_web(endpoint_name, **kwarg)
+            yield from _iter_items_at_prefix(response_dict, prefix.split("."))
+            return
+
+        url = self.endpoints[endpoint_name].format(**kwarg) 
+        breaker = self._get_circuit_breaker(endpoint_name) 
+
+        # Errors up to the first item, including API errors in the body, are
+        # retried with the request. Success is only recorded once the whole
+        # stream is read. 
+        response, stream, items = self._request_with_retries(
+                                    endpoint_name, url, 
+                                    lambda url: self._open_item_stream(url, prefix),
+                                    record_success=False)
+        try:
+            yield from items 
+
+        except _APIErrorInBody as e:
+            raise NextBusAPIError(f"API error: {e.api_error}") from e
+
+        except (ijson.JSONError, requests.RequestException) as e:
+            breaker.record_failure() 
+            raise NextBusAPIError(
+                f"Stream from endpoint '{endpoint_name}' failed: {e!r}") from e
+
+        finally:
+            self._close_stream(response, stream) 
+
+        breaker.record_success() 
+
+    def _request_with_retries(self, endpoint_name, url, request_func, record_success=True):
+        """Helper function performing a request with retries, backoff and the
+        endpoint's circuit breaker. 
+
+        Args:
+            endpoint_name (str): Name of the endpoint, for its circuit breaker.
+            url (str): Formatted url to request. 
+            request_func (callable): Performs a single request on url.
+            record_success (bool, optional): Record the success of the request
+                                             with the circuit breaker. False 
+                                             when the body is read afterwards,
+                                             e.g. streamed. Defaults to True.
+
+        Returns:
+            Result of request_func. 
+        """
+
+        breaker = self._get_circuit_breaker(endpoint_name) 
+        if breaker.is_open():
+            raise NextBusAPIError(
+                f"Circuit open for endpoint '{endpoint_name}', request refused.")
+
+        error = None
+        for attempt in range(self.max_retries + 1):
+
+            if attempt > 0:
+                time.sleep(self._get_backoff_delay(attempt)) 
+
+            if self.verbose:
+                now = datetime.datetime.now().strftime("%H:%M:%S %h %d")
+                print("API call at {time} ~ {url}".format(time=now, url=url))
+
+            try:
+                response_dict = request_func(url)  
+            except requests.HTTPError as e:
+                # Client errors (e.g. a bad request) fail the same way again, 
+                # and don't mean the endpoint is down. 
+                if self._is_client_error(e):
+                    raise NextBusAPIError(
+                        f"Request to endpoint '{endpoint_name}' refused: {e!r}") from e
+                error = e 
+                continue
+            except (requests.RequestException, ValueError) as e:
+                error = e 
+                continue
+
+            # The API reports some errors (e.g. rate limiting) in the body. 
+            # Errors which can't be retried (e.g. an unknown vehicle) are 
+            # raised without counting against the circuit breaker. 
+            api_error = response_dict.get("Error") if isinstance(response_dict, dict) else None
+            if api_error is not None:
+                error = NextBusAPIError(f"API error: {api_error}")
+                if self._should_retry(api_error):
+                    continue
+                raise error
+
+            if record_success:
+                breaker.record_success() 
+            return response_dict
+
+        breaker.record_failure() 
+        raise NextBusAPIError(
+            f"Request to endpoint '{endpoint_name}' failed: {error!r}") from error
+
+    def _is_client_error(self, error):
+        """Whether an HTTP error is a 4xx response other than rate limiting
+        (429), which are not retried."""
 
-        if self.session:
-            return self.session.get(url).json()
-        else:
-            return requests.get(url).json() 
+        status_code = getattr(error.response, "status_code", None) 
+        return status_code is not None and 400 <= status_code < 500 and status_code != 429
+
+    def _should_retry(self, api_error):
+        """Whether an error reported in a response body can be retried."""
+
+        if not isinstance(api_error, dict):
+            return False 
+        return str(api_error.get("shouldRetry", "false")).lower() == "true"
+
+    def _get(self, url):
+        """Helper function to get_response_dict_from_web. Single GET request."""
+
+        response = self.session.get(url, timeout=self.timeout) 
+        response.raise_for_status() 
+
+        content = response.content
+        self.stats.record(wire_bytes=self._get_wire_bytes(response, len(content)),
+                          content_bytes=len(content))
+        return self._decode(content) 
+
+    def _get_stream(self, url):
+        """Helper function to iter_response_items_from_web. Opens a streamed 
+        GET request, leaving the body to be read from response.raw."""
+
+        response = self.session.get(url, timeout=self.timeout, stream=True) 
+        response.raise_for_status() 
+        return response 
+
+    def _open_item_stream(self, url, prefix):
+        """Helper function to iter_response_items_from_web. Opens a streamed
+        GET request, and decodes its body up to the first item at prefix. 
+
+        An API error reported in the body comes before any item: it is then
+        returned as the decoded error body, for _request_with_retries to 
+        retry or raise it as that of any other response. A malformed body 
+        raises ValueError, as when decoding a whole body. 
+
+        Returns:
+            tuple or dict: The response, the counting reader of its body and
+                           an iterator over its items, or an API error body.
+        """
+        response = self._get_stream(url) 
+        stream = _CountingReader(response.raw) 
+        try:
+            response.raw.decode_content = True  # undo transfer compression
+            events = _raise_on_api_error(ijson.parse(stream, use_float=True))
+            items = _iter_items_from_events(events, prefix)
+            first_items = list(itertools.islice(items, 1)) 
+        except _APIErrorInBody as e:
+            self._close_stream(response, stream)
+            return {"Error": e.api_error}
+        except ijson.JSONError as e:
+            self._close_stream(response, stream)
+            raise ValueError(f"Malformed stream: {e!r}") from e
+        except BaseException:
+            self._close_stream(response, stream)
+            raise
+
+        return response, stream, itertools.chain(first_items, items)
+
+    def _close_stream(self, response, stream):
+        """Record the bytes read from a streamed response, and close it."""
+
+        self.stats.record(wire_bytes=self._get_wire_bytes(response, stream.num_bytes),
+                          content_bytes=stream.num_bytes)
+        response.close() 
+
+    def _get_wire_bytes(self, response, default):
+        """Number of body bytes received over the network for a response."""
+
+        try:
+            return int(response.raw.tell())  # counts compressed bytes
+        except (AttributeError, TypeError, ValueError):
+            return default 
+
+    def get_connection_stats(self):
+        """Statistics on connection reuse and data transferred. 
+
+        Returns:
+            dict: Number of requests, new connections opened and reused, 
+                  wire and content bytes received (in total, and wire bytes
+                  over the rate limit window). 
+        """
+        new_connections = 0 
+        for adapter in set(self.session.adapters.values()):
+            pools = getattr(getattr(adapter, "poolmanager", None), "pools", None)
+            if pools is None:
+                continue
+            for key in pools.keys():
+                pool = pools.get(key)
+                new_connections += getattr(pool, "num_connections", 0) 
+
+        num_requests = self.stats.num_requests 
+        return {
+            "requests": num_requests,
+            "new_connections": new_connections,
+            "reused_connections": max(num_requests - new_connections, 0),
+            "wire_bytes": self.stats.wire_bytes,
+            "content_bytes": self.stats.content_bytes,
+            "wire_bytes_in_window": self.stats.get_wire_bytes_in_window(),
+        }
+
+    def _decode(self, content):
+        """Decode a json body, using orjson when available."""
+
+        if orjson is not None:
+            return orjson.loads(content) 
+        return json.loads(content) 
+
+    def _get_circuit_breaker(self, endpoint_name):
+        """Get the circuit breaker for an endpoint, creating it if needed."""
+
+        if endpoint_name not in self.circuit_breakers:
+            self.circuit_breakers[endpoint_name] = CircuitBreaker(
+                                        failure_threshold=self.failure_threshold,
+                                        reset_timeout=self.reset_timeout
+                                        )
+        return self.circuit_breakers[endpoint_name]
+
+    def _get_backoff_delay(self, attempt):
+        """Exponential backoff with full jitter, in seconds."""
+
+        cap = min(self.backoff_max, self.backoff_base * 2**(attempt - 1)) 
+        return random.uniform(0, cap) 
+
+    def get_route_config_response_dicts_from_web(self, agency_tag, route_tags,
+                                                 on_error=None):
+        """Fetch the routeConfig data for a list of routes, requesting up to 
+        max_routes_per_route_config routes per API call. 
+
+        Each response holds a list of routes under the 'route' key (or a 
+        single dict when the batch has one route), see 
+        ResponseParser.split_route_config_response.
+
+        Args:
+            agency_tag (str): shortname of the agency (e.g. 'ttc')
+            route_tags (List[str]): Tags of the routes to fetch. 
+            on_error (callable, optional): Called with the NextBusAPIError of
+                             a failed batch, after which the next batch is 
+                             fetched. By default the error is raised. 
+
+        Yields:
+            response_dict: response object parsed into json, one per batch. 
+        """
+        route_tags = list(route_tags) 
+        batch_size = self.max_routes_per_route_config
+
+        for start in range(0, len(route_tags), batch_size):
+            batch = route_tags[start:start + batch_size] 
+            route_params = "".join(f"&r={route_tag}" for route_tag in batch)
+
+            try:
+                response_dict = self.get_response_dict_from_web(
+                                endpoint_name="routeConfigMultiRoutes",
+                                agency_tag=agency_tag,
+                                route_params=route_params
+                                )
+            except NextBusAPIError as e:
+                if on_error is None:
+                    raise
+                on_error(e)
+                continue
+
+            yield response_dict
+
+    def get_predictions_response_dicts_from_web(self, agency_tag, route_tag,
+                                                stop_tags, on_error=None):
+        """Fetch predictions for a list of stops on a route, requesting up to
+        max_stops_per_predictions_for_multi_stops stops per API call. 
+
+        Args:
+            agency_tag (str): shortname of the agency (e.g. 'ttc')
+            route_tag (str): Tag of the route the stops are on. 
+            stop_tags (List[str]): Tags of the stops to fetch predictions for. 
+            on_error (callable, optional): Called with the NextBusAPIError of
+                             a failed batch, after which the next batch is 
+                             fetched. By default the error is raised. 
+
+        Yields:
+            response_dict: response object parsed into json, one per batch. 
+        """
+        stop_tags = list(stop_tags) 
+        batch_size = self.max_stops_per_predictions_for_multi_stops
+
+        for start in range(0, len(stop_tags), batch_size):
+            batch = stop_tags[start:start + batch_size] 
+            stop_params = "".join(f"&stops={route_tag}|{stop_tag}" 
+                                  for stop_tag in batch)
+
+            try:
+                response_dict = self.get_response_dict_from_web(
+                                endpoint_name="predictionsForMultiStops",
+                                agency_tag=agency_tag,
+                                stop_params=stop_params
+                                )
+            except NextBusAPIError as e:
+                if on_error is None:
+                    raise
+                on_error(e)
+                continue
+
+            yield response_dict
+
+
+class _CountingReader:
+    """File-like wrapper counting the bytes read from a stream."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.num_bytes = 0 
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size) 
+        self.num_bytes += len(data) 
+        return data
+
+
+class _APIErrorInBody(Exception):
+    """Raised by _raise_on_api_error on an error reported in a streamed body."""
+
+    def __init__(self, api_error):
+        super().__init__(api_error)
+        self.api_error = api_error
+
+
+def _raise_on_api_error(events):
+    """Pass through a stream of ijson events, raising _APIErrorInBody when the
+    top level 'Error' object of an API error body has been decoded."""
+
+    builder = None
+    for current, event, value in events:
+        if current == "Error" or current.startswith("Error."):
+            if builder is None:
+                if event not in ("start_map", "start_array"):
+                    raise _APIErrorInBody(value)
+                builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            if current == "Error" and event in ("end_map", "end_array"):
+                raise _APIErrorInBody(builder.value)
+            continue
+
+        yield current, event, value
+
+
+def _iter_items_at_prefix(obj, path):
+    """Yield the items at path in a decoded json object, mirroring the 
+    ijson prefix syntax used by NextBusAPI.iter_response_items_from_web.
+    """
+    if not path:
+        yield obj
+        return
+
+    key, rest = path[0], path[1:]
+    if key == "item":
+        items = obj if isinstance(obj, list) else [obj]
+        for item in items:
+            yield from _iter_items_at_prefix(item, rest)
+    elif isinstance(obj, dict) and key in obj:
+        yield from _iter_items_at_prefix(obj[key], rest)
+
+
+def _iter_items_from_events(events, prefix):
+    """Build and yield the items at prefix from a stream of ijson events.
+
+    Unlike ijson.items, a dict found in place of the list (i.e. at the parent
+    of a prefix ending in 'item') is also yielded, as a single item. 
+    """
+    parent = prefix[:-len(".item")] if prefix.endswith(".item") else None
+
+    builder = None
+    depth = 0 
+    for current, event, value in events:
+
+        if builder is None:
+            if not (current == prefix or (current == parent and event == "start_map")):
+                continue
+            if event not in ("start_map", "start_array"):
+                yield value     # scalar item
+                continue
+            builder = ijson.ObjectBuilder()
+
+        builder.event(event, value)
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+
+        if depth == 0:
+            yield builder.value
+            builder = None
 
 
 class NextBusAPIClient:
@@ -107,18 +682,32 @@ class NextBusAPIClient:
         response = client.get_response_dict_from_web(...)
 
     """
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, pool_size=1, **api_kwargs):
         self.client = None
         self.verbose = verbose
+        self.pool_size = pool_size     # pooled connections, see create_session
+        self.api_kwargs = api_kwargs   # timeout & retry settings for NextBusAPI
+
+        # Circuit breakers and transfer stats are kept across sessions, so 
+        # that a failing endpoint stays paused between successive uses of 
+        # the client, and data usage is tracked over the rate limit window. 
+        self.circuit_breakers = {}
+        self.stats = TransferStats() 
 
     def set_verbose(self, verbose):
         self.verbose = verbose
 
     def __enter__(self):
         self.client = NextBusAPI(
-            session=requests.Session(), 
-            verbose=self.verbose)
+            session=create_session(pool_size=self.pool_size), 
+            verbose=self.verbose,
+            circuit_breakers=self.circuit_breakers,
+            stats=self.stats,
+            **self.api_kwargs)
         return self.client
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.client.session.close() 
\ No newline at end of file
+        if self.verbose:
+            print("API session stats ~ {stats}".format(
+                stats=self.client.get_connection_stats()))
+        self.client.session.close() 
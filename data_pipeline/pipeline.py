@@ -4,13 +4,25 @@ Data Pipeline classes.
 import contextlib
 import datetime
 import db_connection 
+import numpy as np
+import os
 import pandas as pd
+from anomalies import AnomalyDetector
+from config_diff import TransitConfigDiff
+from connection_scan import ConnectionTimetable
+from data_quality import VehicleLocationsQuality
 from database import DatabaseWrapper
-from nextbus_api import NextBusAPIClient 
+from map_matching import MapMatcher
+from nextbus_api import NextBusAPIClient, NextBusAPIError
+from route_geometry import RouteGeometry
+from route_index import RouteIndex
+from routing import trim_stop_tags
 from sklearn.neighbors import KNeighborsRegressor
+from transit_statistics import TransitStatistics
+from utils.caching import RecentKeyFilter
 from utils.configs import get_transit_config
-from utils.distances import calculate_distance_from_lat_lon_coords
-from utils.queries import get_queries_path
+from utils.distances import calculate_distances_from_lat_lon_arrays
+from utils.queries import load_sql_file
 
 
 class Pipeline:
@@ -36,14 +48,84 @@ class DataLoader:
         self.verbose = verbose 
         self.nextbus_client = NextBusAPIClient(verbose=self.verbose)
         self.parser = ResponseParser()
+        self.vehicle_locations_layout = "legacy" 
+        self.recent_keys = RecentKeyFilter() 
+        self.recent_keys_seeded = False 
+        self.route_index = None 
+        self.quality = None 
+        self.anomaly_detector = None 
 
     def set_verbose(self, verbose):
         self.verbose = verbose
         self.nextbus_client.set_verbose(verbose)
 
+    def set_vehicle_locations_layout(self, layout):
+        """Set the storage layout of vehicle locations: 'legacy' (the 
+        vehicle_locations table), 'compact' (vehicle_locations_compact and
+        its dimension tables) or 'both', e.g. while migrating."""
+
+        if layout not in ("legacy", "compact", "both"):
+            raise ValueError(f"Unknown vehicle locations layout '{layout}'.")
+        self.vehicle_locations_layout = layout 
+
+    def load_route_index(self, geometry_path=None):
+        """Check the routes of vehicle locations at ingestion: repair missing
+        route and direction tags from the readings' location, and record 
+        readings away from their direction in the off_route_readings table
+        (see route_index.RouteIndex). 
+
+        Args:
+            geometry_path (str, optional): Directory of the route geometry 
+                                           (see compile_route_geometry). If 
+                                           missing, only route bounding boxes
+                                           are used, and direction tags are
+                                           not repaired. 
+        """
+        geometry = None 
+        if geometry_path is not None and os.path.isdir(geometry_path):
+            geometry = RouteGeometry.load(geometry_path) 
+
+        self.route_index = RouteIndex.from_database(self.db, geometry=geometry) 
+
+    def load_anomaly_detector(self):
+        """Detect slowdowns at the end of each collection cycle, and record 
+        them in the anomalies table (see anomalies.AnomalyDetector). The 
+        detector is kept for the life of the loader and fed the readings of
+        each cycle; the readings of its window are only replayed here, from
+        the source table of the vehicle locations layout. 
+        """
+        self.anomaly_detector = AnomalyDetector.from_database(
+                                    self.db, source=self.get_vehicle_locations_source_table())
+
+    def _log_api_error(self, error):
+        """Report a failed API request. Failed requests are skipped, so that
+        a transient error only costs the data of that request."""
+
+        if self.verbose:
+            now = datetime.datetime.now().strftime("%H:%M:%S %h %d")
+            print("API error at {time} ~ {error}".format(time=now, error=error))
+
+    def _insert_dataframes_in_table(self, tablename, df_list):
+        """Concatenate the dataframes collected during a fetch loop and insert
+        them in the database. Missing dataframes (e.g. from failed requests)
+        are ignored, so that partial batches are still committed. 
+        """
+
+        df_list = [df for df in df_list if df is not None]
+        if not df_list:
+            return 
+
+        self.db.insert_dataframe_in_table(tablename, pd.concat(df_list)) 
+
     def populate_transit_config_tables_from_API(self):
-        """Download all routes, directions and stops data and insert them
-        into the database. 
+        """Download all routes, directions, stops and path data and insert 
+        them into the database. 
+
+        The whole configuration is downloaded first, then written in a single 
+        transaction (see DatabaseWrapper.refresh_tables), so that readers and
+        downstream builders (connections, transit graph) never see a partial 
+        refresh. Directions, stops and paths no longer listed on a downloaded
+        route are removed, while routes which failed to download are left as is.
         """
         # First, collect list of routes for agency. 
         agency_tag = self.db.get_agency_tag() 
@@ -58,35 +140,52 @@ class DataLoader:
                                             response_dict=route_list_response,
                                             agency_tag=agency_tag
                                             )
-        
-        # Insert the list of route tags in the routes table.
-        # This response dataframe only contains partial columns, and
-        # the other columns will be updated as we collect them from
-        # the routeConfig endpoint.
-        self.db.insert_dataframe_in_table("routes", routes_df_dict["routes"])
-
-        # Next we collect the route config info.
-        # We'll update the remaining 'routes' table 
-        # columns, and populate the entire 'directions' & 'stops' tables. 
+
+        # Next we collect the route config info, i.e. the full 'routes' 
+        # table columns and the entire 'directions' & 'stops' tables. 
+        # Routes are requested in batches (up to 100 per call), and each
+        # multi-route response is split back into routes by the parser. 
         route_list = routes_df_dict["routes"].tag.unique()    
+        conf_lists = {"routes": [], "directions": [], "stops": [], "route_paths": []} 
         with self.nextbus_client as client:
-            for route_tag in route_list:   
-
-                route_config_response = client.get_response_dict_from_web(
-                                            endpoint_name="routeConfig",
+            responses = client.get_route_config_response_dicts_from_web(
                                             agency_tag=agency_tag,
-                                            route_tag=route_tag
-                                            ) 
+                                            route_tags=route_list,
+                                            on_error=self._log_api_error
+                                            )
+            for route_config_response in responses:   
 
                 conf = self.parser.parse_route_config_response_into_df_dict(
                                             response_dict=route_config_response,
-                                            route_tag=route_tag,
+                                            route_tag=None,
                                             agency_tag=agency_tag
                                             )
 
-                self.db.update_dataframe_in_table("routes", conf["routes"])
-                self.db.insert_dataframe_in_table("directions", conf["directions"])
-                self.db.insert_dataframe_in_table("stops", conf["stops"]) 
+                for tablename, df_list in conf_lists.items():
+                    if conf[tablename] is not None:
+                        df_list.append(conf[tablename]) 
+
+        # Routes whose config failed to download are left as they are. 
+        conf = {tablename: pd.concat(df_list, ignore_index=True) if df_list else None
+                for tablename, df_list in conf_lists.items()} 
+
+        # Record what changed on the refreshed routes, for the incremental 
+        # connections and transit graph rebuilds (see TransitConfigDiff). 
+        stored = {"directions": self.db.get_directions_dataframe(),
+                  "stops": self.db.get_stops_dataframe()} 
+        diff = TransitConfigDiff.compare(stored, conf) 
+        conf["transit_config_changes"] = diff.changes 
+
+        if self.verbose:
+            print("Refreshing transit config: {} routes, {} directions, {} stops.".format(
+                *[len(conf[tablename]) if conf[tablename] is not None else 0 
+                  for tablename in ["routes", "directions", "stops"]]))
+            print("Transit config changes: {}".format(
+                diff.changes.groupby(["table_name", "change"]).size().to_dict())) 
+
+        self.db.refresh_tables(conf, scope_columns={"directions": "route_tag",
+                                                    "stops": "route_tag",
+                                                    "route_paths": "route_tag"}) 
 
     def populate_schedules_table_from_API(self):
         """Download all schedules tables and insert them into database."""
@@ -97,19 +196,25 @@ class DataLoader:
         with self.nextbus_client as client:
             for route_tag in route_list: 
 
+                # Schedule responses can run to several MB. We decode them
+                # incrementally, flattening each schedule as it is decoded.
                 time_of_extraction = datetime.datetime.now()
-                schedules_response = client.get_response_dict_from_web(
+                schedules = client.iter_response_items_from_web(
                                         endpoint_name="schedule",
+                                        prefix="route.item",
                                         route_tag=route_tag,
                                         agency_tag=agency_tag
                                         )
-
-                df_dict = self.parser.parse_schedule_response_into_df_dict(
-                                        response_dict=schedules_response,
+                try:
+                    df_dict = self.parser.parse_schedules_into_df_dict(
+                                        schedules=schedules,
                                         route_tag=route_tag,
                                         agency_tag=agency_tag,
                                         time_of_extraction=time_of_extraction
                                         )
+                except NextBusAPIError as e:
+                    self._log_api_error(e) 
+                    continue
 
                 self.db.insert_dataframe_in_table(
                                         "schedules", df_dict["schedules"])
@@ -123,10 +228,18 @@ class DataLoader:
         df_list = []
         with self.nextbus_client as client:
             for route_tag in route_list:
-                df_vehicles_on_route = self._fetch_vehicle_location_on_route_df(
-                    route_tag, agency_tag, client)
+                try:
+                    df_vehicles_on_route = self._fetch_vehicle_location_on_route_df(
+                        route_tag, agency_tag, client)
+                except NextBusAPIError as e:
+                    self._log_api_error(e) 
+                    continue
 
                 df_list.append(df_vehicles_on_route)
+
+        df_list = [df for df in df_list if df is not None]
+        if not df_list:
+            return 
         df_active_vehicles = pd.concat(df_list)  
 
         df_active_vehicles["agency_tag"] = agency_tag
@@ -162,16 +275,235 @@ class DataLoader:
         vehicle_ids = self.db.get_active_vehicle_ids(
             agency_tag, active_over_num_days)
 
+        time_of_fetch = datetime.datetime.now() 
         df_list = [] 
         with self.nextbus_client as client:
             for vehicle_id in vehicle_ids:
-                df_vehicle = self._fetch_vehicle_location_df(
-                    agency_tag, vehicle_id, client) 
+                try:
+                    df_vehicle = self._fetch_vehicle_location_df(
+                        agency_tag, vehicle_id, client) 
+                except NextBusAPIError as e:
+                    self._log_api_error(e) 
+                    continue
 
                 df_list.append(df_vehicle)
-        df_vehicle_locations = pd.concat(df_list) 
 
-        self.db.insert_dataframe_in_table("vehicle_locations", df_vehicle_locations)
+        df_list = [df for df in df_list if df is not None]
+        if not df_list:
+            return 
+        df_locations = pd.concat(df_list) 
+
+        self._store_vehicle_locations(df_locations)
+        self._record_vehicle_locations_quality(df_locations, time_of_fetch) 
+
+    def run_collection_cycle(self, max_report_age_seconds=300):
+        """Fetch the current location of all vehicles active on a route, 
+        with one request per route, and store them both as vehicle locations
+        and as the vehicles' last seen time.
+
+        This replaces fetch_active_vehicles_snapshop_from_API followed by 
+        fetch_vehicle_locations_from_API: a vehicle is tracked as soon as 
+        it reports on a route, and no request is spent on inactive vehicles.
+
+        All readings are kept, however old: one repeated from a previous 
+        cycle is skipped by the recent keys filter or updated in place by 
+        the upsert on its key, while one missed by a failed request or 
+        before the first cycle is stored. 
+
+        Args:
+            max_report_age_seconds (int, optional): Readings reported longer 
+                                                    ago are counted as stale,
+                                                    and the recent keys are 
+                                                    seeded over this age. 
+                                                    Defaults to 300.
+        """
+
+        agency_tag = self.db.get_agency_tag() 
+        route_list = self.db.get_route_list(agency_tag)   
+
+        time_of_cycle = datetime.datetime.now() 
+        df_list = []
+        with self.nextbus_client as client:
+            for route_tag in route_list:
+                try:
+                    df_vehicles_on_route = self._fetch_vehicle_location_on_route_df(
+                        route_tag, agency_tag, client)
+                except NextBusAPIError as e:
+                    self._log_api_error(e) 
+                    continue
+
+                df_list.append(df_vehicles_on_route)
+
+        df_list = [df for df in df_list if df is not None]
+        if not df_list:
+            return 
+        df_batch = pd.concat(df_list, ignore_index=True) 
+
+        df_locations = df_batch.drop_duplicates(subset="key", keep="last") 
+        if not df_locations.empty:
+            self._store_collection_cycle(df_locations, num_routes=len(df_list),
+                                         max_report_age_seconds=max_report_age_seconds) 
+
+        self._record_vehicle_locations_quality(df_batch, time_of_cycle, 
+                                               max_report_age_seconds) 
+
+        if self.anomaly_detector is not None:
+            self._detect_anomalies(df_locations, time_of_cycle) 
+
+    def _store_collection_cycle(self, df_locations, num_routes, max_report_age_seconds=300):
+        """Helper function to run_collection_cycle. Store the readings of a 
+        cycle, and the vehicles' last seen time."""
+
+        if self.verbose:
+            print(f"Collected {len(df_locations)} readings on {num_routes} routes.")
+
+        # Vehicles last seen time, from their latest reading. 
+        df_vehicles = df_locations.sort_values("read_time") \
+                                  .drop_duplicates(subset="id", keep="last") 
+        df_vehicles = df_vehicles[["id", "read_time", "agency_tag"]].rename(
+                                  columns={"read_time": "last_seen_active"}) 
+        self.db.insert_dataframe_in_table("vehicles", df_vehicles) 
+
+        self._store_vehicle_locations(df_locations, max_report_age_seconds) 
+
+    def _detect_anomalies(self, df_locations, time_of_cycle):
+        """Helper function to run_collection_cycle. Feed the readings of a 
+        cycle to the anomaly detector, and store the slowdowns detected."""
+
+        self.anomaly_detector.add_vehicle_locations(df_locations) 
+        df_anomalies = self.anomaly_detector.detect(
+                            detected_at=time_of_cycle.replace(microsecond=0)) 
+        self.db.upsert_dataframe_in_table("anomalies", df_anomalies) 
+
+        if self.verbose:
+            print(f"Detected {len(df_anomalies)} anomalies.")
+
+    def _record_vehicle_locations_quality(self, df_locations, time_of_extraction,
+                                          max_report_age_seconds=300):
+        """Add the data quality counts of a batch of vehicle locations, before
+        any filtering, to the hourly vehicle_locations_quality table. See 
+        data_quality.VehicleLocationsQuality. Called once the readings are
+        stored: counters are best effort, and their errors are only reported.
+
+        Args:
+            df_locations (dataframe): Batch of vehicle locations.
+            time_of_extraction (datetime): Time at which the batch was collected.
+            max_report_age_seconds (int, optional): Readings reported longer
+                                                    ago are counted as stale.
+                                                    Defaults to 300.
+        """
+        try:
+            if self.quality is None:
+                self.quality = VehicleLocationsQuality.from_database(self.db) 
+            self.quality.max_report_age_seconds = max_report_age_seconds 
+
+            df_counts = self.quality.get_counts_df(df_locations, time_of_extraction) 
+            self.db.add_vehicle_locations_quality(df_counts) 
+
+        except Exception as e:
+            if self.db.session is not None:
+                self.db.session.rollback() 
+            if self.verbose:
+                print(f"Failed to record data quality counts ~ {e}")
+            return 
+
+        if self.verbose:
+            counts = df_counts.iloc[0] 
+            print("Batch quality: {} stale, {} out of bounds, {} duplicate keys, "
+                  "{} missing direction tags.".format(
+                    counts.stale_readings, counts.out_of_bbox, 
+                    counts.duplicate_keys, counts.direction_tag_null))
+
+    def _store_vehicle_locations(self, df_locations, max_report_age_seconds=300):
+        """Insert a batch of vehicle locations in the tables of the storage 
+        layout in use, and refresh the hourly rollup for the hours touched. 
+
+        Readings whose key was written recently, e.g. repeated by vehicles 
+        which have not reported since the last poll, are dropped first. A 
+        fresh process seeds these keys over the last max_report_age_seconds.
+        """
+
+        self._seed_recent_keys(num_seconds=max_report_age_seconds) 
+        num_dropped = self.recent_keys.num_dropped 
+        df_locations = df_locations[self.recent_keys.is_new(df_locations["key"])] 
+
+        if self.verbose:
+            print("Skipped {} repeated readings ({} of {} since start).".format(
+                    self.recent_keys.num_dropped - num_dropped, 
+                    self.recent_keys.num_dropped, self.recent_keys.num_checked))
+
+        if df_locations.empty:
+            return 
+
+        if self.route_index is not None:
+            df_locations = self._check_vehicle_locations_routes(df_locations) 
+
+        if self.vehicle_locations_layout in ("legacy", "both"):
+            self.db.insert_dataframe_in_table("vehicle_locations", df_locations) 
+
+        if self.vehicle_locations_layout in ("compact", "both"):
+            self.db.insert_vehicle_locations_compact(df_locations) 
+
+        self.recent_keys.add(df_locations["key"]) 
+
+        self.db.refresh_vehicle_locations_hourly(
+                    hours=pd.to_datetime(df_locations["read_time"]).dropna(),
+                    source=self.get_vehicle_locations_source_table()) 
+
+    def _check_vehicle_locations_routes(self, df_locations):
+        """Helper function to _store_vehicle_locations. Repair missing tags and
+        record off route readings, see load_route_index."""
+
+        df_locations, num_repaired = self.route_index.repair_tags(df_locations) 
+        is_off_route, _ = self.route_index.get_off_route_mask(df_locations) 
+
+        df_off_route = df_locations.loc[is_off_route, ["key", "id", "route_tag", "direction_tag",
+                                                       "lat", "lon", "read_time"]] 
+        self.db.insert_dataframe_in_table("off_route_readings", df_off_route) 
+
+        if self.verbose:
+            print(f"Repaired tags of {num_repaired} readings, {len(df_off_route)} off route.")
+
+        return df_locations 
+
+    def _seed_recent_keys(self, num_seconds=300):
+        """Helper function to _store_vehicle_locations. On first use, fill the
+        recent keys filter with the keys of the readings of the last 
+        num_seconds, so that a fresh process (e.g. a cron job) also skips 
+        repeats of readings stored by previous runs. Only the keys are read, 
+        over the age of the readings still reported; older repeats are rare, 
+        and left to the upsert."""
+
+        if self.recent_keys_seeded:
+            return 
+
+        since = datetime.datetime.now() - datetime.timedelta(seconds=num_seconds) 
+        self.recent_keys.add(self.db.get_vehicle_location_keys_since(
+                    since, source=self.get_vehicle_locations_source_table())) 
+
+        self.recent_keys_seeded = True 
+
+    def get_vehicle_locations_source_table(self):
+        """Get the table holding the full vehicle locations history, given 
+        the storage layout in use."""
+
+        if self.vehicle_locations_layout == "compact":
+            return "vehicle_locations_compact"
+        return "vehicle_locations"
+
+    def refresh_vehicle_locations_hourly_rollup(self, num_days=7):
+        """Rebuild the vehicle_locations_hourly rollup over the last num_days, 
+        e.g. to backfill it from existing vehicle locations. 
+        """
+        end_time = datetime.datetime.now() 
+        start_time = end_time - datetime.timedelta(days=num_days) 
+        hours = pd.date_range(start_time, end_time, freq="H") 
+
+        if self.verbose:
+            print(f"Refreshing hourly rollup over {len(hours)} hours.")
+
+        self.db.refresh_vehicle_locations_hourly(
+                    hours=hours, source=self.get_vehicle_locations_source_table())
 
     def _fetch_vehicle_location_df(self, agency_tag, vehicle_id, client):
         """Fetch current location data for a specific vehicle.""" 
@@ -204,16 +536,53 @@ class DataLoader:
         df_list = [] 
         with self.nextbus_client as client:
             for vehicle_id in vehicle_ids:
-                df_vehicle = self._fetch_vehicle_location_df(
-                    agency_tag, vehicle_id, client) 
+                try:
+                    df_vehicle = self._fetch_vehicle_location_df(
+                        agency_tag, vehicle_id, client) 
+                except NextBusAPIError as e:
+                    self._log_api_error(e) 
+                    continue
+
                 df_list.append(df_vehicle)
 
-        df_vehicle_locations = pd.concat(df_list) 
-        self.db.insert_dataframe_in_table(
-            "vehicle_locations_validation", df_vehicle_locations)
+        self._insert_dataframes_in_table("vehicle_locations_validation", df_list)
+
+    def fetch_predictions_from_API(self):
+        """Fetch the agency's arrival predictions for all stops, and insert 
+        them in the predictions table. 
+
+        Stops are polled route by route with the predictionsForMultiStops 
+        endpoint, packing up to 150 stops per request. Covering the whole 
+        network therefore costs about one request per route. 
+        """
+        agency_tag = self.db.get_agency_tag() 
+        df_route_stops = self.db.get_route_stop_tags_dataframe(agency_tag) 
+
+        df_list = [] 
+        with self.nextbus_client as client:
+            for route_tag, df_stops in df_route_stops.groupby("route_tag"):
+
+                time_of_extraction = datetime.datetime.now() 
+                responses = client.get_predictions_response_dicts_from_web(
+                                        agency_tag=agency_tag,
+                                        route_tag=route_tag,
+                                        stop_tags=df_stops.stop_tag.unique(),
+                                        on_error=self._log_api_error
+                                        )
+
+                for response_dict in responses: 
+                    df_dict = self.parser.parse_predictions_response_into_df_dict(
+                                        response_dict=response_dict,
+                                        agency_tag=agency_tag,
+                                        time_of_extraction=time_of_extraction
+                                        )
+                    df_list.append(df_dict["predictions"])
+
+        self._insert_dataframes_in_table("predictions", df_list)
 
     def delete_old_vehicle_locations_entries(self, keep_num_days=7):
-        """Delete all vehicle location entries outside of retention period."""
+        """Delete all vehicle location entries outside of retention period, 
+        from the tables of the storage layout in use."""
 
         today = datetime.datetime.today().replace(
                         hour=0, minute=0, second=0, microsecond=0)
@@ -221,8 +590,12 @@ class DataLoader:
         days_kept_before_today = keep_num_days - 1
         first_date_kept = (today - datetime.timedelta(days=days_kept_before_today)).strftime("%Y-%m-%d")
 
-        self.db.session.execute(f"DELETE FROM vehicle_locations WHERE read_time < '{first_date_kept}'")
-        self.db.session.commit() 
+        if self.vehicle_locations_layout in ("legacy", "both"):
+            self.db.delete_vehicle_locations_before(first_date_kept) 
+
+        if self.vehicle_locations_layout in ("compact", "both"):
+            self.db.delete_vehicle_locations_before(
+                        first_date_kept, source="vehicle_locations_compact") 
 
 
 class DataPreparation:
@@ -231,26 +604,49 @@ class DataPreparation:
         self.db = db 
         self.session = session
 
-    def populate_connections_table(self):
+    def populate_connections_table(self, incremental=False):
         """Cluster nearby stops within a fixed distance. This distance can be
         adjusted within the transit config file. 
 
         Stop pairs are inserted in the database (in both directions) along with
         their latitude, longitude coordinates and the direction they're on. 
+
+        Args:
+            incremental (bool, optional): Only rebuild the connections of the
+                                          stops added, removed or moved by the
+                                          transit config changes not applied 
+                                          yet (see TransitConfigDiff). Defaults
+                                          to False, building all connections.
         """
 
         # First fetch the cluster max distance from a flat file. 
-        cluster_distance = None   
         config = get_transit_config() 
         cluster_distance = config["connections_cluster_max_distance_meters"]     
 
-        # Then build and insert connections table. 
-        df_connections = self._build_connections_df_from_database(
-                                        cluster_distance=cluster_distance) 
-
-        self.db.insert_dataframe_in_table("connections", df_connections)  
+        # Changes detected up to now are applied by this build. 
+        until = datetime.datetime.now() 
 
-    def _build_connections_df_from_database(self, cluster_distance):
+        if not incremental:
+            df_connections = self._build_connections_df_from_database(
+                                        cluster_distance=cluster_distance) 
+            self.db.insert_dataframe_in_table("connections", df_connections)  
+            self.db.mark_transit_config_changes_applied("connections", until=until) 
+            return 
+
+        # Rebuild the connections touching stops which moved, appeared or 
+        # disappeared. Other stop pairs are unchanged. 
+        diff = TransitConfigDiff(self.db.get_pending_transit_config_changes("connections")) 
+        stop_tags = diff.get_moved_stop_tags() 
+        if stop_tags:
+            df_connections = self._build_connections_df_from_database(
+                                        cluster_distance=cluster_distance,
+                                        stop_tags=stop_tags) 
+            self.db.replace_rows("connections", df_connections, deletes=[
+                ("delete_connections_of_stops", {"stop_tags": stop_tags})]) 
+
+        self.db.mark_transit_config_changes_applied("connections", until=until) 
+
+    def _build_connections_df_from_database(self, cluster_distance, stop_tags=None):
         """Assemble the connections dataframe from the stops table.
         Helper function for population_connections_table. 
 
@@ -266,6 +662,9 @@ class DataPreparation:
 
         Args:
             cluster_distance (float): Maximal meter distance between pairs.
+            stop_tags (List[str], optional): Only build the pairs involving 
+                                             these stops, in both directions.
+                                             Defaults to all stops.
 
         Returns:
             df: Dataframe to be inserted in 'connections' table.
@@ -283,122 +682,57 @@ class DataPreparation:
         }
         agency_tag = self.db.get_agency_tag() 
         stops_df = self.db.get_stop_coords_dataframe(agency_tag=agency_tag) 
-
-        # Algorithm: Neighborhood Search 
-        # 0. First, stops_df already comes sorted by lat, then lon values.
-        # 1. Find a threshold value so that latitude differences above that 
-        #    threshold are guaranteed to be > cluster_distance away. Do 
-        #    the same for longitude.   
-        # 2. For stop in list: 
-        #       - find all stops within [lat += lat_thresh, lon += lon_thresh]
-        #       - test whether within cluster distance
-        #       - add to list of pairs 
-        df_pairs_list = [] 
-        stops = stops_df.tag.unique() 
-
-        # 1. Find lat_threshold and lon_threshold to form neighborhoods. 
-        #    - Start them at initial values of 0.0001 (testing shows this is ~10m);
-        #    - For each threshold value, go through list of points p and test whether
-        #      p +- threshold_value are both > cluster_distance;
-        #    - If not, increment value. 
-        # 
-        #    This guarantees the following property at the end: 
-        #    For any stop p, all other stops p' within cluster_distance 
-        #    are within [p += lat_thresh, p+= lon_thresh]. 
-        lat_thresh = 0.0001   
-        lon_thresh = 0.0001 
-        increment = 0.0001 
-
-        # TODO (Future): Do both steps in one pass. 
-        # Find proper lat_thresh value. 
-        for stop in stops: 
-            lat = stops_df.loc[stops_df.tag==stop, "lat"].values[0] 
-            lon = stops_df.loc[stops_df.tag==stop, "lon"].values[0]  
-            p = (lat,lon)   
-
-            p_plus = (p[0] + lat_thresh, p[1]) 
-            p_minus = (p[0] - lat_thresh, p[1])  
-            dist_plus = calculate_distance_from_lat_lon_coords(p, p_plus) 
-            dist_minus = calculate_distance_from_lat_lon_coords(p, p_minus) 
-
-            dist = min(dist_plus, dist_minus) 
-
-            # Increment threshold value as needed. 
-            while dist <= cluster_distance:  
-                lat_thresh += increment 
-
-                p_plus = (p[0] + lat_thresh, p[1]) 
-                p_minus = (p[0] - lat_thresh, p[1])  
-                dist_plus = calculate_distance_from_lat_lon_coords(p, p_plus) 
-                dist_minus = calculate_distance_from_lat_lon_coords(p, p_minus) 
-
-                dist = min(dist_plus, dist_minus) 
-
-        # Repeat for lon_thresh value. 
-        for stop in stops: 
-            lat = stops_df.loc[stops_df.tag==stop, "lat"].values[0] 
-            lon = stops_df.loc[stops_df.tag==stop, "lon"].values[0]  
-            p = (lat,lon)   
-
-            p_plus = (p[0], p[1] + lon_thresh) 
-            p_minus = (p[0], p[1] - lon_thresh)  
-            dist_plus = calculate_distance_from_lat_lon_coords(p, p_plus) 
-            dist_minus = calculate_distance_from_lat_lon_coords(p, p_minus) 
-
-            dist = min(dist_plus, dist_minus) 
-
-            # Increment threshold value as needed. 
-            while dist <= cluster_distance:  
-                lon_thresh += increment  
-
-                p_plus = (p[0] + lon_thresh, p[1]) 
-                p_minus = (p[0] - lon_thresh, p[1])  
-                dist_plus = calculate_distance_from_lat_lon_coords(p, p_plus) 
-                dist_minus = calculate_distance_from_lat_lon_coords(p, p_minus) 
-
-                dist = min(dist_plus, dist_minus) 
-
-
-        # 2. For each stop in list, search its neighborhood for nearby stops.
-        for stop1 in stops:
-
-            lat1 = stops_df.loc[stops_df.tag==stop1, "lat"].values[0]
-            lon1 = stops_df.loc[stops_df.tag==stop1, "lon"].values[0]
-            p1 = (lat1, lon1) 
-
-            condition = (
-                         (stops_df.lat.between(lat1-lat_thresh, lat1+lat_thresh)) 
-                        &(stops_df.lon.between(lon1-lon_thresh, lon1+lon_thresh))
-                        )  
-            nhbd = stops_df[condition].tag.unique() 
-
-            # Remove stop1 from its own neighborhood. 
-            # We don't want it in the search area. 
-            nhbd = [x for x in nhbd if x != stop1] 
-
-            for stop2 in nhbd:  
-
-                lat2 = stops_df.loc[stops_df.tag==stop2, "lat"].values[0]
-                lon2 = stops_df.loc[stops_df.tag==stop2, "lon"].values[0]
-                p2 = (lat2, lon2)     
-
-                dist = calculate_distance_from_lat_lon_coords(p1, p2)
-                if dist <= cluster_distance: 
-
-                    data =  {
-                        "key": "_".join([stop1, stop2]), 
-                        "stop1": stop1,
-                        "lat1": lat1,
-                        "lon1": lon1,
-                        "stop2": stop2, 
-                        "lat2": lat2,
-                        "lon2": lon2,   
-                        "distance_meters": dist 
-                    }
-                    df_pairs_list.append(pd.DataFrame(data, index=[0])) 
-
-
-        df_connections = pd.concat(df_pairs_list)  
+        stops_df = stops_df.drop_duplicates(subset="tag").reset_index(drop=True) 
+
+        sources_df = stops_df if stop_tags is None else stops_df[stops_df.tag.isin(stop_tags)] 
+        if sources_df.empty:
+            return pd.DataFrame(columns=list(connections_types)).astype(connections_types) 
+
+        # Algorithm: Grid Neighborhood Search 
+        # 1. Bin stops into grid cells at least cluster_distance wide in both
+        #    latitude and longitude (longitude degrees shrink away from the 
+        #    equator, so the cells are sized at the largest latitude). Then all
+        #    stops within cluster_distance of a stop are in its cell or one of 
+        #    the 8 cells around it. 
+        # 2. Pair each stop with the stops of these 9 cells, by joining on the
+        #    cell shifted each way, and keep pairs within cluster_distance. 
+        meters_per_degree = 6373000 * np.pi / 180     # Earth's radius as in utils.distances
+        lat_step = 1.1 * cluster_distance / meters_per_degree   # with a safety margin
+        lon_step = lat_step / np.cos(np.radians(np.abs(stops_df.lat).max())) 
+
+        stops_df = stops_df.assign(cell_lat=np.floor(stops_df.lat / lat_step).astype(int),
+                                   cell_lon=np.floor(stops_df.lon / lon_step).astype(int))
+        sources_df = stops_df.loc[sources_df.index] 
+
+        shifted_df = pd.concat([sources_df.assign(cell_lat=sources_df.cell_lat + dlat,
+                                                  cell_lon=sources_df.cell_lon + dlon)
+                                for dlat in (-1, 0, 1) for dlon in (-1, 0, 1)])
+        pairs_df = pd.merge(shifted_df, stops_df, on=["cell_lat", "cell_lon"], 
+                            suffixes=("1", "2")) 
+        pairs_df = pairs_df[pairs_df.tag1 != pairs_df.tag2] 
+
+        pairs_df = pairs_df.assign(distance_meters=calculate_distances_from_lat_lon_arrays(
+            pairs_df.lat1, pairs_df.lon1, pairs_df.lat2, pairs_df.lon2)) 
+        pairs_df = pairs_df[pairs_df.distance_meters <= cluster_distance] 
+
+        # Pairs are found from both ends when building all connections. 
+        # Otherwise add the reverse of the pairs found from the given stops.
+        if stop_tags is not None:
+            reverse_df = pairs_df.rename(columns={"tag1": "tag2", "lat1": "lat2", "lon1": "lon2",
+                                                  "tag2": "tag1", "lat2": "lat1", "lon2": "lon1"})
+            pairs_df = pd.concat([pairs_df, reverse_df]).drop_duplicates(subset=["tag1", "tag2"]) 
+
+        df_connections = pd.DataFrame({
+            "key": pairs_df.tag1 + "_" + pairs_df.tag2,
+            "stop1": pairs_df.tag1,
+            "lat1": pairs_df.lat1,
+            "lon1": pairs_df.lon1,
+            "stop2": pairs_df.tag2,
+            "lat2": pairs_df.lat2,
+            "lon2": pairs_df.lon2,
+            "distance_meters": pairs_df.distance_meters
+        }) 
+        df_connections.sort_values("key", inplace=True) 
         df_connections.reset_index(drop=True, inplace=True) 
 
         # Type validation and conversion 
@@ -406,27 +740,91 @@ class DataPreparation:
 
         return df_connections
 
-    def populate_transit_graph_table(self):
+    def compile_connection_timetables(self, path):
+        """Compile the schedules of each service class into a timetable of 
+        elementary connections, saved in a subdirectory of path named after 
+        the service class (see connection_scan.ConnectionTimetable). 
+
+        Args:
+            path (str): Directory of the timetables. 
+        """
+        for service_class in self.db.get_service_classes():
+            timetable = ConnectionTimetable.from_database(self.db, service_class)
+            timetable.save(os.path.join(path, service_class)) 
+
+    def compile_route_geometry(self, path, tolerance_meters=5.0):
+        """Simplify the paths of each direction into a polyline with cumulative
+        distances, saved as <direction_tag>.npz files in path (see 
+        route_geometry.RouteGeometry). 
+
+        Args:
+            path (str): Directory of the geometry. 
+            tolerance_meters (float, optional): Douglas-Peucker tolerance. 
+                                                Defaults to 5 meters.
+        """
+        geometry = RouteGeometry.from_database(self.db, tolerance_meters=tolerance_meters)
+        geometry.save(path) 
+
+    def populate_transit_graph_table(self, incremental=False):
         """Assemble the transit graph table from the stops and connections table.
         
         We construct a directed graph with the following types of edges:
             - consecutive stops on a direction;
             - stops in a connection.
+
+        Args:
+            incremental (bool, optional): Only rebuild the edge chains of the 
+                                          directions whose stops changed, and 
+                                          the connection edges of the stops 
+                                          which moved, from the transit config
+                                          changes not applied yet (see 
+                                          TransitConfigDiff). Connections 
+                                          should be rebuilt first. Defaults to
+                                          False, building the whole graph.
         """
 
-        # For each direction, build an edge dataframe and insert into db.
-        agency_tag = self.db.get_agency_tag() 
-        direction_tags = self.db.get_direction_list(agency_tag=agency_tag) 
+        # Changes detected up to now are applied by this build. 
+        until = datetime.datetime.now() 
+
+        if not incremental:
+            # For each direction, build an edge dataframe and insert into db.
+            agency_tag = self.db.get_agency_tag() 
+            direction_tags = self.db.get_direction_list(agency_tag=agency_tag) 
+
+            for tag in direction_tags: 
+
+                df_direction_edges = self._build_direction_edges_df_from_database(
+                                                                    direction_tag=tag)  
+
+                self.db.insert_dataframe_in_table("transit_graph", df_direction_edges) 
 
-        for tag in direction_tags: 
+            # Transfer the connections table, adding the is_connection attribute. 
+            self._add_connections_to_transit_graph_table() 
+            self.db.mark_transit_config_changes_applied("graph", until=until) 
+            return 
 
-            df_direction_edges = self._build_direction_edges_df_from_database(
-                                                                direction_tag=tag)  
+        diff = TransitConfigDiff(self.db.get_pending_transit_config_changes("graph")) 
 
-            self.db.insert_dataframe_in_table("transit_graph", df_direction_edges) 
+        # Rebuild the edge chains of directions whose sequence of stops 
+        # changed. Removed directions are left without edges. 
+        direction_tags = diff.get_rechained_direction_tags() 
+        if direction_tags:
+            df_direction_edges = pd.concat([
+                self._build_direction_edges_df_from_database(direction_tag=tag)
+                for tag in direction_tags], ignore_index=True) 
+            self.db.replace_rows("transit_graph", df_direction_edges, deletes=[
+                ("delete_transit_graph_directions", {"direction_tags": direction_tags})]) 
 
-        # Transfer the connections table, adding the is_connection attribute. 
-        self._add_connections_to_transit_graph_table() 
+        # Replace the connection edges of stops which moved. 
+        stop_tags = diff.get_moved_stop_tags() 
+        if stop_tags:
+            df_connection_edges = self._build_connection_edges_df_from_database(
+                                                                stop_tags=stop_tags) 
+            self.db.replace_rows("transit_graph", df_connection_edges, deletes=[
+                ("delete_transit_graph_connections_of_stops", 
+                 {"stop_tags": stop_tags, "true": True})]) 
+
+        self.db.mark_transit_config_changes_applied("graph", until=until) 
 
     def _build_direction_edges_df_from_database(self, direction_tag):
         """Construct part of the transit directed graph associated to a direction.
@@ -453,7 +851,7 @@ class DataPreparation:
         """
 
         agency_tag = self.db.get_agency_tag()
-        stops_df = self.db.get_stops_on_direction_dataframe(
+        stops_df = self.db.get_stops_along_direction_dataframe(
                                             direction_tag=direction_tag,
                                             agency_tag=agency_tag
                                             )
@@ -467,34 +865,43 @@ class DataPreparation:
             "direction_tag": "str" 
         }
 
-        rows = [] 
-        num_stops = stops_df.shape[0]  
-        for n in range(1, num_stops): 
-
-            stop = stops_df.loc[stops_df.stop_along_direction==n,"stop_tag"].values[0]
-            next_stop = stops_df.loc[stops_df.stop_along_direction==n+1,"stop_tag"].values[0]
-
-            data = {}  
-            data["stop_tag1"] = stop
-            data["stop_tag2"] = next_stop  
-            data["key"] = "_".join([stop, next_stop, direction_tag])
-            data["direction_tag"] = direction_tag 
+        # Pair each stop with the next one along the direction. 
+        stop_tags = stops_df.sort_values("stop_number").stop_tag.astype(str).to_numpy() 
+        df_direction_edges = pd.DataFrame({"stop_tag1": stop_tags[:-1], 
+                                           "stop_tag2": stop_tags[1:]}, dtype=object) 
+        df_direction_edges["key"] = (df_direction_edges.stop_tag1 + "_" 
+                                     + df_direction_edges.stop_tag2 + "_" + direction_tag) 
+        df_direction_edges["direction_tag"] = direction_tag 
 
-            rows.append(data) 
-
-        df_direction_edges = pd.DataFrame(rows) 
         df_direction_edges = self._trim_stop_tags(df_direction_edges) 
         df_direction_edges = df_direction_edges.astype(direction_edges_types)
 
-        return df_direction_edges 
+        return df_direction_edges[list(direction_edges_types)] 
 
     def _add_connections_to_transit_graph_table(self):
         """Add all transit graph edges coming from connections.
         """
+        df = self._build_connection_edges_df_from_database() 
+        self.db.insert_dataframe_in_table("transit_graph", df) 
+
+    def _build_connection_edges_df_from_database(self, stop_tags=None):
+        """Construct the transit graph edges coming from connections.
+
+        Args:
+            stop_tags (List[str], optional): Only build the edges involving 
+                                             these stops. Defaults to all.
+
+        Returns:
+            dataframe: Dataframe with key, stop_tag1, stop_tag2, node1, node2, 
+                       is_connection columns. 
+        """
 
         # Each connection gives a pair of directed edges in the transit graph.
         # We identify which ones come from such a connection.
         connections_df = self.db.get_connections_dataframe() 
+        if stop_tags is not None:
+            connections_df = connections_df[connections_df.stop1.isin(stop_tags)
+                                            | connections_df.stop2.isin(stop_tags)].copy() 
         connections_df["is_connection"] = True
 
         # Some stop tags have additional endings (i.e. 1000 vs 1000_ar).
@@ -505,9 +912,8 @@ class DataPreparation:
             inplace=True) 
         connections_df = self._trim_stop_tags(connections_df)  
 
-        df = connections_df[["key", "stop_tag1", "stop_tag2", 
-                             "node1", "node2", "is_connection"]]  
-        self.db.insert_dataframe_in_table("transit_graph", df) 
+        return connections_df[["key", "stop_tag1", "stop_tag2", 
+                               "node1", "node2", "is_connection"]]  
 
     def _trim_stop_tags(self, df):
         """Helper function. Used when assembling the transit graph from stops data.
@@ -519,24 +925,99 @@ class DataPreparation:
         the same stop), we remove them when considering stops as nodes in our graph. 
         """
 
-        df["node1"] = df["stop_tag1"].str.replace("_IB","").str.replace("_OB","").str.replace("_ar","")
-        df["node2"] = df["stop_tag2"].str.replace("_IB","").str.replace("_OB","").str.replace("_ar","")
+        df["node1"] = trim_stop_tags(df["stop_tag1"])
+        df["node2"] = trim_stop_tags(df["stop_tag2"])
 
         return df 
 
-    def get_predicted_times_at_stops_df(self):
+    def update_transit_statistics(self, left=None, right=None, geometry_path=None):
+        """Fold the trips ending in [left, right) into the travel time 
+        distributions of the segment_time_distributions table. 
+
+        Since trips are partitioned by their end time, running this over 
+        consecutive intervals counts each trip exactly once. Defaults to the 
+        last complete hour. 
+
+        Args:
+            left (datetime, optional): Lower bound for the trips' end time.
+            right (datetime, optional): Upper bound for the trips' end time.
+            geometry_path (str, optional): Directory of the route geometry 
+                                           (see compile_route_geometry). When
+                                           given, times at stops are map 
+                                           matched instead of regressed. 
+        """
+
+        if right is None:
+            right = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+        if left is None:
+            left = right - datetime.timedelta(hours=1) 
+
+        if geometry_path is None:
+            times_df = self.get_predicted_times_at_stops_df(left, right) 
+        else:
+            times_df = self.get_map_matched_times_at_stops_df(
+                            left, right, geometry=RouteGeometry.load(geometry_path)) 
+        if times_df is None:
+            return 
+
+        stats = TransitStatistics(self.db) 
+        df_segments = stats.get_segment_times_df(times_df) 
+        stats.load(hours_of_week=df_segments.hour_of_week.unique())
+        stats.add_segment_times(df_segments) 
+        stats.save() 
+
+    def detect_anomalies(self, source="vehicle_locations"):
+        """Compare live segment travel times over the last few collection 
+        cycles to their historical distributions, and record slowdowns in 
+        the anomalies table. Meant to run right after each collection cycle,
+        from a separate process.
+
+        Each run starts a fresh detector and replays the readings of its 
+        window. A long running collection process should rather keep its 
+        detector, see DataLoader.load_anomaly_detector. 
+
+        Args:
+            source (str, optional): Table of vehicle readings, either 
+                                    'vehicle_locations' or 
+                                    'vehicle_locations_compact'.
+                                    Defaults to 'vehicle_locations'.
+
+        Returns:
+            dataframe: Anomalies detected, in the format of the anomalies table.
+        """
+
+        now = datetime.datetime.now().replace(microsecond=0) 
+        detector = AnomalyDetector.from_database(self.db, source=source, now=now)
+        df_anomalies = detector.detect(detected_at=now) 
+        self.db.upsert_dataframe_in_table("anomalies", df_anomalies) 
+
+        return df_anomalies 
+
+    def get_predicted_times_at_stops_df(self, left, right):
+        """Predict the time of visit at each stop on the trips ending in 
+        [left, right), by regressing the trip's read times on its locations.
 
-        trips_df = self._load_daily_trips_data()
+        Args:
+            left (datetime): Lower bound for the trips' end time.
+            right (datetime): Upper bound for the trips' end time.
+
+        Returns:
+            dataframe: Times at stops with columns stop_tag, lat, lon, 
+                       stop_order, read_time, vehicle_id, direction_tag, 
+                       trip_id, or None if there are no trips. 
+        """
+
+        trips_df = self._load_trips_data(left, right)
         stops_df = self._load_stops_data()
 
         # We use a simple knn as regressor. 
         knn = KNeighborsRegressor(n_neighbors=3, p=1, weights="distance")
 
         df_list = []  
-        groups = trips_df.groupby(["vehicle_id", "direction_tag", "trip_number"])
+        groups = trips_df.groupby(["vehicle_id", "direction_tag", "trip_id"])
         for name, group_df in groups: 
 
-            vehicle_id, direction_tag, trip_number = name
+            vehicle_id, direction_tag, trip_id = name
             group_stops_df = stops_df[stops_df.direction_tag==direction_tag]
 
             try:
@@ -546,7 +1027,7 @@ class DataPreparation:
                 knn.fit(X, y)  
 
                 # Then predict time-of-visit at stops. 
-                times_df = group_stops_df[["lat", "lon", "stop_order"]]
+                times_df = group_stops_df[["stop_tag", "lat", "lon", "stop_order"]].copy()
 
                 X_new = group_stops_df[["lat", "lon"]]  
                 times_df["read_time"] = knn.predict(X_new) 
@@ -555,7 +1036,7 @@ class DataPreparation:
                 # Tag the trip. 
                 times_df["vehicle_id"] = vehicle_id
                 times_df["direction_tag"] = direction_tag
-                times_df["trip_number"] = trip_number 
+                times_df["trip_id"] = trip_id 
 
                 df_list.append(times_df) 
 
@@ -564,27 +1045,49 @@ class DataPreparation:
 
         return pd.concat(df_list) if df_list else None
 
-    def _load_daily_trips_data(self):
-        """Load daily vehicle locations data, prepared and segmented by trips."""
+    def get_map_matched_times_at_stops_df(self, left, right, geometry):
+        """Interpolate the time of visit at each stop on the trips ending in 
+        [left, right), from the trip's readings map matched onto the geometry
+        of its direction (see map_matching.MapMatcher). Stops outside the 
+        stretch of a trip are left out. 
+
+        Args:
+            left (datetime): Lower bound for the trips' end time.
+            right (datetime): Upper bound for the trips' end time.
+            geometry (RouteGeometry): Polylines of the directions. 
 
-        queries = get_queries_path() 
-        sql_file = f"{queries}/preparation_for_time_prediction_at_stops.sql"
+        Returns:
+            dataframe: Times at stops, in the format of 
+                       get_predicted_times_at_stops_df, or None if there are 
+                       no trips. 
+        """
+
+        trips_df = self._load_trips_data(left, right)
+        stops_df = self._load_stops_data()
+
+        matcher = MapMatcher(geometry) 
+        return matcher.get_times_at_stops_df(trips_df, stops_df) 
+
+    def _load_trips_data(self, left, right, offset=3):
+        """Load vehicle locations data segmented into trips, for the trips 
+        ending in [left, right). See segment_vehicle_locations_into_trips.sql.
+        """
+
+        stmt = load_sql_file("segment_vehicle_locations_into_trips.sql")
+        params = {"left": left, "right": right, "offset": offset} 
 
         with self.db.connect() as conn: 
-            with open(sql_file) as stmt:
-                df = pd.read_sql(stmt.read(), conn)
+            df = pd.read_sql(stmt, conn, params=params)
             
         return df
 
     def _load_stops_data(self):
         """Load location and direction data for all stops."""
 
-        queries = get_queries_path() 
-        sql_file = f"{queries}/get_all_stops_data.sql"
+        stmt = load_sql_file("get_all_stops_data.sql")
 
         with self.db.connect() as conn: 
-            with open(sql_file) as stmt:
-                df = pd.read_sql(stmt.read(), conn)
+            df = pd.read_sql(stmt, conn)
 
         return df
 
@@ -594,6 +1097,38 @@ class ResponseParser:
     def __init__(self):
         pass
 
+    def _validate_types(self, df, types):
+        """Convert the columns of a parsed dataframe to the types of its
+        template, keeping missing values missing: None in string columns
+        (stored as NULL, rather than the 'None' string astype("str") gives),
+        <NA> in nullable boolean and integer columns, NaN/NaT otherwise.
+        Booleans are parsed from the 'true'/'false' strings of the API.
+
+        Args:
+            df (dataframe): Parsed values, with the columns of types.
+            types (dict): Column types, as for DataFrame.astype.
+
+        Returns:
+            dataframe: Converted dataframe.
+        """
+        df = df.copy()
+        for column, dtype in types.items():
+            values = df[column]
+            is_missing = values.isna()
+
+            if dtype == "str":
+                df[column] = values.astype("str").astype(object).where(~is_missing, None)
+            elif dtype in ("bool", "boolean"):
+                is_true = values.astype("str").str.lower() == "true"
+                df[column] = is_true if dtype == "bool" else \
+                    pd.array(is_true.astype(object).where(~is_missing, None), dtype="boolean")
+            elif dtype.startswith("Int"):
+                df[column] = pd.to_numeric(values, errors="coerce").astype(dtype)
+            else:
+                df[column] = values.astype(dtype)
+
+        return df
+
     def parse_route_list_response_into_df_dict(self, response_dict,
                                                agency_tag): 
         """Parse the json response data coming from the routeList NextBus 
@@ -666,7 +1201,7 @@ class ResponseParser:
             df_routes["agency_tag"] = agency_tag 
 
             # Data validation: test and convert types as per template.
-            df_routes = df_routes.astype(routes_types) 
+            df_routes = self._validate_types(df_routes, routes_types) 
 
         df_dict = {'routes': df_routes} 
         return df_dict
@@ -678,7 +1213,8 @@ class ResponseParser:
         matches the format of its intended database table for insertion. 
         The dict keys are the table names.  
 
-        Three dataframes are returned: df_routes, df_directions, df_stops.
+        Four dataframes are returned: df_routes, df_directions, df_stops, 
+        df_route_paths.
 
         Column formats are as follows. 
 
@@ -710,15 +1246,132 @@ class ResponseParser:
             - key (str), 
             - agency_tag (str) 
 
+        df_route_paths:
+            - key (str),
+            - path_id (str),
+            - direction_tag (str),
+            - path_along_direction (int),
+            - point_along_path (int),
+            - lat (float),
+            - lon (float),
+            - route_tag (str),
+            - agency_tag (str) 
+
         A returned dataframe is None if the corresponding data cannot be parsed.  
 
+        Multi-route responses (where 'route' is a list of routes) are split
+        into single-route responses, parsed separately and concatenated. In
+        that case the route tags are read from the response itself. 
+
+        Args:
+            response_dict (dict): json response data from routeConfig endpoint.
+            route_tag (str): route number corresponding to config. Can be None
+                             for multi-route responses. 
+            agency_tag (str): shortname of the corresponding agency (e.g. 'ttc') 
+
+        Returns:
+            df_dict: Four dataframes wrapped in a dict, with corresponding 
+            database table name as key.  
+        """
+
+        route_responses = self.split_route_config_response(response_dict) 
+        if route_tag is not None and len(route_responses) == 1:
+            route_responses = [(route_tag, route_responses[0][1])]
+
+        df_dict_list = [
+            self._parse_single_route_config_response_into_df_dict(
+                                            response_dict=route_response,
+                                            route_tag=tag,
+                                            agency_tag=agency_tag
+                                            )
+            for tag, route_response in route_responses
+            ]
+
+        df_dict = {}
+        for tablename in ["routes", "directions", "stops", "route_paths"]:
+            df_list = [dct[tablename] for dct in df_dict_list 
+                       if dct[tablename] is not None]
+
+            if len(df_list) == 1:
+                df_dict[tablename] = df_list[0]
+            elif df_list:
+                df_dict[tablename] = pd.concat(df_list, ignore_index=True) 
+            else:
+                df_dict[tablename] = None
+
+        return df_dict
+
+    def split_route_config_response(self, response_dict):
+        """Split a routeConfig response into single-route responses. 
+
+        The 'route' key of a routeConfig response holds a single dict when
+        one route was requested, and a list of dicts for multiple routes. 
+
         Args:
             response_dict (dict): json response data from routeConfig endpoint.
+
+        Returns:
+            List[tuple]: List of (route_tag, response_dict) pairs, one for each
+                         route. The route_tag is None if it can't be read. 
+        """
+
+        try:
+            routes = response_dict['route']
+        except:
+            return [(None, response_dict)]
+
+        if not isinstance(routes, list):
+            routes = [routes] 
+
+        route_responses = [] 
+        for route in routes:
+            route_tag = None
+            if isinstance(route, dict):
+                route_tag = route.get('tag') 
+                route = self._normalize_route_config_lists(route) 
+
+            route_response = {k: v for k,v in response_dict.items() if k != 'route'}
+            route_response['route'] = route 
+
+            route_responses.append((route_tag, route_response))
+
+        return route_responses
+
+    def _normalize_route_config_lists(self, route):
+        """Helper function to split_route_config_response. 
+
+        The API returns a dict instead of a list of dicts whenever a list has 
+        a single element (e.g. a route with a single direction). We wrap these
+        back into lists, which is the format expected by the parsers. 
+        """
+        route = dict(route) 
+
+        for key in ['stop', 'direction', 'path']:
+            if isinstance(route.get(key), dict):
+                route[key] = [route[key]]
+
+        if isinstance(route.get('direction'), list):
+            directions = []
+            for direction in route['direction']:
+                if isinstance(direction, dict) and isinstance(direction.get('stop'), dict):
+                    direction = dict(direction, stop=[direction['stop']])
+                directions.append(direction)
+            route['direction'] = directions
+
+        return route
+
+    def _parse_single_route_config_response_into_df_dict(self, response_dict,
+                                                         route_tag, agency_tag):
+        """Helper function to parse_route_config_response_into_df_dict. 
+        Parses a response holding a single route. 
+
+        Args:
+            response_dict (dict): json response data for a single route. 
             route_tag (str): route number corresponding to config. 
             agency_tag (str): shortname of the corresponding agency (e.g. 'ttc') 
 
         Returns:
-            df_dict: Three dataframes wrapped in a dict, with corresponding 
+            df_dict: Four dataframes wrapped in a dict, with corresponding 
             database table name as key.  
         """
 
@@ -738,10 +1391,17 @@ class ResponseParser:
                                             agency_tag=agency_tag
                                             )
 
+        df_route_paths = self._get_df_route_paths_from_route_config_response(
+                                            response_dict=response_dict,
+                                            route_tag=route_tag,
+                                            agency_tag=agency_tag
+                                            )
+
         df_dict = {
             "routes": df_routes,
             "directions": df_directions,
-            "stops": df_stops 
+            "stops": df_stops, 
+            "route_paths": df_route_paths 
         }
         return df_dict
 
@@ -810,7 +1470,7 @@ class ResponseParser:
                 df_routes["lonmax"] = df_response["lonMax"]    
                 
             # Validate and convert data types. 
-            df_routes = df_routes.astype(routes_types) 
+            df_routes = self._validate_types(df_routes, routes_types) 
 
             # Finally, reorder columns so they match the database order.
             col_order = list(routes_types.keys()) 
@@ -895,7 +1555,7 @@ class ResponseParser:
 
 
             # Validate and convert data types. 
-            df_directions = df_directions.astype(directions_types)
+            df_directions = self._validate_types(df_directions, directions_types)
 
             # Finally, reorder columns so they match the database order.
             col_order = list(directions_types.keys()) 
@@ -1014,7 +1674,7 @@ class ResponseParser:
             df_stops["key"] = df_stops["tag"]+"_"+df_stops["direction_tag"]
 
             # Validate and convert data types. 
-            df_stops = df_stops.astype(stops_types) 
+            df_stops = self._validate_types(df_stops, stops_types) 
 
             # Finally, order columns as in the database. 
             col_order = list(stops_types.keys())
@@ -1022,6 +1682,97 @@ class ResponseParser:
 
         return df_stops
 
+    def _get_df_route_paths_from_route_config_response(self, response_dict, 
+                                                       route_tag, agency_tag):
+        """Helper function to parse_route_config_response_into_df_dict.
+
+        Each path of the route is a list of points, tagged with one or more 
+        ids of the form '<direction_tag>_<path number>_<stop tag>_<stop tag>', 
+        e.g. '506_1_506_8_614_7982' for a path of direction '506_1_506'. A path 
+        shared by several directions (e.g. branches) is listed once per id. 
+        Paths whose id doesn't start with a direction tag of the route are 
+        skipped. 
+
+        Args:
+            response_dict (dict): json response data from routeConfig endpoint.
+            route_tag (str): route number corresponding to config. 
+            agency_tag (str): shortname of the corresponding agency (e.g. 'ttc') 
+
+        Returns:
+            df_route_paths: Dataframe with format matching the 'route_paths' table.
+        """
+
+        df_route_paths = None 
+        route_paths_types = {
+            "key": "str",
+            "path_id": "str",
+            "direction_tag": "str",
+            "path_along_direction": "int",
+            "point_along_path": "int",
+            "lat": "float",
+            "lon": "float",
+            "route_tag": "str",
+            "agency_tag": "str" 
+        }
+
+        def as_list(x):
+            return x if isinstance(x, list) else [x] 
+
+        df_response = None 
+        try:
+            paths = as_list(response_dict['route']['path'])    # list of dicts
+            direction_tags = [direction['tag'] for direction 
+                              in as_list(response_dict['route']['direction'])] 
+
+            df_list = [] 
+            for path in paths:
+                points = as_list(path['point'])  
+                lat = [point.get('lat') for point in points]
+                lon = [point.get('lon') for point in points] 
+
+                for path_id in [tag['id'] for tag in as_list(path['tag'])]:
+
+                    # Match the longest direction tag prefixing the path id.
+                    matches = [tag for tag in direction_tags 
+                               if path_id.startswith(tag + "_")] 
+                    if not matches:
+                        continue 
+                    direction_tag = max(matches, key=len)
+                    path_number = path_id[len(direction_tag) + 1:].split("_")[0] 
+
+                    df_list.append(pd.DataFrame({
+                        "path_id": path_id,
+                        "direction_tag": direction_tag,
+                        "path_along_direction": int(path_number),
+                        "point_along_path": range(1, len(points) + 1),   # start at 1
+                        "lat": lat,
+                        "lon": lon 
+                    }))
+
+            df_response = pd.concat(df_list, ignore_index=True) 
+
+        except:
+            pass
+
+        if df_response is not None: 
+
+            df_route_paths = df_response 
+            df_route_paths["route_tag"] = route_tag      # passed as arg
+            df_route_paths["agency_tag"] = agency_tag    # passed as arg
+
+            # Add primary key: concatenation of path_id and point number. 
+            df_route_paths["key"] = (df_route_paths["path_id"] + "_" 
+                                     + df_route_paths["point_along_path"].astype(str)) 
+
+            # Validate and convert data types. 
+            df_route_paths = self._validate_types(df_route_paths, route_paths_types) 
+
+            # Finally, order columns as in the database. 
+            col_order = list(route_paths_types.keys())
+            df_route_paths = df_route_paths[col_order] 
+
+        return df_route_paths 
+
     def parse_schedule_response_into_df_dict(self, response_dict, 
                                              route_tag, agency_tag,
                                              time_of_extraction):
@@ -1052,6 +1803,40 @@ class ResponseParser:
             df_dict: A single dataframe wrapped in a dict, with database 
             table name as key. 
         """
+
+        try:
+            schedules = response_dict['route'] 
+        except:
+            schedules = []
+
+        return self.parse_schedules_into_df_dict(
+                                        schedules=schedules,
+                                        route_tag=route_tag,
+                                        agency_tag=agency_tag,
+                                        time_of_extraction=time_of_extraction
+                                        )
+
+    def parse_schedules_into_df_dict(self, schedules, route_tag, agency_tag,
+                                     time_of_extraction):
+        """Parse schedules from the schedule NextBus API endpoint into a 
+        dataframe, in the format of parse_schedule_response_into_df_dict. 
+
+        The schedules can be any iterable, e.g. the schedules being decoded
+        incrementally from the response stream (see 
+        NextBusAPI.iter_response_items_from_web), in which case each schedule
+        is flattened as soon as it is decoded. 
+
+        Args:
+            schedules (iterable): Schedules, i.e. the items of the response's 
+                                  'route' list. 
+            route_tag (str): route number corresponding to schedule.  
+            agency_tag (str): shortname of the corresponding agency (e.g. 'ttc') 
+            time_of_extraction (datetime): time at which the API was queried. 
+
+        Returns: 
+            df_dict: A single dataframe wrapped in a dict, with database 
+            table name as key. 
+        """
         
         # We construct a null dataframe of the correct format and types.
         # We'll then extract the values out of the schedule response,
@@ -1086,45 +1871,37 @@ class ResponseParser:
             #   c. Each block id contains a table of stop tags, epoch times
             #      and ETAs. 
             #
-            # We will work upward from the bottom-most nested subdict:
-            #   
-            #   1. For each block_id in a schedule, extract the timetable;
-            #   2. Concatenate all block_ids in a schedule;
-            #   3. Join constant data to the schedule (serviceClass, and so on);
-            #   4. Concatenate all schedules; 
-            #
-            # TODO: Rewrite this block of code (flagged by profiler).
-
-            schedules = response_dict['route'] 
-            
-            schedule_class_df_list = [] 
-            for schedule_class in schedules:  # service classes (e.g. holidays, sun, sat)
-
-                block_id_df_list = []
-                blocks = schedule_class["tr"]    # block: ~bus run
-                for block in blocks:
-                    block_id = block["blockID"]
-                    block_stops = block["stop"]  # list of dicts 
-
-                    block_id_df = pd.DataFrame(block_stops)  # timetable
-                    block_id_df["block_id"] = block_id       # stamp it
-
-                    block_id_df_list.append(block_id_df) 
-
-                schedule_df = pd.concat(block_id_df_list)  # schedule for given class
-
-                schedule_df["schedule_class"] = schedule_class["scheduleClass"] 
-                schedule_df["service_class"] = schedule_class["serviceClass"]  
-                schedule_df["route_title"] = schedule_class["title"] 
-                schedule_df["direction_name"] = schedule_class["direction"] 
-
-                schedule_class_df_list.append(schedule_df) 
-
-
-            df_response = pd.concat(schedule_class_df_list)   # all schedules for route 
-            df_response.reset_index(drop=True, inplace=True)  # for access issues 
-
-        except:
+            # We flatten the blocks into columns in a single pass (see 
+            # iter_schedule_blocks), and build one dataframe at the end. 
+            # This avoids building and concatenating a dataframe per block. 
+            columns = {
+                "tag": [],
+                "epochTime": [],
+                "content": [],
+                "block_id": [],
+                "schedule_class": [],
+                "service_class": [],
+                "route_title": [],
+                "direction_name": [] 
+            }
+
+            for schedule_data, block_id, block_stops in self.iter_schedule_blocks(schedules):
+                for stop in block_stops:
+                    columns["tag"].append(stop.get("tag"))
+                    columns["epochTime"].append(stop.get("epochTime"))
+                    columns["content"].append(stop.get("content"))
+
+                num_stops = len(block_stops) 
+                columns["block_id"] += [block_id] * num_stops
+                columns["schedule_class"] += [schedule_data["scheduleClass"]] * num_stops
+                columns["service_class"] += [schedule_data["serviceClass"]] * num_stops
+                columns["route_title"] += [schedule_data["title"]] * num_stops
+                columns["direction_name"] += [schedule_data["direction"]] * num_stops
+
+            if columns["tag"]:
+                df_response = pd.DataFrame(columns)  # all schedules for route 
+
+        except (KeyError, TypeError, AttributeError):
             pass
 
         # Then assemble our dataframe from the response df,
@@ -1179,7 +1956,7 @@ class ResponseParser:
                                                                 )
 
             # Validate and convert data types. 
-            df_schedules = df_schedules.astype(schedules_types) 
+            df_schedules = self._validate_types(df_schedules, schedules_types) 
 
             # Finally, order columns as in the database. 
             col_order = list(schedules_types.keys()) 
@@ -1188,6 +1965,30 @@ class ResponseParser:
         df_dict = {"schedules": df_schedules}
         return df_dict
 
+    def iter_schedule_blocks(self, schedules):
+        """Iterate over the block timetables of schedules. 
+
+        Args:
+            schedules (iterable): Schedules from the schedule endpoint. 
+
+        Yields:
+            tuple: (schedule_data, block_id, block_stops), where schedule_data
+                   is the schedule dict (holding the constant data such as
+                   serviceClass), and block_stops the list of stop dicts of
+                   the block's timetable. 
+        """
+        for schedule_data in schedules:
+            blocks = schedule_data["tr"]         # block: ~bus run
+            if isinstance(blocks, dict):
+                blocks = [blocks] 
+
+            for block in blocks:
+                block_stops = block["stop"]      # list of dicts 
+                if isinstance(block_stops, dict):
+                    block_stops = [block_stops]
+
+                yield schedule_data, block["blockID"], block_stops
+
     def parse_vehicle_locations_response_into_df_dict(self, response_dict, 
                                                       agency_tag, time_of_extraction):
         """Parse the json response data coming from following NextBus API 
@@ -1196,13 +1997,14 @@ class ResponseParser:
             - vehicleLocation
 
         By convention, the dataframe format matches the 'vehicle_locations' 
-        table for insertion.  
+        table for insertion. Values missing from the response are left null
+        (None or <NA>), and stored as NULL.
 
         The columns are:  
             - route_tag (str),
-            - predictable (bool),
-            - heading (int),
-            - speed_kmhr (int),
+            - predictable (boolean),
+            - heading (Int64),
+            - speed_kmhr (Int64),
             - lat (float),
             - lon (float),
             - id (str),
@@ -1241,9 +2043,9 @@ class ResponseParser:
         df_vehicle_locations = None
         vehicle_locations_types = {
             "route_tag": "str",
-            "predictable": "bool",
-            "heading": "int",
-            "speed_kmhr": "int",
+            "predictable": "boolean",
+            "heading": "Int64",
+            "speed_kmhr": "Int64",
             "lat": "float",
             "lon": "float",
             "id": "str",
@@ -1327,7 +2129,7 @@ class ResponseParser:
                 df_vehicle_locations["key"] = vehicle_id + "_" + read_time 
 
             # Type validation.
-            df_vehicle_locations = df_vehicle_locations.astype(vehicle_locations_types)
+            df_vehicle_locations = self._validate_types(df_vehicle_locations, vehicle_locations_types)
 
             # We order columns as in the database.
             col_order = list(vehicle_locations_types.keys())
@@ -1335,3 +2137,151 @@ class ResponseParser:
 
         df_dict = {"vehicle_locations": df_vehicle_locations} 
         return df_dict 
+
+    def parse_predictions_response_into_df_dict(self, response_dict, 
+                                                agency_tag, time_of_extraction):
+        """Parse the json response data coming from following NextBus API 
+        endpoints into a dataframe:
+            - predictions
+            - predictionsForMultiStops
+
+        By convention, the dataframe format matches the 'predictions' 
+        table for insertion.  
+
+        The columns are:  
+            - route_tag (str),
+            - stop_tag (str),
+            - direction_tag (str),
+            - vehicle_id (str),
+            - block_id (str),
+            - trip_tag (str),
+            - is_departure (boolean),
+            - affected_by_layover (bool),
+            - seconds (Int64),
+            - epoch_time (Int64),
+            - predicted_time (datetime64[ns]),
+            - agency_tag (str),
+            - read_time (datetime64[ns]),
+            - key (str) 
+
+        Returned dataframe is None if no prediction can be parsed.  
+
+        Args:
+            response_dict (dict): json response data from predictions endpoints.
+            agency_tag (str): shortname of the corresponding agency (e.g. 'ttc') 
+            time_of_extraction (datetime): time at which the API was queried. 
+
+        Returns: 
+            df_dict: A single dataframe wrapped in a dict, with database 
+            table name as key. 
+        """
+
+        df_predictions = None
+        predictions_types = {
+            "route_tag": "str",
+            "stop_tag": "str",
+            "direction_tag": "str",
+            "vehicle_id": "str",
+            "block_id": "str",
+            "trip_tag": "str",
+            "is_departure": "boolean",
+            "affected_by_layover": "bool",
+            "seconds": "Int64",
+            "epoch_time": "Int64",
+            "predicted_time": "datetime64[ns]",
+            "agency_tag": "str",
+            "read_time": "datetime64[ns]",
+            "key": "str"
+        }
+
+        # The response nests predictions as stops -> directions -> predictions. 
+        # Each level is a list of dicts, or a single dict when the list has 
+        # one element. We flatten the nesting into one record per prediction. 
+        def as_list(x):
+            if x is None:
+                return []
+            return x if isinstance(x, list) else [x]
+
+        df_response = None 
+        try: 
+            records = [] 
+            for stop in as_list(response_dict["predictions"]):
+                for direction in as_list(stop.get("direction")):
+                    for prediction in as_list(direction.get("prediction")):
+                        record = dict(prediction) 
+                        record["routeTag"] = stop["routeTag"]
+                        record["stopTag"] = stop["stopTag"] 
+                        records.append(record) 
+
+            if records:
+                df_response = pd.DataFrame(records) 
+
+        except:
+            pass
+
+        if df_response is not None:
+
+            num_rows = df_response.shape[0]
+            df_predictions = pd.DataFrame(columns=predictions_types.keys(), 
+                                          index=range(num_rows))
+
+            df_predictions["agency_tag"] = agency_tag          # passed as arg
+            df_predictions["read_time"] = time_of_extraction   # passed as arg
+
+            with contextlib.suppress(KeyError):  # route_tag
+                df_predictions["route_tag"] = df_response["routeTag"]
+
+            with contextlib.suppress(KeyError):  # stop_tag
+                df_predictions["stop_tag"] = df_response["stopTag"]
+
+            with contextlib.suppress(KeyError):  # direction_tag
+                df_predictions["direction_tag"] = df_response["dirTag"]
+
+            with contextlib.suppress(KeyError):  # vehicle_id
+                df_predictions["vehicle_id"] = df_response["vehicle"]
+
+            with contextlib.suppress(KeyError):  # block_id
+                df_predictions["block_id"] = df_response["block"]
+
+            with contextlib.suppress(KeyError):  # trip_tag
+                df_predictions["trip_tag"] = df_response["tripTag"]
+
+            # Booleans are sent as 'true'/'false' strings, see _validate_types.
+            with contextlib.suppress(KeyError):  # is_departure
+                df_predictions["is_departure"] = df_response["isDeparture"]
+
+            df_predictions["affected_by_layover"] = False 
+            with contextlib.suppress(KeyError):  # affected_by_layover
+                df_predictions["affected_by_layover"] = df_response["affectedByLayover"]
+
+            with contextlib.suppress(KeyError):  # seconds
+                df_predictions["seconds"] = df_response["seconds"]
+
+            with contextlib.suppress(KeyError):  # epoch_time
+                df_predictions["epoch_time"] = df_response["epochTime"]
+
+            # Type validation.
+            df_predictions = self._validate_types(df_predictions, predictions_types)
+
+            # As with vehicle read times, we pinpoint the predicted arrival time
+            # relative to the time of extraction. Missing seconds give NaT.
+            df_predictions["predicted_time"] = time_of_extraction + pd.to_timedelta(
+                                                   df_predictions["seconds"], unit="seconds")
+
+            # Primary key is the concatenation of stop, direction, vehicle and
+            # read_time, rounded to the minute as in the vehicle_locations table.
+            # It is built from the validated values, where missing tags are None:
+            # they are left empty, and a missing vehicle falls back to the trip. 
+            read_time = str(time_of_extraction)[:16]
+            vehicle_id = df_predictions["vehicle_id"].fillna(df_predictions["trip_tag"])
+            df_predictions["key"] = (df_predictions["stop_tag"].fillna("") + "_" 
+                                     + df_predictions["direction_tag"].fillna("") + "_" 
+                                     + vehicle_id.fillna("") + "_" 
+                                     + read_time)
+
+            # We order columns as in the database.
+            col_order = list(predictions_types.keys())
+            df_predictions = df_predictions[col_order] 
+
+        df_dict = {"predictions": df_predictions} 
+        return df_dict
@@ -0,0 +1,232 @@
+"""
+Simplified street geometry of each route direction.
+
+The paths of a direction (see the route_paths table) are chained in order into
+a single polyline, simplified with the Douglas-Peucker algorithm within a
+tolerance in meters, and stored as parallel NumPy arrays of latitudes,
+longitudes and cumulative distances along the direction. Each direction is
+saved to its own .npz file, so that segmentation and prediction code can load
+only the directions it needs.
+"""
+import os
+import numpy as np
+import pandas as pd
+from utils.distances import calculate_distances_from_lat_lon_arrays
+
+METERS_PER_DEGREE = 6373000 * np.pi / 180   # Earth's radius as in utils.distances
+
+
+def project_to_meters(lat, lon, lat0, lon0):
+    """Project (lat, lon) coordinates to planar (x, y) meters around the origin
+    (lat0, lon0), with an equirectangular projection. Distances are accurate
+    to well under a meter over a city.
+
+    Args:
+        lat, lon (array-like): Coordinates in degrees.
+        lat0, lon0 (float): Origin of the projection, in degrees.
+
+    Returns:
+        tuple: Arrays x (meters east), y (meters north).
+    """
+    x = (np.asarray(lon, dtype=np.float64) - lon0) * METERS_PER_DEGREE * np.cos(np.radians(lat0))
+    y = (np.asarray(lat, dtype=np.float64) - lat0) * METERS_PER_DEGREE
+    return x, y
+
+
+def simplify_polyline(x, y, tolerance):
+    """Simplify a polyline with the Douglas-Peucker algorithm: the points kept
+    are such that every dropped point is within tolerance of the simplified
+    polyline. The distances of all points of a span to its chord are computed
+    at once, and spans are split iteratively.
+
+    Args:
+        x, y (np.ndarray): Planar coordinates of the points, e.g. in meters.
+        tolerance (float): Maximal distance of dropped points, in the units
+                           of x and y.
+
+    Returns:
+        np.ndarray: Sorted indices of the points kept, including both ends.
+    """
+    num_points = len(x)
+    if num_points < 3:
+        return np.arange(num_points)
+
+    keep = np.zeros(num_points, dtype=bool)
+    keep[[0, -1]] = True
+
+    spans = [(0, num_points - 1)]
+    while spans:
+        start, end = spans.pop()
+        if end - start < 2:
+            continue
+
+        # Distance of the inner points to the chord segment [start, end].
+        px, py = x[start + 1:end] - x[start], y[start + 1:end] - y[start]
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        length_sq = dx * dx + dy * dy
+        if length_sq > 0:
+            t = np.clip((px * dx + py * dy) / length_sq, 0, 1)
+            distances = np.hypot(px - t * dx, py - t * dy)
+        else:
+            distances = np.hypot(px, py)
+
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            spans.append((start, split))
+            spans.append((split, end))
+
+    return np.flatnonzero(keep)
+
+
+class RouteGeometry:
+    """
+    Simplified polylines of route directions, with cumulative distances.
+
+    Usage:
+        geometry = RouteGeometry.from_database(db, tolerance_meters=5)
+        geometry.save(path)
+
+        geometry = RouteGeometry.load(path, direction_tags=["506_0_506"])
+        lat, lon, distance_meters = geometry.get_polyline("506_0_506")
+    """
+
+    array_names = ("lat", "lon", "distance_meters")
+
+    def __init__(self, polylines):
+        """
+        Args:
+            polylines (dict): Map of direction tags to dicts of the arrays
+                              lat, lon (float64 degrees) and distance_meters
+                              (cumulative, starting at 0).
+        """
+        self.polylines = polylines
+
+    def __contains__(self, direction_tag):
+        return direction_tag in self.polylines
+
+    @property
+    def direction_tags(self):
+        return sorted(self.polylines)
+
+    @classmethod
+    def from_database(cls, db, tolerance_meters=5.0):
+        """Build the geometry of all directions from the route_paths table.
+
+        Args:
+            db (DatabaseWrapper): Database wrapper.
+            tolerance_meters (float, optional): Simplification tolerance.
+                                                Defaults to 5 meters.
+
+        Returns:
+            RouteGeometry: The geometry.
+        """
+        return cls.compile(db.get_route_paths_dataframe(),
+                           tolerance_meters=tolerance_meters)
+
+    @classmethod
+    def compile(cls, paths_df, tolerance_meters=5.0):
+        """Chain the paths of each direction by path number, then simplify.
+        Consecutive repeated points, e.g. where a path starts at the end of
+        the previous one, are dropped.
+
+        Args:
+            paths_df (dataframe): Path points, with direction_tag,
+                                  path_along_direction, point_along_path,
+                                  lat, lon columns.
+            tolerance_meters (float, optional): Simplification tolerance.
+                                                Defaults to 5 meters.
+
+        Returns:
+            RouteGeometry: The geometry.
+        """
+        df = paths_df.dropna(subset=["direction_tag", "lat", "lon"])
+        df = df.sort_values(["direction_tag", "path_along_direction", "point_along_path"],
+                            kind="stable")
+
+        polylines = {}
+        for direction_tag, df_direction in df.groupby("direction_tag", sort=False):
+            lat = df_direction.lat.to_numpy(dtype=np.float64)
+            lon = df_direction.lon.to_numpy(dtype=np.float64)
+
+            is_repeat = np.zeros(len(lat), dtype=bool)
+            is_repeat[1:] = (lat[1:] == lat[:-1]) & (lon[1:] == lon[:-1])
+            lat, lon = lat[~is_repeat], lon[~is_repeat]
+
+            x, y = project_to_meters(lat, lon, lat.mean(), lon.mean())
+            kept = simplify_polyline(x, y, tolerance_meters)
+            polylines[direction_tag] = cls._get_polyline_arrays(lat[kept], lon[kept])
+
+        return cls(polylines)
+
+    @staticmethod
+    def _get_polyline_arrays(lat, lon):
+        """Helper function to compile. Add cumulative distances to a polyline."""
+
+        distance_meters = np.zeros(len(lat))
+        if len(lat) > 1:
+            distance_meters[1:] = np.cumsum(calculate_distances_from_lat_lon_arrays(
+                lat[:-1], lon[:-1], lat[1:], lon[1:]))
+
+        return {"lat": lat, "lon": lon, "distance_meters": distance_meters}
+
+    def get_polyline(self, direction_tag):
+        """Get the polyline of a direction.
+
+        Args:
+            direction_tag (str): Direction tag, e.g. '506_0_506'.
+
+        Returns:
+            tuple: Arrays lat, lon, distance_meters.
+        """
+        polyline = self.polylines[direction_tag]
+        return tuple(polyline[name] for name in self.array_names)
+
+    def get_stats_df(self):
+        """Get the number of points and length of each direction.
+
+        Returns:
+            dataframe: Dataframe with direction_tag, num_points, length_meters
+                       columns.
+        """
+        return pd.DataFrame({
+            "direction_tag": self.direction_tags,
+            "num_points": [len(self.polylines[tag]["lat"]) for tag in self.direction_tags],
+            "length_meters": [self.polylines[tag]["distance_meters"][-1]
+                              for tag in self.direction_tags],
+        })
+
+    def save(self, path):
+        """Save each direction's arrays to a <direction_tag>.npz file in the
+        path directory.
+
+        Args:
+            path (str): Directory, created if needed.
+        """
+        os.makedirs(path, exist_ok=True)
+        for direction_tag, polyline in self.polylines.items():
+            np.savez(os.path.join(path, direction_tag + ".npz"), **polyline)
+
+    @classmethod
+    def load(cls, path, direction_tags=None):
+        """Load a geometry saved with save.
+
+        Args:
+            path (str): Directory of the geometry.
+            direction_tags (List[str], optional): Directions loaded. Defaults
+                                                  to all saved directions.
+
+        Returns:
+            RouteGeometry: The geometry.
+        """
+        if direction_tags is None:
+            direction_tags = [filename[:-len(".npz")] for filename in os.listdir(path)
+                              if filename.endswith(".npz")]
+
+        polylines = {}
+        for direction_tag in direction_tags:
+            with np.load(os.path.join(path, direction_tag + ".npz")) as arrays:
+                polylines[direction_tag] = {name: arrays[name] for name in cls.array_names}
+
+        return cls(polylines)
@@ -0,0 +1,297 @@
+"""
+Point to route lookup over route bounding boxes and direction geometry.
+
+Routes are registered in the cells of a regular lat/lon grid overlapping
+their bounding box (the latmin, latmax, lonmin, lonmax columns of the routes
+table), as sorted int64 cell keys. A batch of points finds the routes whose
+bounding box contains them with two binary searches per point and an exact
+containment test, without any Python loop over points.
+
+With the simplified direction geometry (see route_geometry), candidate routes
+are narrowed down to the nearest direction within a maximal distance, using
+the vehicle's heading to tell apart opposite directions sharing a street.
+This is used at ingestion to repair readings missing their route or direction
+tag, and to flag readings away from their reported direction.
+"""
+import numpy as np
+import pandas as pd
+from map_matching import MapMatcher
+
+
+class RouteIndex:
+    """
+    Grid index of route bounding boxes, with optional direction geometry.
+
+    Usage:
+        index = RouteIndex.from_database(db, geometry=RouteGeometry.load(path))
+        point, route_tags = index.get_candidate_routes(lat, lon)
+        df, num_repaired = index.repair_tags(df_locations)
+        is_off_route, distance = index.get_off_route_mask(df)
+    """
+
+    cell_bits = 24                 # bits per cell coordinate in the keys
+    max_heading_difference = 90    # degrees between heading and direction bearing
+
+    def __init__(self, routes_df, directions_df=None, geometry=None,
+                 cell_size_degrees=0.01, max_distance_meters=100):
+        """
+        Args:
+            routes_df (dataframe): Routes with tag, latmin, latmax, lonmin,
+                                   lonmax columns.
+            directions_df (dataframe, optional): Directions with tag and
+                                                 route_tag columns. Required
+                                                 with geometry.
+            geometry (RouteGeometry, optional): Polylines of the directions.
+            cell_size_degrees (float, optional): Side of the grid cells.
+                                                 Defaults to 0.01 (about 1km).
+            max_distance_meters (float, optional): Readings further from a
+                                                   direction are not on it.
+                                                   Defaults to 100 meters.
+        """
+        self.cell_size_degrees = cell_size_degrees
+        self.max_distance_meters = max_distance_meters
+
+        df = routes_df.dropna(subset=["latmin", "latmax", "lonmin", "lonmax"])
+        self.route_tags = df.tag.to_numpy(dtype=object)
+        self.route_ids = {tag: i for i, tag in enumerate(self.route_tags)}
+        self._latmin, self._latmax = df.latmin.to_numpy(np.float64), df.latmax.to_numpy(np.float64)
+        self._lonmin, self._lonmax = df.lonmin.to_numpy(np.float64), df.lonmax.to_numpy(np.float64)
+        self._set_index()
+
+        self.matcher = None
+        if geometry is not None:
+            self.matcher = MapMatcher(geometry, max_distance_meters=max_distance_meters)
+            self._set_route_directions(directions_df)
+
+    @classmethod
+    def from_database(cls, db, geometry=None, **kwargs):
+        """Build the index from the routes and directions tables.
+
+        Args:
+            db (DatabaseWrapper): Database wrapper.
+            geometry (RouteGeometry, optional): Polylines of the directions.
+
+        Returns:
+            RouteIndex: The index.
+        """
+        return cls(db.get_routes_dataframe(),
+                   directions_df=db.get_directions_dataframe() if geometry is not None else None,
+                   geometry=geometry, **kwargs)
+
+    def _set_index(self):
+        """Helper function to __init__. Register each route in the cells
+        overlapping its bounding box, as sorted (cell key, route) arrays."""
+
+        cx0, cx1 = self._get_cells(self._lonmin), self._get_cells(self._lonmax)
+        cy0, cy1 = self._get_cells(self._latmin), self._get_cells(self._latmax)
+
+        width, height = cx1 - cx0 + 1, cy1 - cy0 + 1
+        counts = width * height
+        route = np.repeat(np.arange(len(counts)), counts)
+        position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        keys = self._get_keys(cx0[route] + position // height[route],
+                              cy0[route] + position % height[route])
+
+        order = np.argsort(keys, kind="stable")
+        self._index_keys = keys[order]
+        self._index_routes = route[order]
+
+    def _set_route_directions(self, directions_df):
+        """Helper function to __init__. List the directions with geometry of
+        each route, as CSR arrays."""
+
+        df = directions_df[directions_df.tag.isin(self.matcher.direction_ids)
+                           & directions_df.route_tag.isin(self.route_ids)]
+        route = df.route_tag.map(self.route_ids).to_numpy(dtype=np.int64)
+        order = np.argsort(route, kind="stable")
+
+        self._direction_tags = df.tag.to_numpy(dtype=object)[order]
+        self._direction_routes = route[order]
+        self._direction_indptr = np.concatenate(
+            [[0], np.cumsum(np.bincount(route, minlength=len(self.route_tags)))])
+
+    def _get_cells(self, coordinate):
+        return np.floor(np.asarray(coordinate, dtype=np.float64)
+                        / self.cell_size_degrees).astype(np.int64)
+
+    def _get_keys(self, cx, cy):
+        offset = 1 << (self.cell_bits - 1)
+        return ((cx + offset) << self.cell_bits) | (cy + offset)
+
+    def get_candidate_routes(self, lat, lon):
+        """Find the routes whose bounding box contains each point.
+
+        Args:
+            lat, lon (array-like): Coordinates of the points.
+
+        Returns:
+            tuple(np.ndarray, np.ndarray): Pairs of point positions and route
+                tags, sorted by point. Points outside all bounding boxes (or
+                with missing coordinates) have no pair.
+        """
+        point, route = self._get_candidate_route_ids(np.asarray(lat, dtype=np.float64),
+                                                     np.asarray(lon, dtype=np.float64))
+        return point, self.route_tags[route]
+
+    def _get_candidate_route_ids(self, lat, lon):
+        """Helper function to get_candidate_routes, with route ids."""
+
+        is_valid = ~np.isnan(lat) & ~np.isnan(lon)
+        keys = self._get_keys(self._get_cells(np.where(is_valid, lon, 0)),
+                              self._get_cells(np.where(is_valid, lat, 0)))
+
+        first = np.searchsorted(self._index_keys, keys, side="left")
+        counts = np.searchsorted(self._index_keys, keys, side="right") - first
+        counts[~is_valid] = 0
+        point = np.repeat(np.arange(len(keys)), counts)
+        position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        route = self._index_routes[np.repeat(first, counts) + position]
+
+        # Exact containment, cells overlap the boxes' edges.
+        is_inside = (self._latmin[route] <= lat[point]) & (lat[point] <= self._latmax[route]) \
+                    & (self._lonmin[route] <= lon[point]) & (lon[point] <= self._lonmax[route])
+        return point[is_inside], route[is_inside]
+
+    def locate(self, lat, lon, heading=None, route_tags=None):
+        """Find the nearest direction to each point within max_distance_meters,
+        among the directions of the routes whose bounding box contains it, or
+        of its known route. Directions whose bearing is more than 90 degrees
+        off the heading are skipped, where the heading is known.
+
+        Without geometry, points are only attributed a route when a single
+        bounding box contains them.
+
+        Args:
+            lat, lon (array-like): Coordinates of the points.
+            heading (array-like, optional): Headings in degrees clockwise from
+                                            north, negative when unknown.
+            route_tags (array-like, optional): Known route tags, None (or NaN)
+                                               when unknown.
+
+        Returns:
+            dataframe: Dataframe with route_tag, direction_tag,
+                       distance_to_route_meters columns, in the order of the
+                       points. Values are None (or NaN) where not found.
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        known_route = np.full(len(lat), -1, dtype=np.int64) if route_tags is None else \
+            pd.Series(np.asarray(route_tags, dtype=object)).map(self.route_ids) \
+              .fillna(-1).to_numpy(dtype=np.int64)
+
+        # Candidate routes: the known route, else the bounding boxes.
+        point, route = self._get_candidate_route_ids(lat, lon)
+        is_unknown = known_route[point] < 0
+        point, route = point[is_unknown], route[is_unknown]
+        has_route = np.flatnonzero(known_route >= 0)
+        point = np.concatenate([point, has_route])
+        route = np.concatenate([route, known_route[has_route]])
+
+        located = pd.DataFrame({"route_tag": pd.Series([None] * len(lat), dtype=object),
+                                "direction_tag": pd.Series([None] * len(lat), dtype=object),
+                                "distance_to_route_meters": np.full(len(lat), np.nan)})
+
+        if self.matcher is None:
+            counts = np.bincount(point, minlength=len(lat))
+            is_single = counts[point] == 1
+            located.loc[point[is_single], "route_tag"] = self.route_tags[route[is_single]]
+            return located
+
+        # Candidate directions of the candidate routes.
+        counts = self._direction_indptr[route + 1] - self._direction_indptr[route]
+        pair_point = np.repeat(point, counts)
+        position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        direction = np.repeat(self._direction_indptr[route], counts) + position
+
+        _, distance, bearing = self.matcher.match(self._direction_tags[direction],
+                                                  lat[pair_point], lon[pair_point],
+                                                  return_bearing=True)
+        if heading is not None:
+            pair_heading = pd.array(heading, dtype="Float64").to_numpy(
+                               dtype=np.float64, na_value=np.nan)[pair_point]
+            difference = np.abs((pair_heading - bearing + 180) % 360 - 180)
+            distance[(pair_heading >= 0) & (difference > self.max_heading_difference)] = np.nan
+
+        # Keep the nearest direction of each point.
+        is_matched = ~np.isnan(distance)
+        pair_point, direction, distance = \
+            pair_point[is_matched], direction[is_matched], distance[is_matched]
+        order = np.lexsort((distance, pair_point))
+        _, first = np.unique(pair_point[order], return_index=True)
+        nearest = order[first]
+
+        located.loc[pair_point[nearest], "route_tag"] = \
+            self.route_tags[self._direction_routes[direction[nearest]]]
+        located.loc[pair_point[nearest], "direction_tag"] = self._direction_tags[direction[nearest]]
+        located.loc[pair_point[nearest], "distance_to_route_meters"] = distance[nearest]
+        return located
+
+    def repair_tags(self, df):
+        """Fill in the missing route and direction tags of readings from their
+        location (see locate). Tags which are present are kept, and direction
+        tags are only filled in with geometry.
+
+        Args:
+            df (dataframe): Readings with route_tag, direction_tag, lat, lon
+                            and optionally heading columns, e.g. a batch of
+                            the vehicle_locations table.
+
+        Returns:
+            tuple(dataframe, int): Copy of df with repaired tags, and the
+                                   number of readings repaired.
+        """
+        df = df.copy()
+        is_missing = df.route_tag.isna() | df.direction_tag.isna()
+        if not is_missing.any():
+            return df, 0
+
+        missing = df[is_missing]
+        located = self.locate(missing.lat, missing.lon,
+                              heading=missing.heading if "heading" in df.columns else None,
+                              route_tags=missing.route_tag)
+        located.index = missing.index
+
+        is_route_repaired = (missing.route_tag.isna()
+                             & located.route_tag.notna()).to_numpy()
+        is_direction_repaired = (missing.direction_tag.isna()
+                                 & located.direction_tag.notna()).to_numpy()
+        df.loc[missing.index[is_route_repaired], "route_tag"] = \
+            located.route_tag.to_numpy()[is_route_repaired]
+        df.loc[missing.index[is_direction_repaired], "direction_tag"] = \
+            located.direction_tag.to_numpy()[is_direction_repaired]
+
+        return df, int((is_route_repaired | is_direction_repaired).sum())
+
+    def get_off_route_mask(self, df):
+        """Flag readings away from their reported direction: further than
+        max_distance_meters from its geometry, or without geometry, outside
+        the bounding box of their route. Readings without tags, or of
+        directions or routes missing from the index, are not flagged.
+
+        Args:
+            df (dataframe): Readings with route_tag, direction_tag, lat, lon
+                            columns.
+
+        Returns:
+            tuple(np.ndarray, np.ndarray): Off route mask, and distance to the
+                direction in meters (NaN when off route or unknown).
+        """
+        lat = df.lat.to_numpy(dtype=np.float64)
+        lon = df.lon.to_numpy(dtype=np.float64)
+        has_location = ~np.isnan(lat) & ~np.isnan(lon)
+
+        if self.matcher is not None:
+            direction_tags = df.direction_tag.to_numpy(dtype=object)
+            is_known = has_location & df.direction_tag.isin(self.matcher.direction_ids).to_numpy()
+            _, distance = self.matcher.match(direction_tags, lat, lon)
+            return is_known & np.isnan(distance), distance
+
+        if not len(self.route_tags):
+            return np.zeros(len(df), dtype=bool), np.full(len(df), np.nan)
+
+        route = df.route_tag.map(self.route_ids).fillna(-1).to_numpy(dtype=np.int64)
+        is_known = has_location & (route >= 0)
+        route = np.maximum(route, 0)
+        is_inside = (self._latmin[route] <= lat) & (lat <= self._latmax[route]) \
+                    & (self._lonmin[route] <= lon) & (lon <= self._lonmax[route])
+        return is_known & ~is_inside, np.full(len(df), np.nan)
@@ -0,0 +1,464 @@
+"""
+Time-dependent shortest paths over the transit graph.
+
+The transit_graph table is loaded once into a compressed sparse row (CSR)
+adjacency over integer node ids, where nodes are the trimmed stop tags
+(node1, node2). Each edge carries a travel time profile with one value per
+hour of the week, taken from the segment travel time distributions when
+available (see transit_statistics), and estimated from distance otherwise.
+
+Earliest arrival queries run a time-dependent Dijkstra: the time to
+traverse an edge is read from its profile at the hour the edge is entered,
+unless waiting at the stop for a later hour arrives sooner. Arrival times are
+then non-decreasing in departure time on every edge (the FIFO property, under
+which Dijkstra's label setting is exact), also across hour boundaries where
+the hourly travel time drops.
+Point-to-point queries are directed towards the target (A*) by a lower bound
+on the remaining time: the straight-line distance at the fastest edge speed.
+"""
+import datetime
+import heapq
+import numpy as np
+import pandas as pd
+from utils.distances import calculate_distances_from_lat_lon_arrays
+
+
+HOURS_PER_WEEK = 7 * 24
+
+
+def trim_stop_tags(stop_tags):
+    """Get the transit graph nodes of stop tags. 
+
+    Stop tags sometimes have endings such as _IB, _OB, _ar, which only have
+    meaning with respect to a direction (inbound only, outbound only, arrival 
+    only); the stop is otherwise the same, i.e. 1000 and 1000_IB are the same 
+    node. 
+
+    Args:
+        stop_tags (Series): Stop tags, as str.
+
+    Returns:
+        Series: Trimmed stop tags. 
+    """
+    return stop_tags.str.replace("_IB", "").str.replace("_OB", "").str.replace("_ar", "")
+
+
+def get_seconds_of_week(timestamp):
+    """Get the number of seconds since the start of the week (Monday 00:00).
+
+    Args:
+        timestamp (datetime): Time.
+
+    Returns:
+        float: Seconds since the start of the week.
+    """
+    return (timestamp.weekday() * 86400 + timestamp.hour * 3600
+            + timestamp.minute * 60 + timestamp.second
+            + timestamp.microsecond / 1e6)
+
+
+class TransitRouter:
+    """
+    Earliest arrival router over the transit graph.
+
+    Times along edges are vehicle travel times (and walking times on
+    connections). Waiting at a stop is only modeled as far as it keeps arrival
+    times FIFO: an edge may be entered at the start of a later hour when that
+    arrives sooner. Headways are not modeled.
+
+    Usage:
+        router = TransitRouter.from_database(db, stats)
+        arrival_time, path = router.earliest_arrival("14260", "5292", departure_time)
+    """
+
+    transit_speed_mps = 15 / 3.6   # default speed on edges without statistics
+    walking_speed_mps = 1.3
+    anomaly_max_age_minutes = 30   # anomalies not detected again since expire
+
+    def __init__(self, nodes, indptr, targets, edge_ids, edge_keys, profiles,
+                 node_coords=None):
+        """
+        Args:
+            nodes (np.ndarray): Node tag of each node id.
+            indptr (np.ndarray): CSR row pointers, of length num_nodes + 1. The
+                                 edges leaving node u are in positions
+                                 indptr[u]:indptr[u+1] of targets and edge_ids.
+            targets (np.ndarray): Target node id of each edge, in CSR order.
+            edge_ids (np.ndarray): Edge id (row of profiles) of each edge, in
+                                   CSR order.
+            edge_keys (np.ndarray): transit_graph key of each edge id.
+            profiles (np.ndarray): Travel times in seconds, with shape
+                                   (num_edges, HOURS_PER_WEEK).
+            node_coords (np.ndarray, optional): (lat, lon) of each node id, used 
+                                                to direct point-to-point queries.
+        """
+        self.nodes = nodes
+        self.node_ids = {tag: i for i, tag in enumerate(nodes)}
+        self.indptr = indptr
+        self.targets = targets
+        self.edge_ids = edge_ids
+        self.edge_keys = edge_keys
+        self.edge_ids_by_key = {key: i for i, key in enumerate(edge_keys)}
+        self.profiles = profiles
+        self.node_coords = node_coords
+        self._edge_distances = self._get_edge_distances()
+        self._max_speed = None
+
+        # Plain lists are much faster than arrays to index in the search loop,
+        # so the CSR rows are also kept as lists of (target, edge id) pairs.
+        targets_list = targets.tolist()
+        edge_ids_list = edge_ids.tolist()
+        self._adjacency = [
+            list(zip(targets_list[start:end], edge_ids_list[start:end]))
+            for start, end in zip(indptr[:-1].tolist(), indptr[1:].tolist())
+        ]
+        self._times_by_hour = {}   # hour of week -> lists of times by edge id
+        self._later_arrivals = None
+        self._anomaly_overrides = {}   # (edge id, hour of week) -> travel time replaced
+
+    @classmethod
+    def from_database(cls, db, stats=None, quantile=0.5):
+        """Load the router from the transit_graph and stops tables.
+
+        Args:
+            db (DatabaseWrapper): Database wrapper.
+            stats (TransitStatistics, optional): Travel time distributions.
+            quantile (float, optional): Quantile of the distributions used as
+                                        travel time. Defaults to the median.
+
+        Returns:
+            TransitRouter: The router.
+        """
+        agency_tag = db.get_agency_tag()
+        return cls.from_dataframes(
+                    graph_df=db.get_transit_graph_dataframe(),
+                    stops_df=db.get_stop_coords_dataframe(agency_tag=agency_tag),
+                    stats=stats,
+                    quantile=quantile)
+
+    @classmethod
+    def from_dataframes(cls, graph_df, stops_df, stats=None, quantile=0.5):
+        """Build the router from transit graph edges and stop coordinates.
+
+        Args:
+            graph_df (dataframe): Edges, in the format of the transit_graph table.
+            stops_df (dataframe): Stops with tag, lat, lon columns.
+            stats (TransitStatistics, optional): Travel time distributions.
+            quantile (float, optional): Quantile of the distributions used as
+                                        travel time. Defaults to the median.
+
+        Returns:
+            TransitRouter: The router.
+        """
+        graph_df = graph_df.drop_duplicates(subset="key").reset_index(drop=True)
+        nodes, node_ids = np.unique(
+            np.concatenate([graph_df.node1.to_numpy(dtype=str),
+                            graph_df.node2.to_numpy(dtype=str)]),
+            return_inverse=True)
+        sources = node_ids[:len(graph_df)]
+        targets = node_ids[len(graph_df):]
+
+        profiles = cls._get_default_profiles(graph_df, stops_df)
+        if stats is not None:
+            cls._fill_profiles_from_statistics(profiles, graph_df, stats, quantile)
+
+        # CSR layout: edges sorted by source node.
+        order = np.argsort(sources, kind="stable")
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(nodes)), out=indptr[1:])
+
+        # Nodes are located at the first of their stops found. 
+        node_stops = pd.DataFrame({
+            "node": np.concatenate([sources, targets]),
+            "tag": np.concatenate([graph_df.stop_tag1.to_numpy(dtype=str),
+                                   graph_df.stop_tag2.to_numpy(dtype=str)])
+        }).drop_duplicates(subset="node").sort_values("node")
+        coords = stops_df.drop_duplicates(subset="tag").set_index("tag")[["lat", "lon"]]
+        node_coords = coords.reindex(node_stops.tag).to_numpy(dtype=np.float64)
+
+        return cls(nodes=nodes,
+                   indptr=indptr,
+                   targets=targets[order],
+                   edge_ids=order,
+                   edge_keys=graph_df.key.to_numpy(dtype=str),
+                   profiles=profiles,
+                   node_coords=node_coords)
+
+    @classmethod
+    def _get_default_profiles(cls, graph_df, stops_df):
+        """Helper function to from_dataframes. Estimate constant travel times
+        from the distance between stops: at transit speed on direction edges,
+        and at walking speed on connections."""
+
+        coords = stops_df.drop_duplicates(subset="tag").set_index("tag")[["lat", "lon"]]
+        coords1 = coords.reindex(graph_df.stop_tag1)
+        coords2 = coords.reindex(graph_df.stop_tag2)
+        distances = calculate_distances_from_lat_lon_arrays(
+                        coords1.lat.to_numpy(), coords1.lon.to_numpy(),
+                        coords2.lat.to_numpy(), coords2.lon.to_numpy())
+        distances = np.nan_to_num(distances, nan=0.0)
+
+        is_connection = graph_df.is_connection.fillna(False).astype(bool).to_numpy() \
+            if "is_connection" in graph_df.columns else np.zeros(len(graph_df), bool)
+        speeds = np.where(is_connection, cls.walking_speed_mps, cls.transit_speed_mps)
+
+        seconds = (distances / speeds).astype(np.float32)
+        return np.repeat(seconds[:, None], HOURS_PER_WEEK, axis=1)
+
+    @classmethod
+    def _fill_profiles_from_statistics(cls, profiles, graph_df, stats, quantile):
+        """Helper function to from_dataframes. Replace default travel times by
+        the distributions' quantiles. Hours without data on an edge which has
+        some take the median over its hours with data."""
+
+        edge_ids_by_key = {key: i for i, key in enumerate(graph_df.key)}
+        observed = np.full(profiles.shape, np.nan, dtype=np.float32)
+
+        for (edge_key, hour_of_week), sketch in stats.sketches.items():
+            edge_id = edge_ids_by_key.get(edge_key)
+            if edge_id is not None:
+                observed[edge_id, hour_of_week] = sketch.quantile(quantile)
+
+        has_data = ~np.isnan(observed).all(axis=1)
+        edge_medians = np.nanmedian(observed[has_data], axis=1)
+        filled = np.where(np.isnan(observed[has_data]),
+                          edge_medians[:, None], observed[has_data])
+        profiles[has_data] = filled
+
+    def set_edge_travel_time(self, edge_key, seconds, hours_of_week=None):
+        """Override the travel time of an edge, e.g. to route around an
+        anomaly.
+
+        Args:
+            edge_key (str): Key of the transit_graph edge.
+            seconds (float): Travel time in seconds (np.inf to close the edge).
+            hours_of_week (List[int], optional): Hours to override. Defaults to all.
+        """
+        edge_id = self.edge_ids_by_key[edge_key]
+        if hours_of_week is None:
+            self.profiles[edge_id, :] = seconds
+        else:
+            self.profiles[edge_id, list(hours_of_week)] = seconds
+        self._times_by_hour = {}
+        self._later_arrivals = None
+        self._max_speed = None
+
+    def apply_anomalies(self, anomalies_df, now=None):
+        """Use the live travel times of detected anomalies on their edges, 
+        at the hour of the week they were detected. Only the latest anomaly 
+        of each edge and hour is used, and anomalies detected more than 
+        anomaly_max_age_minutes before now are ignored. The anomalies of a 
+        previous call are undone first, so that calling this again with 
+        fresh anomalies lets the stale ones expire. Edges missing from the 
+        graph are ignored.
+
+        Args:
+            anomalies_df (dataframe): Anomalies, in the format of the 
+                                      anomalies table, e.g. from 
+                                      DatabaseWrapper.get_anomalies_dataframe.
+            now (datetime, optional): Current time. Defaults to now.
+        """
+        for (edge_id, hour_of_week), seconds in self._anomaly_overrides.items():
+            self.profiles[edge_id, hour_of_week] = seconds
+        self._anomaly_overrides = {}
+
+        if now is None:
+            now = datetime.datetime.now()
+        min_detected_at = pd.Timestamp(now) - pd.Timedelta(minutes=self.anomaly_max_age_minutes)
+        detected_at = pd.to_datetime(anomalies_df.detected_at)
+        df = anomalies_df[(detected_at >= min_detected_at).to_numpy()] \
+                .assign(detected_at=detected_at) \
+                .sort_values("detected_at", kind="stable") \
+                .drop_duplicates(subset=["edge_key", "hour_of_week"], keep="last")
+
+        for edge_key, hour_of_week, seconds in zip(df.edge_key, df.hour_of_week,
+                                                   df.live_seconds):
+            edge_id = self.edge_ids_by_key.get(edge_key)
+            if edge_id is not None:
+                key = (edge_id, int(hour_of_week))
+                self._anomaly_overrides.setdefault(key, self.profiles[key])
+                self.profiles[key] = seconds
+
+        self._times_by_hour = {}
+        self._later_arrivals = None
+        self._max_speed = None
+
+    def _get_edge_distances(self):
+        """Helper function to __init__. Get the straight-line distance between
+        the nodes of each edge id, or None without node coordinates."""
+
+        if self.node_coords is None or np.isnan(self.node_coords).any():
+            return None
+
+        sources = np.repeat(np.arange(len(self.nodes)), np.diff(self.indptr))
+        distances = np.empty(len(self.edge_keys))
+        distances[self.edge_ids] = calculate_distances_from_lat_lon_arrays(
+                                        self.node_coords[sources, 0],
+                                        self.node_coords[sources, 1],
+                                        self.node_coords[self.targets, 0],
+                                        self.node_coords[self.targets, 1])
+        return distances
+
+    def _get_potentials(self, target):
+        """Get a lower bound on the travel time from each node to the target: 
+        its straight-line distance at the fastest speed reached on any edge 
+        (at any hour). Returns None when no useful bound is available."""
+
+        if self._edge_distances is None:
+            return None
+
+        if self._max_speed is None:
+            min_times = self.profiles.min(axis=1)
+            is_moving = self._edge_distances > 0
+            with np.errstate(divide="ignore"):
+                speeds = self._edge_distances[is_moving] / min_times[is_moving]
+            self._max_speed = float(speeds.max()) if speeds.size else np.inf
+
+        if not np.isfinite(self._max_speed) or self._max_speed <= 0:
+            return None
+
+        distances = calculate_distances_from_lat_lon_arrays(
+                        self.node_coords[:, 0], self.node_coords[:, 1],
+                        self.node_coords[target, 0], self.node_coords[target, 1])
+        return (distances / self._max_speed).tolist()
+
+    def _get_later_arrivals(self):
+        """Get, for each edge and hour of the week, the earliest arrival by
+        waiting for a later hour to enter the edge, in seconds since the start
+        of the hour: min over later hours k of (k - hour) * 3600 + profile[k].
+        Built on first use and cached."""
+
+        if self._later_arrivals is None:
+            profiles = self.profiles.astype(np.float64)
+            later = np.empty(profiles.shape)
+            best = np.full(len(profiles), np.inf)
+
+            # Two passes backwards around the week, so that the last hours
+            # also see the first hours of the next week.
+            for hour in list(range(HOURS_PER_WEEK - 1, -1, -1)) * 2:
+                best = 3600 + np.minimum(profiles[:, (hour + 1) % HOURS_PER_WEEK], best)
+                later[:, hour] = best
+            self._later_arrivals = later
+
+        return self._later_arrivals
+
+    def _get_times_at_hour(self, hour_of_week):
+        """Get the travel time of every edge at an hour of the week, and the
+        arrival by waiting for a later hour (see _get_later_arrivals), as
+        lists. Lists are built on first use and cached."""
+
+        times = self._times_by_hour.get(hour_of_week)
+        if times is None:
+            times = (self.profiles[:, hour_of_week].tolist(),
+                     self._get_later_arrivals()[:, hour_of_week].tolist())
+            self._times_by_hour[hour_of_week] = times
+        return times
+
+    def _search(self, source, start_time, target=None, potentials=None):
+        """Time-dependent Dijkstra from the source node id. An edge entered at
+        time t, in hour h, is left at min(t + profile[h], arrival by waiting
+        for a later hour), which is non-decreasing in t.
+
+        Args:
+            source (int): Source node id.
+            start_time (float): Departure time, in seconds of the week.
+            target (int, optional): Stop the search once this node is settled.
+            potentials (list, optional): Lower bound on the time from each node
+                                         to the target, see _get_potentials.
+
+        Returns:
+            (dict, dict): Arrival time (seconds of the week, not wrapped) and
+                          predecessor node id of each settled node.
+        """
+        adjacency = self._adjacency
+        get_times_at_hour = self._get_times_at_hour
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+
+        num_nodes = len(adjacency)
+        arrival = [np.inf] * num_nodes
+        predecessor = [-1] * num_nodes
+        settled = bytearray(num_nodes)
+        settled_nodes = []
+        if potentials is None:
+            potentials = [0.0] * num_nodes
+
+        arrival[source] = start_time
+        heap = [(start_time + potentials[source], source)]
+        current_hour = None
+
+        while heap:
+            _, node = heappop(heap)
+            if settled[node]:
+                continue
+            settled[node] = 1
+            settled_nodes.append(node)
+            if node == target:
+                break
+
+            time = arrival[node]
+            hour = int(time // 3600) % HOURS_PER_WEEK
+            if hour != current_hour:
+                times, later_arrivals = get_times_at_hour(hour)
+                current_hour = hour
+            hour_start = time - time % 3600
+
+            for next_node, edge_id in adjacency[node]:
+                next_time = time + times[edge_id]
+                later_time = hour_start + later_arrivals[edge_id]
+                if later_time < next_time:
+                    next_time = later_time
+                if next_time < arrival[next_node]:
+                    arrival[next_node] = next_time
+                    predecessor[next_node] = node
+                    heappush(heap, (next_time + potentials[next_node], next_node))
+
+        return ({node: arrival[node] for node in settled_nodes},
+                {node: predecessor[node] for node in settled_nodes})
+
+    def earliest_arrival(self, source_tag, target_tag, departure_time):
+        """Find the earliest arrival at the target stop when leaving the
+        source stop at departure_time.
+
+        Args:
+            source_tag (str): Source node, i.e. trimmed stop tag.
+            target_tag (str): Target node, i.e. trimmed stop tag.
+            departure_time (datetime): Time of departure.
+
+        Returns:
+            (datetime, List[str]): Arrival time and node tags along the path,
+                                   or (None, []) if the target is unreachable.
+        """
+        source = self.node_ids[source_tag]
+        target = self.node_ids[target_tag]
+        start_time = get_seconds_of_week(departure_time)
+
+        arrival, predecessor = self._search(source, start_time, target=target,
+                                            potentials=self._get_potentials(target))
+        if target not in arrival:
+            return None, []
+
+        path = [target]
+        while path[-1] != source:
+            path.append(predecessor[path[-1]])
+
+        arrival_time = departure_time + datetime.timedelta(
+                                            seconds=arrival[target] - start_time)
+        return arrival_time, [self.nodes[node] for node in reversed(path)]
+
+    def earliest_arrival_times(self, source_tag, departure_time):
+        """Find the earliest arrival at every reachable stop when leaving the
+        source stop at departure_time.
+
+        Args:
+            source_tag (str): Source node, i.e. trimmed stop tag.
+            departure_time (datetime): Time of departure.
+
+        Returns:
+            Series: Travel time in seconds, indexed by node tag.
+        """
+        start_time = get_seconds_of_week(departure_time)
+        arrival, _ = self._search(self.node_ids[source_tag], start_time)
+
+        return pd.Series({self.nodes[node]: time - start_time
+                          for node, time in arrival.items()}).sort_values()
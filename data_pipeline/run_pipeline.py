@@ -16,12 +16,32 @@ if __name__ == "__main__":
                         help="build connections between nearby stops") 
     parser.add_argument("-tg", "--transitGraph", action="store_true",
                         help="build transit graph table from config tables")
+    parser.add_argument("-inc", "--incremental", action="store_true",
+                        help="with -cn, -tg: only rebuild what transit config changes touched")
+    parser.add_argument("-ct", "--connectionTimetables", action="store_true",
+                        help="compile schedules into connection timetables for journey planning")
+    parser.add_argument("-rg", "--routeGeometry", action="store_true",
+                        help="simplify route paths into per-direction polylines")
+    parser.add_argument("-ts", "--transitStatistics", action="store_true",
+                        help="update transit time distributions with trips ended last hour")
+    parser.add_argument("-mm", "--mapMatching", action="store_true",
+                        help="with -ts: map match trips onto the route geometry instead of regressing")
     parser.add_argument("-av", "--activeVehicles", action="store_true",
                         help="fetch snapshot of active vehicles over all routes") 
     parser.add_argument("-vl", "--vehicleLocations", action="store_true",
                         help="fetch current location data for all known vehicles")  
+    parser.add_argument("-cc", "--collectionCycle", action="store_true",
+                        help="fetch all vehicles by route, storing locations and last seen times")
+    parser.add_argument("-ri", "--routeIndex", action="store_true",
+                        help="with -vl, -cc: repair missing route tags and flag off-route readings")
     parser.add_argument("-vvl", "--validationVehicleLocations", action="store_true",
                         help="fetch current location data for all validation vehicles")  
+    parser.add_argument("-pr", "--predictions", action="store_true",
+                        help="fetch agency arrival predictions for all stops")
+    parser.add_argument("-ad", "--anomalyDetection", action="store_true",
+                        help="detect slowdowns from recent vehicle locations, with -cc: at the end of the cycle")
+    parser.add_argument("-rh", "--rollupHourly", action="store_true",
+                        help="rebuild hourly rollup of vehicle locations over retention period")
     parser.add_argument("-dv", "--deleteVehicles", action="store_true",
                         help="delete vehicle location data outside of retention period")
     parser.add_argument("-w", "--wait", type=int,
@@ -46,10 +66,25 @@ if __name__ == "__main__":
         pipeline.data_loader.populate_schedules_table_from_API()
 
     if args.connections:
-        pipeline.data_preparation.populate_connections_table()
+        pipeline.data_preparation.populate_connections_table(incremental=args.incremental)
 
     if args.transitGraph:
-        pipeline.data_preparation.populate_transit_graph_table()
+        pipeline.data_preparation.populate_transit_graph_table(incremental=args.incremental)
+
+    if args.connectionTimetables:
+        config = get_pipeline_config()
+        pipeline.data_preparation.compile_connection_timetables(
+                                        path=config["timetables_path"])
+
+    if args.routeGeometry:
+        config = get_pipeline_config()
+        pipeline.data_preparation.compile_route_geometry(
+                                        path=config["route_geometry_path"])
+
+    if args.transitStatistics:
+        config = get_pipeline_config()
+        pipeline.data_preparation.update_transit_statistics(
+                    geometry_path=config["route_geometry_path"] if args.mapMatching else None)
 
     if args.activeVehicles:
         pipeline.data_loader.fetch_active_vehicles_snapshop_from_API() 
@@ -57,14 +92,49 @@ if __name__ == "__main__":
     if args.vehicleLocations:
         config = get_pipeline_config() 
         retention_period = config["vehicle_locations_retention_days"]  
+        pipeline.data_loader.set_vehicle_locations_layout(
+                                        config["vehicle_locations_layout"])
+        if args.routeIndex:
+            pipeline.data_loader.load_route_index(
+                                        geometry_path=config["route_geometry_path"])
         pipeline.data_loader.fetch_vehicle_locations_from_API(
                                         active_over_num_days=retention_period)
 
+    if args.collectionCycle:
+        config = get_pipeline_config()
+        pipeline.data_loader.set_vehicle_locations_layout(
+                                        config["vehicle_locations_layout"])
+        if args.routeIndex:
+            pipeline.data_loader.load_route_index(
+                                        geometry_path=config["route_geometry_path"])
+        if args.anomalyDetection:
+            pipeline.data_loader.load_anomaly_detector() 
+        pipeline.data_loader.run_collection_cycle()
+
     if args.validationVehicleLocations:
         pipeline.data_loader.fetch_validation_vehicle_locations_from_API()
 
+    if args.predictions:
+        pipeline.data_loader.fetch_predictions_from_API()
+
+    if args.anomalyDetection and not args.collectionCycle:
+        config = get_pipeline_config()
+        pipeline.data_loader.set_vehicle_locations_layout(
+                                        config["vehicle_locations_layout"])
+        pipeline.data_preparation.detect_anomalies(
+                    source=pipeline.data_loader.get_vehicle_locations_source_table())
+
+    if args.rollupHourly:
+        config = get_pipeline_config()
+        pipeline.data_loader.set_vehicle_locations_layout(
+                                        config["vehicle_locations_layout"])
+        pipeline.data_loader.refresh_vehicle_locations_hourly_rollup(
+                                        num_days=config["vehicle_locations_retention_days"])
+
     if args.deleteVehicles:
         config = get_pipeline_config()
         retention_period = config["vehicle_locations_retention_days"]
+        pipeline.data_loader.set_vehicle_locations_layout(
+                                        config["vehicle_locations_layout"])
         pipeline.data_loader.delete_old_vehicle_locations_entries(
                                         keep_num_days=retention_period) 
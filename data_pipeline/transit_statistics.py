@@ -0,0 +1,278 @@
+"""
+Statistical distributions of transit times over the network, updated
+incrementally.
+
+Travel times on each transit graph edge (consecutive stops s1 -> s2 on a
+direction) are summarized per hour of the week in a SegmentTimeHistogram, a
+histogram sketch with fixed log-spaced buckets. Sketches sharing buckets are
+merged by adding their counts, so new trips are folded into the stored
+distributions without revisiting old data, and quantiles are read off the
+cumulative counts.
+"""
+import datetime
+import numpy as np
+import pandas as pd
+
+
+class SegmentTimeHistogram:
+    """
+    Mergeable histogram sketch of travel times, in seconds.
+
+    Bucket edges are log-spaced from min_seconds to max_seconds, so values
+    are stored with a bounded relative error (about half the bucket growth
+    rate, i.e. ~2.5% with the defaults). Values outside the range are
+    clipped into the first or last bucket.
+
+    Usage:
+        sketch = SegmentTimeHistogram()
+        sketch.add([95, 110, 102])
+        median = sketch.quantile(0.5)
+    """
+
+    min_seconds = 5
+    max_seconds = 3 * 60 * 60
+    growth_rate = 1.05   # ratio of consecutive bucket edges
+
+    num_buckets = int(np.ceil(np.log(max_seconds / min_seconds) / np.log(growth_rate)))
+    bucket_edges = min_seconds * growth_rate ** np.arange(num_buckets + 1)
+    _log_min_seconds = np.log(min_seconds)
+    _log_growth_rate = np.log(growth_rate)
+
+    def __init__(self, counts=None):
+        if counts is None:
+            counts = np.zeros(self.num_buckets, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self._cumulative_counts = None
+
+    @property
+    def num_samples(self):
+        return int(self.counts.sum())
+
+    @classmethod
+    def get_bucket_indices(cls, seconds):
+        """Get the bucket index of each value, in seconds.
+
+        Args:
+            seconds (array-like): Travel times in seconds.
+
+        Returns:
+            np.ndarray: Bucket indices, as ints.
+        """
+        seconds = np.asarray(seconds, dtype=np.float64)
+        with np.errstate(divide="ignore"):
+            indices = np.floor((np.log(seconds) - cls._log_min_seconds)
+                               / cls._log_growth_rate)
+        return np.clip(indices, 0, cls.num_buckets - 1).astype(np.int64)
+
+    def add(self, seconds):
+        """Add travel times to the sketch.
+
+        Args:
+            seconds (array-like): Travel times in seconds.
+        """
+        self.add_bucket_counts(self.get_bucket_indices(seconds))
+
+    def add_bucket_counts(self, bucket_indices, counts=1):
+        """Add counts to buckets, e.g. precomputed with get_bucket_indices."""
+
+        np.add.at(self.counts, bucket_indices, counts)
+        self._cumulative_counts = None
+
+    def merge(self, other):
+        """Merge another sketch into this one.
+
+        Args:
+            other (SegmentTimeHistogram): Sketch to add.
+        """
+        self.counts += other.counts
+        self._cumulative_counts = None
+
+    def quantile(self, q):
+        """Get an approximate quantile of the travel times. Values are
+        interpolated geometrically within their bucket.
+
+        Args:
+            q (float): Quantile, between 0 and 1.
+
+        Returns:
+            float: Travel time in seconds, or nan for an empty sketch.
+        """
+        if self._cumulative_counts is None:
+            self._cumulative_counts = np.cumsum(self.counts)
+
+        cumulative_counts = self._cumulative_counts
+        total = cumulative_counts[-1]
+        if total == 0:
+            return float("nan")
+
+        target = q * total
+        index = min(int(np.searchsorted(cumulative_counts, target, side="left")),
+                    self.num_buckets - 1)
+        count_before = cumulative_counts[index - 1] if index > 0 else 0
+        fraction = (target - count_before) / self.counts[index] if self.counts[index] else 0
+
+        return float(self.bucket_edges[index] * self.growth_rate ** fraction)
+
+    def to_bytes(self):
+        """Serialize the sketch. Only non-empty buckets are stored, as pairs
+        of (uint16 bucket index, uint32 count).
+
+        Returns:
+            bytes: Serialized sketch.
+        """
+        indices = np.flatnonzero(self.counts)
+        record = np.empty(len(indices), dtype=[("index", "<u2"), ("count", "<u4")])
+        record["index"] = indices
+        record["count"] = self.counts[indices]
+        return record.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Deserialize a sketch, see to_bytes.
+
+        Args:
+            data (bytes): Serialized sketch.
+
+        Returns:
+            SegmentTimeHistogram: The sketch.
+        """
+        record = np.frombuffer(data, dtype=[("index", "<u2"), ("count", "<u4")])
+        counts = np.zeros(cls.num_buckets, dtype=np.int64)
+        counts[record["index"]] = record["count"]
+        return cls(counts)
+
+
+class TransitStatistics:
+    """
+    Travel time distributions per (edge, hour of week), where edges are keys
+    of the transit_graph table and hour 0 of the week is Monday 00:00-01:00.
+
+    Distributions are loaded from and saved to the segment_time_distributions
+    table. Only the sketches touched since loading are written back.
+
+    Usage:
+        stats = TransitStatistics(db)
+        df_segments = stats.get_segment_times_df(df_times_at_stops)
+        stats.load(hours_of_week=df_segments.hour_of_week.unique())
+        stats.add_segment_times(df_segments)
+        stats.save()
+
+        stats.quantile(edge_key, hour_of_week, 0.9)
+    """
+
+    def __init__(self, db=None):
+        self.db = db
+        self.sketches = {}       # (edge_key, hour_of_week) -> SegmentTimeHistogram
+        self.updated_keys = set()
+
+    def get_segment_times_df(self, times_df):
+        """Compute segment travel times from times of visit at stops. A segment
+        joins consecutive stops visited on the same trip; its travel time is
+        placed in the hour of the week of departure.
+
+        Args:
+            times_df (dataframe): Times at stops with columns vehicle_id,
+                                  direction_tag, trip_id, stop_tag, stop_order,
+                                  read_time, see
+                                  DataPreparation.get_predicted_times_at_stops_df.
+
+        Returns:
+            dataframe: Segment times with columns edge_key, hour_of_week,
+                       seconds.
+        """
+
+        df = times_df.sort_values(
+                ["vehicle_id", "direction_tag", "trip_id", "stop_order"])
+        read_time = pd.to_datetime(df["read_time"])
+
+        trip_columns = ["vehicle_id", "direction_tag", "trip_id"]
+        is_same_trip = (df[trip_columns] == df[trip_columns].shift(-1)).all(axis=1)
+        is_next_stop = (df["stop_order"].shift(-1) - df["stop_order"]) == 1
+        is_segment = (is_same_trip & is_next_stop).to_numpy()
+
+        departure = read_time[is_segment]
+        seconds = (read_time.shift(-1)[is_segment] - departure).dt.total_seconds()
+        edge_key = (df["stop_tag"].astype(str) + "_"
+                    + df["stop_tag"].shift(-1).astype(str) + "_"
+                    + df["direction_tag"].astype(str))[is_segment]
+
+        df_segments = pd.DataFrame({
+            "edge_key": edge_key.to_numpy(),
+            "hour_of_week": (departure.dt.dayofweek * 24 + departure.dt.hour).to_numpy(),
+            "seconds": seconds.to_numpy()
+        })
+
+        # Interpolated times at stops are not always increasing along a trip.
+        return df_segments[df_segments.seconds > 0].reset_index(drop=True)
+
+    def add_segment_times(self, df_segments):
+        """Fold segment travel times into the sketches.
+
+        Args:
+            df_segments (dataframe): Segment times, see get_segment_times_df.
+        """
+
+        df = df_segments[["edge_key", "hour_of_week"]].copy()
+        df["bucket"] = SegmentTimeHistogram.get_bucket_indices(df_segments["seconds"])
+        bucket_counts = df.groupby(["edge_key", "hour_of_week", "bucket"]).size()
+
+        for (edge_key, hour_of_week), group in bucket_counts.groupby(level=[0, 1]):
+            key = (edge_key, int(hour_of_week))
+            sketch = self.sketches.setdefault(key, SegmentTimeHistogram())
+            sketch.add_bucket_counts(group.index.get_level_values("bucket"),
+                                     group.to_numpy())
+            self.updated_keys.add(key)
+
+    def get_sketch(self, edge_key, hour_of_week):
+        """Get the sketch of an edge at an hour of the week, or None."""
+        return self.sketches.get((edge_key, hour_of_week))
+
+    def quantile(self, edge_key, hour_of_week, q):
+        """Get a quantile of the travel time on an edge at an hour of the week.
+
+        Args:
+            edge_key (str): Key of the transit_graph edge.
+            hour_of_week (int): Hour of the week, 0 to 167.
+            q (float): Quantile, between 0 and 1.
+
+        Returns:
+            float: Travel time in seconds, or nan without data.
+        """
+        sketch = self.sketches.get((edge_key, hour_of_week))
+        return sketch.quantile(q) if sketch is not None else float("nan")
+
+    def load(self, hours_of_week=None):
+        """Load sketches from the segment_time_distributions table.
+
+        Args:
+            hours_of_week (List[int], optional): Hours of the week to load.
+                                                 Defaults to all.
+        """
+        df = self.db.get_segment_time_distributions_dataframe(hours_of_week)
+
+        for edge_key, hour_of_week, sketch in zip(df.edge_key, df.hour_of_week, df.sketch):
+            self.sketches[(edge_key, int(hour_of_week))] = \
+                SegmentTimeHistogram.from_bytes(sketch)
+
+    def save(self):
+        """Write the sketches updated since loading to the
+        segment_time_distributions table."""
+
+        if not self.updated_keys:
+            return
+
+        updated_at = datetime.datetime.now()
+        rows = []
+        for key in sorted(self.updated_keys):
+            sketch = self.sketches[key]
+            rows.append({
+                "edge_key": key[0],
+                "hour_of_week": key[1],
+                "num_samples": sketch.num_samples,
+                "sketch": sketch.to_bytes(),
+                "updated_at": updated_at
+            })
+
+        self.db.upsert_dataframe_in_table(
+                    "segment_time_distributions", pd.DataFrame(rows))
+        self.updated_keys = set()
@@ -1,21 +1,35 @@
-/*Busiest routes by various metrics.*/
+/*Busiest routes by various metrics.
 
-WITH routes_readings AS (
-SELECT distinct 
-       routes.tag AS route_tag,
-       routes.title as route_title,
-       loc.direction_tag,
-       loc.id AS vehicle_id,
-       loc.read_time
+Reads from the vehicle_locations_hourly rollup, see 
+vehicle_locations_reads_per_day.sql for the peak_hourly_vehicles metric. 
+Vehicles are counted once per route and hour (route_vehicles_seen), whatever
+the directions they ran in.*/
+
+WITH routes_hourly AS (
+SELECT routes.tag AS route_tag,
+       routes.title AS route_title,
+       loc.hour,
+       MAX(loc.route_vehicles_seen) AS vehicles_seen,
+       SUM(loc.reads_taken) AS reads_taken
   FROM TTC.routes routes
-  LEFT JOIN TTC.vehicle_locations loc ON routes.tag=loc.route_tag
+  INNER JOIN TTC.vehicle_locations_hourly loc ON routes.tag=loc.route_tag
+ WHERE loc.hour >= SUBDATE(CURRENT_DATE(), INTERVAL 1 WEEK)
+ GROUP BY 1,2,3
+),
+routes_directions AS (
+SELECT route_tag,
+       COUNT(DISTINCT direction_tag) AS active_directions
+  FROM TTC.vehicle_locations_hourly
+ WHERE hour >= SUBDATE(CURRENT_DATE(), INTERVAL 1 WEEK)
+   AND direction_tag <> ''
+ GROUP BY 1
 )
-SELECT route_tag, 
+SELECT routes_hourly.route_tag, 
        route_title,
-       COUNT(DISTINCT vehicle_id) AS vehicles_seen,
-       COUNT(1) AS reads_taken,
-       COUNT(DISTINCT direction_tag) AS active_directions
-  FROM routes_readings
- WHERE DATE(read_time) >= SUBDATE(CURRENT_DATE(), INTERVAL 1 WEEK)
+       MAX(vehicles_seen) AS peak_hourly_vehicles,
+       SUM(reads_taken) AS reads_taken,
+       MAX(routes_directions.active_directions) AS active_directions
+  FROM routes_hourly
+  LEFT JOIN routes_directions ON routes_directions.route_tag=routes_hourly.route_tag
  GROUP BY 1,2
  ORDER BY 4 desc;
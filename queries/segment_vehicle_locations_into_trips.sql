@@ -79,7 +79,7 @@ WITH preprocessed_base AS (      /*Pull data for the wanted period (with offset)
                 ) AS sec_to_prev_ts
                 
       FROM preprocessed_base
-     WHERE direction_tag <> 'None'  -- TODO: Fix null insertion issues in ORM, then change this part of the query. 
+     WHERE direction_tag IS NOT NULL
 ),
      start_times AS (            /*Identify trip segments by inspecting the sec_to_prev_ts field for large deviations.*/
     SELECT vehicle_id, 
@@ -99,7 +99,7 @@ WITH preprocessed_base AS (      /*Pull data for the wanted period (with offset)
              ON base.vehicle_id=start_times.vehicle_id 
             AND base.direction_tag=start_times.direction_tag 
             AND base.read_time=start_times.read_time
-     WHERE base.direction_tag <> 'None'  /*At this point we remove timestamps with null direction_tag, since these are between trips.*/
+     WHERE base.direction_tag IS NOT NULL  /*At this point we remove timestamps with null direction_tag, since these are between trips.*/
 ),
      loc_data_fill_helper AS (   /*Create a row_group column, identifying which rows belong to the same trip.*/
     SELECT *,
@@ -0,0 +1,23 @@
+/*Assess data quality of the vehicle locations collected over the last day, per hour.
+
+Reads from the vehicle_locations_quality counters, accumulated at collection 
+from each batch of readings before filtering (see data_quality.py), instead 
+of scanning vehicle_locations as vehicle_locations_missing_data.sql does.*/
+
+SELECT hour,
+       readings,
+       route_tag_null,
+       direction_tag_null,
+       heading_null,
+       speed_kmhr_null,
+       lat_null + lon_null                             AS coordinates_null,
+       stale_readings,
+       out_of_bbox,
+       duplicate_keys,
+       ROUND(100 * direction_tag_null / readings, 1)   AS direction_tag_null_pct,
+       ROUND(100 * stale_readings / readings, 1)       AS stale_readings_pct
+
+  FROM TTC.vehicle_locations_quality
+ WHERE hour >= NOW() - INTERVAL 1 DAY
+   AND readings > 0
+ ORDER BY hour;
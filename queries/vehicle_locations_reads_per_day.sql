@@ -1,12 +1,24 @@
-/*Get the daily number of vehicles seen and the number of sensor reads taken over the last month.*/
+/*Get the daily number of vehicles seen and the number of sensor reads taken over the last month.
 
-SELECT DATE(read_time)                                 AS date,
-       DATE_FORMAT(read_time, "%a")                    AS weekday,
-       COUNT(DISTINCT id)                              AS vehicles_seen,
-       COUNT(1)                                        AS reads_taken,
-       SUM(COUNT(1)) OVER (ORDER BY DATE(read_time))   AS cumul_reads
+Reads from the vehicle_locations_hourly rollup. Distinct vehicles can't be 
+added up across hours, so the day reports the peak number of vehicles seen 
+in any one hour, from the distinct count over all routes stored with each 
+hour (hour_vehicles_seen).*/
 
-  FROM TTC.vehicle_locations
- WHERE DATE(read_time) >= SUBDATE(CURRENT_DATE(), INTERVAL 1 MONTH)
+WITH hourly AS (
+SELECT hour,
+       MAX(hour_vehicles_seen)                         AS vehicles_seen,
+       SUM(reads_taken)                                AS reads_taken
+  FROM TTC.vehicle_locations_hourly
+ WHERE hour >= SUBDATE(CURRENT_DATE(), INTERVAL 1 MONTH)
+ GROUP BY 1
+)
+SELECT DATE(hour)                                      AS date,
+       DATE_FORMAT(hour, "%a")                         AS weekday,
+       MAX(vehicles_seen)                              AS peak_hourly_vehicles,
+       SUM(reads_taken)                                AS reads_taken,
+       SUM(SUM(reads_taken)) OVER (ORDER BY DATE(hour)) AS cumul_reads
+
+  FROM hourly
  GROUP BY 1,2
- ORDER BY 1,2;
\ No newline at end of file
+ ORDER BY 1,2;
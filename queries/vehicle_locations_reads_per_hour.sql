@@ -1,12 +1,15 @@
-/*Get the hourly number of vehicles seen and the number of sensor reads taken today.*/
+/*Get the hourly number of vehicles seen and the number of sensor reads taken today.
 
-SELECT DATE(read_time)                                 AS date,
-       HOUR(read_time)                                 AS hour,
-       COUNT(DISTINCT id)                              AS vehicles_seen,
-       COUNT(1)                                        AS reads_taken,
-       SUM(COUNT(1)) OVER (ORDER BY HOUR(read_time))   AS cumul_reads
+Reads from the vehicle_locations_hourly rollup. Vehicles are counted once per
+hour, from the distinct count over all routes stored with each hour.*/
 
-  FROM TTC.vehicle_locations
- WHERE DATE(read_time) = CURRENT_DATE()
+SELECT DATE(hour)                                      AS date,
+       HOUR(hour)                                      AS hour,
+       MAX(hour_vehicles_seen)                         AS vehicles_seen,
+       SUM(reads_taken)                                AS reads_taken,
+       SUM(SUM(reads_taken)) OVER (ORDER BY HOUR(hour)) AS cumul_reads
+
+  FROM TTC.vehicle_locations_hourly
+ WHERE hour >= CURRENT_DATE()
  GROUP BY 1,2
- ORDER BY 2;
\ No newline at end of file
+ ORDER BY 2;
@@ -0,0 +1,33 @@
+"""
+Shared fixtures of the unit tests. 
+"""
+import pytest
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+from database import DatabaseWrapper
+from db_tables import Base
+
+
+@pytest.fixture
+def db():
+    """Database wrapper over a fresh in-memory SQLite database."""
+
+    engine = sqlalchemy.create_engine("sqlite://")
+
+    # Let SQLAlchemy emit BEGIN itself, so that savepoints roll back as on
+    # MySQL instead of being committed by the pysqlite driver.
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @sqlalchemy.event.listens_for(engine, "begin")
+    def begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+
+    db = DatabaseWrapper(session=session)
+    db.connect = engine.connect
+    yield db
+    session.close()
@@ -0,0 +1,142 @@
+"""
+Unit tests for the real-time slowdown detector. 
+"""
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+from anomalies import AnomalyDetector
+from pipeline import DataLoader
+from routing import TransitRouter
+from transit_statistics import TransitStatistics
+
+
+@pytest.fixture
+def stops_df():
+    # Stops 1 -> 2 -> 3 -> 4 heading north, about 556m apart.
+    return pd.DataFrame({
+        "direction_tag": ["A"] * 4,
+        "stop_tag": ["1", "2", "3", "4"],
+        "lat": [43.650, 43.655, 43.660, 43.665],
+        "lon": [-79.380] * 4,
+        "stop_order": [1, 2, 3, 4],
+    })
+
+
+@pytest.fixture
+def stats():
+    # Historically, each edge takes about 60s on Tuesdays at 8:00 (hour 32).
+    rng = np.random.default_rng(0)
+    stats = TransitStatistics()
+    stats.add_segment_times(pd.DataFrame({
+        "edge_key": np.repeat(["1_2_A", "2_3_A", "3_4_A"], 200),
+        "hour_of_week": 32,
+        "seconds": rng.normal(60, 5, size=600),
+    }))
+    return stats
+
+
+def make_readings(vehicle_id, start, seconds_per_edge, num_minutes):
+    """Readings every minute of a vehicle moving at constant speed from stop 1."""
+
+    rows = []
+    for minute in range(num_minutes):
+        fraction = min(minute * 60 / (3 * seconds_per_edge), 1)
+        rows.append({"id": vehicle_id, "direction_tag": "A",
+                     "lat": 43.650 + 0.015 * fraction, "lon": -79.380,
+                     "read_time": start + datetime.timedelta(minutes=minute)})
+    return pd.DataFrame(rows)
+
+
+def test_detector_flags_slow_edges_across_cycles(stops_df, stats):
+
+    start = datetime.datetime(2022, 2, 8, 8, 0)
+    df_slow = pd.concat([make_readings(str(i), start, seconds_per_edge=240, 
+                                       num_minutes=13) for i in range(3)])
+    df_normal = make_readings("9", start, seconds_per_edge=60, num_minutes=4)
+    df = pd.concat([df_slow, df_normal]).sort_values("read_time")
+
+    # Feed the readings one collection cycle at a time.
+    detector = AnomalyDetector(stops_df, stats)
+    observations = [detector.add_vehicle_locations(cycle_df) 
+                    for _, cycle_df in df.groupby("read_time")]
+    df_observations = pd.concat(observations)
+
+    normal = df_observations.seconds < 120
+    assert df_observations[normal].seconds.to_numpy() == pytest.approx(60, abs=1)
+    assert df_observations[~normal].seconds.to_numpy() == pytest.approx(240, abs=1)
+
+    df_anomalies = detector.detect()
+    assert sorted(df_anomalies.edge_key) == ["1_2_A", "2_3_A", "3_4_A"]
+    assert (df_anomalies.hour_of_week == 32).all()
+    assert (df_anomalies.z_score > 10).all()
+
+    # Replaying the same readings at once gives the same traversal times.
+    batch_detector = AnomalyDetector(stops_df, stats)
+    df_batch = batch_detector.add_vehicle_locations(df)
+    assert len(df_batch) == len(df_observations)
+    assert sorted(batch_detector.detect().edge_key) == sorted(df_anomalies.edge_key)
+
+
+def test_thresholds_without_history_are_not_cached(stops_df, stats):
+
+    detector = AnomalyDetector(stops_df, stats)
+    assert np.isnan(detector._get_thresholds("1_2_A", 33)).all()
+
+    stats.add_segment_times(pd.DataFrame({"edge_key": "1_2_A", "hour_of_week": 33,
+                                          "seconds": np.full(50, 90.0)}))
+    assert detector._get_thresholds("1_2_A", 33)[0] == pytest.approx(90, rel=0.05)
+
+
+def test_loader_feeds_each_cycle_to_its_detector(db, stops_df, stats):
+
+    loader = DataLoader(db, db.session)
+    loader.anomaly_detector = AnomalyDetector(stops_df, stats)
+
+    start = datetime.datetime(2022, 2, 8, 8, 0)
+    df = pd.concat([make_readings(str(i), start, seconds_per_edge=240, num_minutes=13)
+                    for i in range(2)])
+    for read_time, cycle_df in df.groupby("read_time"):
+        loader._detect_anomalies(cycle_df, read_time.to_pydatetime())
+
+    df_anomalies = db.get_anomalies_dataframe(since=start)
+    assert sorted(df_anomalies.edge_key.unique()) == ["1_2_A", "2_3_A", "3_4_A"]
+
+
+def test_anomalies_are_stored_and_applied_by_router(db, stops_df, stats):
+
+    start = datetime.datetime(2022, 2, 8, 8, 0)
+    detector = AnomalyDetector(stops_df, stats)
+    detector.add_vehicle_locations(pd.concat(
+        [make_readings(str(i), start, seconds_per_edge=240, num_minutes=13) 
+         for i in range(2)]))
+    db.upsert_dataframe_in_table("anomalies", detector.detect())
+
+    df_anomalies = db.get_anomalies_dataframe(since=start)
+    assert len(df_anomalies) == 3
+
+    graph_df = pd.DataFrame({
+        "key": ["1_2_A", "2_3_A", "3_4_A"],
+        "stop_tag1": ["1", "2", "3"], "stop_tag2": ["2", "3", "4"],
+        "node1": ["1", "2", "3"], "node2": ["2", "3", "4"],
+        "direction_tag": ["A"] * 3, "is_connection": [None] * 3,
+    })
+    router = TransitRouter.from_dataframes(
+        graph_df, stops_df.rename(columns={"stop_tag": "tag"}), stats)
+    arrival_before, _ = router.earliest_arrival("1", "4", start)
+
+    now = pd.to_datetime(df_anomalies.detected_at).max()
+    router.apply_anomalies(df_anomalies, now=now)
+    arrival_after, _ = router.earliest_arrival("1", "4", start)
+    assert (arrival_after - arrival_before).total_seconds() == pytest.approx(540, abs=30)
+
+    # The latest anomaly of an edge wins, and stale ones expire.
+    df_latest = df_anomalies.assign(detected_at=now + datetime.timedelta(minutes=1),
+                                    live_seconds=60)
+    router.apply_anomalies(pd.concat([df_anomalies, df_latest.iloc[:1]]), now=now)
+    arrival_latest, _ = router.earliest_arrival("1", "4", start)
+    assert (arrival_latest - arrival_before).total_seconds() == pytest.approx(360, abs=30)
+
+    router.apply_anomalies(df_anomalies, now=now + datetime.timedelta(hours=1))
+    arrival_expired, _ = router.earliest_arrival("1", "4", start)
+    assert arrival_expired == arrival_before
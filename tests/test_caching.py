@@ -0,0 +1,21 @@
+"""
+Unit tests for the recently written keys filter. 
+"""
+from utils.caching import RecentKeyFilter
+
+
+def test_recent_key_filter_drops_repeats_and_evicts_lru():
+
+    key_filter = RecentKeyFilter(max_size=3)
+    assert key_filter.is_new(["a", "b", "c"]) == [True, True, True]
+    key_filter.add(["a", "b", "c"])
+
+    # Checking "a" makes it recently used, so "b" is evicted first.
+    assert key_filter.is_new(["a", "d"]) == [False, True]
+    key_filter.add(["d"])
+    assert len(key_filter) == 3
+    assert "b" not in key_filter
+    assert "a" in key_filter and "d" in key_filter
+
+    assert key_filter.num_checked == 5
+    assert key_filter.num_dropped == 1
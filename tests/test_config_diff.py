@@ -0,0 +1,92 @@
+"""
+Unit tests for the transit config diff and the incremental rebuilds of the
+connections and transit_graph tables.
+"""
+import datetime
+import pandas as pd
+import sqlalchemy
+from config_diff import TransitConfigDiff
+from pipeline import DataPreparation
+
+
+def make_conf(stops):
+    # Routes 1 and 2 have one direction each. Stops are (tag, lat, direction).
+    routes = pd.DataFrame({"tag": ["1", "2"], "title": ["1", "2"], "agency_tag": ["ttc"] * 2})
+    directions = pd.DataFrame({
+        "tag": ["1_0", "2_0"], "title": ["East", "North"], "name": ["East", "North"],
+        "route_tag": ["1", "2"], "branch": ["1", "2"], "agency_tag": ["ttc"] * 2,
+    })
+    df = pd.DataFrame(stops, columns=["tag", "lat", "direction_tag"])
+    df["title"] = df.tag
+    df["lon"] = -79.38
+    df["route_tag"] = df.direction_tag.str.slice(stop=1)
+    df["stop_along_direction"] = df.groupby("direction_tag").cumcount() + 1
+    df["key"] = df.tag + "_" + df.direction_tag
+    df["agency_tag"] = "ttc"
+    return {"routes": routes, "directions": directions, "stops": df}
+
+
+def test_compare():
+
+    stored = make_conf([("a", 43.650, "1_0"), ("b", 43.651, "1_0"), ("c", 43.652, "1_0"),
+                        ("x", 43.700, "2_0")])
+    fresh = make_conf([("a", 43.650, "1_0"), ("b", 43.6515, "1_0"), ("d", 43.653, "1_0")])
+    fresh["directions"] = fresh["directions"][fresh["directions"].route_tag == "1"]
+    fresh["directions"].loc[0, "title"] = "Eastbound"
+
+    diff = TransitConfigDiff.compare(stored, fresh, detected_at=datetime.datetime(2022, 1, 3))
+    changes = diff.changes.set_index("key")
+
+    # Route 2 was not refreshed, so its stops and direction are not removed.
+    assert sorted(changes.index) == ["1_0", "b_1_0", "c_1_0", "d_1_0"]
+    assert changes.loc["1_0", "changed_columns"] == "title"
+    assert changes.loc["b_1_0", "changed_columns"] == "lat"
+    assert changes.loc["c_1_0", "change"] == "removed"
+    assert changes.loc["d_1_0", "change"] == "added"
+    assert not changes.connections_applied.any() and not changes.graph_applied.any()
+
+    assert diff.get_moved_stop_tags() == ["b", "c", "d"]
+    assert diff.get_rechained_direction_tags() == ["1_0"]
+
+
+def test_incremental_rebuilds_match_full_rebuilds(db, monkeypatch):
+
+    monkeypatch.setenv("TRANSIT_CONFIG_AGENCY_TAG", "ttc")
+    monkeypatch.setenv("TRANSIT_CONFIG_CONNECTIONS_CLUSTER_MAX_DISTANCE_METERS", "150")
+    db.insert_dataframe_in_table("agencies", pd.DataFrame({"id": [1], "tag": ["ttc"]}))
+    data_preparation = DataPreparation(db, session=db.session)
+
+    # Stops are about 111m apart every 0.001 degree of latitude.
+    stored = make_conf([("a", 43.650, "1_0"), ("b", 43.651, "1_0"), ("c", 43.652, "1_0"),
+                        ("x", 43.6505, "2_0"), ("y", 43.700, "2_0")])
+    db.refresh_tables(stored)
+    data_preparation.populate_connections_table()
+    data_preparation.populate_transit_graph_table()
+
+    # Stop c moves away from b, and stop d is added next to y.
+    fresh = make_conf([("a", 43.650, "1_0"), ("b", 43.651, "1_0"), ("c", 43.660, "1_0"),
+                       ("d", 43.7005, "1_0")])
+    diff = TransitConfigDiff.compare(stored, fresh)
+    fresh["transit_config_changes"] = diff.changes
+    db.refresh_tables(fresh, scope_columns={"directions": "route_tag", "stops": "route_tag"})
+
+    data_preparation.populate_connections_table(incremental=True)
+    data_preparation.populate_transit_graph_table(incremental=True)
+    connections = db.get_connections_dataframe().sort_values("key").reset_index(drop=True)
+    graph = db.get_transit_graph_dataframe().sort_values("key").reset_index(drop=True)
+
+    assert db.get_pending_transit_config_changes("connections").empty
+    assert db.get_pending_transit_config_changes("graph").empty
+    assert set(connections.key) == {"a_b", "b_a", "a_x", "x_a", "b_x", "x_b", "d_y", "y_d"}
+    assert "c_d_1_0" in set(graph.key) and "b_c_1_0" in set(graph.key)
+
+    # Same tables as rebuilding everything from the fresh config.
+    for tablename in ["connections", "transit_graph"]:
+        db.session.execute(sqlalchemy.text("DELETE FROM {}".format(tablename)))
+    data_preparation.populate_connections_table()
+    data_preparation.populate_transit_graph_table()
+
+    pd.testing.assert_frame_equal(
+        connections, db.get_connections_dataframe().sort_values("key").reset_index(drop=True))
+    pd.testing.assert_frame_equal(
+        graph, db.get_transit_graph_dataframe().sort_values("key").reset_index(drop=True))
@@ -0,0 +1,79 @@
+"""
+Unit tests for the connection timetable and its CSA queries. 
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from connection_scan import ConnectionTimetable
+
+
+def hms(hours, minutes=0, seconds=0):
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def make_schedules_df(route_tag, block_id, trips, direction_name="East"):
+    """Rows of the schedules table for consecutive trips of a block, each 
+    given as a list of (stop_tag, seconds since midnight or -1)."""
+    rows = []
+    for stops in trips:
+        for stop_tag, time in stops:
+            rows.append({"schedule_class": "2022Jan", "service_class": "wkd",
+                         "route_tag": route_tag, "direction_name": direction_name,
+                         "block_id": block_id, "stop_tag": stop_tag,
+                         "epoch_time": time * 1000 if time >= 0 else -1})
+    df = pd.DataFrame(rows)
+    df["key"] = route_tag + "_2022Jan_" + df.index.astype(str).str.pad(8, fillchar="0")
+    return df
+
+
+@pytest.fixture
+def timetable():
+    # Route A runs 1 -> 2 -> 3_ar twice on the same block (2 is skipped on 
+    # the second trip), route B runs 4 -> 5, and stops 3 and 4 are 100m apart.
+    schedules_df = pd.concat([
+        make_schedules_df("A", "A_1", [
+            [("1", hms(8)), ("2", hms(8, 10)), ("3_ar", hms(8, 20))],
+            [("1", hms(9)), ("2", -1), ("3_ar", hms(9, 15))],
+        ]),
+        make_schedules_df("B", "B_1", [
+            [("4", hms(8, 25)), ("5", hms(8, 35))],
+            [("4", hms(9, 25)), ("5", hms(9, 35))],
+        ]),
+    ])
+    connections_df = pd.DataFrame({
+        "stop1": ["3", "4"], "stop2": ["4", "3"], "distance_meters": [100.0, 100.0]
+    })
+    return ConnectionTimetable.compile(schedules_df, connections_df)
+
+
+def test_compile_connections(timetable):
+
+    assert timetable.num_connections == 5
+    assert (np.diff(timetable.dep_time) >= 0).all()
+    assert sorted(timetable.trips) == ["A_A_1_28800", "A_A_1_32400",
+                                       "B_B_1_30300", "B_B_1_33900"]
+
+
+def test_earliest_arrival_with_transfer(timetable):
+
+    arrival, legs = timetable.earliest_arrival("1", "5", hms(7, 50))
+    assert arrival == hms(8, 35)
+    assert [leg["mode"] for leg in legs] == ["trip", "walk", "trip"]
+    assert legs[0]["from_stop"] == "1" and legs[0]["to_stop"] == "3"
+    assert legs[1]["arrival"] == hms(8, 20) + 77
+
+    arrival, legs = timetable.earliest_arrival("1", "5", hms(9, 30))
+    assert arrival is None and legs == []
+
+
+def test_profile_and_memory_mapped_roundtrip(timetable, tmp_path):
+
+    timetable.save(str(tmp_path))
+    timetable = ConnectionTimetable.load(str(tmp_path))
+    assert isinstance(timetable.dep_time, np.memmap)
+
+    df_profile = timetable.profile("1", "5", hms(7), hms(10))
+    assert df_profile.to_dict("records") == [
+        {"departure": hms(8), "arrival": hms(8, 35)},
+        {"departure": hms(9), "arrival": hms(9, 35)},
+    ]
@@ -0,0 +1,75 @@
+"""
+Unit tests for the data quality counters of vehicle location batches.
+"""
+import datetime
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from data_quality import VehicleLocationsQuality
+from pipeline import DataLoader
+
+
+def make_batch_df(time_of_extraction):
+    read_time = [time_of_extraction - datetime.timedelta(seconds=s) for s in [10, 20, 900, 30]]
+    return pd.DataFrame({
+        "route_tag": ["506", "506", "506", None],
+        "predictable": pd.array([True, True, None, True], dtype="boolean"),
+        "heading": pd.array([73, None, 90, 180], dtype="Int64"),
+        "speed_kmhr": pd.array([0, 0, 0, 0], dtype="Int64"),
+        "lat": [43.65, 43.66, 45.00, np.nan],
+        "lon": [-79.38, -79.39, -79.38, np.nan],
+        "id": ["4516", "4470", "4470", "1234"],
+        "direction_tag": ["506_0_506", None, None, None],
+        "agency_tag": "ttc",
+        "read_time": read_time,
+        "key": ["4516_1", "4470_1", "4470_1", "1234_1"],
+    })
+
+
+def test_get_counts_df():
+
+    time_of_extraction = datetime.datetime(2022, 1, 4, 8, 59, 30)
+    quality = VehicleLocationsQuality(bbox=(43.5, 43.9, -79.7, -79.1))
+
+    counts = quality.get_counts_df(make_batch_df(time_of_extraction), time_of_extraction) \
+                    .iloc[0].to_dict()
+
+    assert counts["hour"] == datetime.datetime(2022, 1, 4, 8)
+    assert counts["readings"] == 4
+    assert counts["route_tag_null"] == 1
+    assert counts["direction_tag_null"] == 3
+    assert counts["predictable_null"] == 1
+    assert counts["heading_null"] == 1
+    assert counts["lat_null"] == counts["lon_null"] == 1
+    assert counts["stale_readings"] == 1
+    assert counts["out_of_bbox"] == 1        # missing coordinates are not counted
+    assert counts["duplicate_keys"] == 1
+
+
+def test_add_vehicle_locations_quality(db):
+
+    quality = VehicleLocationsQuality()
+    for minute in [0, 1, 61]:
+        time_of_extraction = datetime.datetime(2022, 1, 4, 8, 0) + datetime.timedelta(minutes=minute)
+        db.add_vehicle_locations_quality(
+            quality.get_counts_df(make_batch_df(time_of_extraction), time_of_extraction))
+
+    # Batches of the same hour are added up.
+    df = db.get_vehicle_locations_quality_dataframe(since=datetime.datetime(2022, 1, 4))
+    assert pd.to_datetime(df.hour).dt.hour.to_list() == [8, 9]
+    assert df.batches.to_list() == [2, 1]
+    assert df.readings.to_list() == [8, 4]
+    assert df.direction_tag_null.to_list() == [6, 3]
+    assert df.out_of_bbox.to_list() == [0, 0]
+
+
+def test_record_quality_failure_does_not_raise(db, monkeypatch):
+
+    def fail(dataframe):
+        raise sqlalchemy.exc.OperationalError("INSERT", {}, Exception("locked"))
+
+    loader = DataLoader(db, db.session)
+    monkeypatch.setattr(db, "add_vehicle_locations_quality", fail)
+
+    time_of_extraction = datetime.datetime(2022, 1, 4, 8, 0)
+    loader._record_vehicle_locations_quality(make_batch_df(time_of_extraction), time_of_extraction)
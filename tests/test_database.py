@@ -0,0 +1,310 @@
+"""
+Unit tests for the DatabaseWrapper write paths, run against an in-memory 
+SQLite database. 
+"""
+import datetime
+import pandas as pd 
+import pytest
+import sqlalchemy
+from database import VEHICLE_LOCATIONS_DTYPES
+from migrate_null_values import migrate_none_strings_to_null
+from pipeline import DataLoader
+
+
+def make_vehicle_locations_df(read_time, vehicle_ids, direction_tags, lat=43.65):
+    num_rows = len(vehicle_ids)
+    df = pd.DataFrame({
+        "route_tag": ["506"] * num_rows,
+        "predictable": [True] * num_rows,
+        "heading": [73] * num_rows,
+        "speed_kmhr": [0] * num_rows,
+        "lat": [lat] * num_rows,
+        "lon": [-79.38] * num_rows,
+        "id": vehicle_ids,
+        "direction_tag": direction_tags,
+        "agency_tag": ["ttc"] * num_rows,
+        "read_time": [read_time] * num_rows,
+    })
+    df["key"] = df["id"] + "_" + df["read_time"].apply(str).str.slice(stop=16)
+    return df
+
+
+def test_insert_vehicle_locations_compact(db):
+
+    read_time = datetime.datetime(2021, 12, 21, 21, 17, 54)
+    df = make_vehicle_locations_df(read_time, ["4516", "4470"], ["506_0_506", None])
+    db.insert_vehicle_locations_compact(df)
+
+    # Same vehicles and minute, updated position: rows are updated in place.
+    df = make_vehicle_locations_df(read_time + datetime.timedelta(seconds=3),
+                                   ["4516", "4470"], ["506_0_506", None], lat=43.66)
+    db.insert_vehicle_locations_compact(df)
+
+    df_facts = db.query("SELECT * FROM vehicle_locations_compact ORDER BY vehicle_int")
+    df_vehicles = db.query("SELECT * FROM vehicle_dim ORDER BY vehicle_int")
+    df_directions = db.query("SELECT * FROM direction_dim")
+
+    assert df_vehicles.id.to_list() == ["4516", "4470"]
+    assert df_directions.tag.to_list() == ["506_0_506"]
+    assert len(df_facts) == 2
+    assert (df_facts.lat.round(2) == 43.66).all()
+    assert df_facts.direction_int.isna().to_list() == [False, True]
+    assert (df_facts.read_time_bucket == int(pd.Timestamp(read_time).value // 60e9)).all()
+
+
+def test_insert_vehicle_locations_compact_caches_committed_ids_only(db, monkeypatch):
+
+    read_time = datetime.datetime(2021, 12, 21, 21, 17, 54)
+    df = make_vehicle_locations_df(read_time, ["4516", "4470"], ["506_0_506"] * 2)
+
+    write_dataframe = db.write_dataframe
+    def fail(*args, **kwargs):
+        raise sqlalchemy.exc.OperationalError("INSERT", {}, Exception("interrupted"))
+    monkeypatch.setattr(db, "write_dataframe", fail)
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        db.insert_vehicle_locations_compact(df)
+
+    # The new dimension rows are rolled back, and their keys not cached.
+    assert not any(db.dimension_ids.values())
+    assert db.query("SELECT * FROM vehicle_dim").empty
+
+    monkeypatch.setattr(db, "write_dataframe", write_dataframe)
+    db.insert_vehicle_locations_compact(df)
+    df_facts = db.query("SELECT * FROM vehicle_locations_compact ORDER BY vehicle_int")
+    df_vehicles = db.query("SELECT * FROM vehicle_dim ORDER BY vehicle_int")
+    assert df_facts.vehicle_int.to_list() == df_vehicles.vehicle_int.to_list()
+    assert db.dimension_ids["vehicle_dim"] == dict(zip(df_vehicles.id, df_vehicles.vehicle_int))
+
+
+def test_insert_vehicle_locations_compact_reads_back_concurrent_ids(db, monkeypatch):
+
+    # Another writer registers vehicle 4470 between the lookup and the insert.
+    begin_nested = db.session.begin_nested
+    def insert_concurrently():
+        monkeypatch.setattr(db.session, "begin_nested", begin_nested)
+        db.session.execute(sqlalchemy.text(
+            "INSERT INTO vehicle_dim (vehicle_int, id, agency_tag) VALUES (42, '4470', 'ttc')"))
+        return begin_nested()
+    monkeypatch.setattr(db.session, "begin_nested", insert_concurrently)
+
+    read_time = datetime.datetime(2021, 12, 21, 21, 17, 54)
+    df = make_vehicle_locations_df(read_time, ["4516", "4470"], ["506_0_506"] * 2)
+    db.insert_vehicle_locations_compact(df)
+
+    df_vehicles = db.query("SELECT * FROM vehicle_dim ORDER BY id")
+    df_facts = db.query("SELECT * FROM vehicle_locations_compact")
+    assert df_vehicles.id.to_list() == ["4470", "4516"]
+    assert sorted(df_facts.vehicle_int) == sorted(df_vehicles.vehicle_int)
+    assert 42 in df_facts.vehicle_int.to_list()
+
+
+def test_insert_dataframe_in_table_updates_existing_keys(db):
+
+    read_time = datetime.datetime(2021, 12, 21, 21, 17, 54)
+    df = make_vehicle_locations_df(read_time, ["4516", "4470"], ["506_0_506", None])
+    db.insert_dataframe_in_table("vehicle_locations", df)
+
+    # Missing values become NULL, and columns not in the table are ignored.
+    df = make_vehicle_locations_df(read_time, ["4470", "1234"], [None, None], lat=43.66)
+    df["heading"] = pd.array([None, 90], dtype="Int16")
+    df["secs_since_report"] = 12
+    db.insert_dataframe_in_table("vehicle_locations", df)
+
+    df_loaded = db.query("SELECT * FROM vehicle_locations ORDER BY id")
+    assert df_loaded.id.to_list() == ["1234", "4470", "4516"]
+    assert df_loaded.lat.round(2).to_list() == [43.66, 43.66, 43.65]
+    assert df_loaded.heading.isna().to_list() == [False, True, False]
+    assert df_loaded.direction_tag.isna().to_list() == [True, True, False]
+    assert df_loaded.predictable.astype(bool).all()
+    assert (pd.to_datetime(df_loaded.read_time) == read_time).all()
+
+
+def test_bulk_load_dataframe(db):
+
+    read_time = datetime.datetime(2021, 12, 21, 21, 17, 54)
+    df = make_vehicle_locations_df(read_time, ["4516", "4470"], ["506_0_506", None])
+    db.insert_dataframe_in_table("vehicle_locations", df.iloc[:1])
+
+    # One existing key to update, one new key, and a duplicate within the batch.
+    df = make_vehicle_locations_df(read_time, ["4516", "4470", "4470"],
+                                   ["506_0_506", None, None], lat=43.66)
+    df["predictable"] = pd.array([True, None, None], dtype="boolean")
+    db.bulk_load_dataframe("vehicle_locations", df, batch_size=2)
+
+    df_loaded = db.query("SELECT * FROM vehicle_locations ORDER BY id")
+    assert df_loaded.id.to_list() == ["4470", "4516"]
+    assert (df_loaded.lat == 43.66).all()
+    assert df_loaded.direction_tag.isna().to_list() == [True, False]
+    assert df_loaded.predictable.isna().to_list() == [True, False]
+    assert (pd.to_datetime(df_loaded.read_time) == read_time).all()
+
+
+def test_bulk_load_dataframe_rolls_back_failed_batches(db, monkeypatch):
+
+    read_time = datetime.datetime(2021, 12, 21, 21, 17, 54)
+    df = make_vehicle_locations_df(read_time, ["4516", "4470", "1234"], ["506_0_506"] * 3)
+
+    load_into_staging_table = db._load_into_staging_table
+    num_calls = []
+    def fail_second_batch(*args):
+        num_calls.append(1)
+        if len(num_calls) == 2:
+            raise sqlalchemy.exc.OperationalError("LOAD DATA", {}, Exception("interrupted"))
+        load_into_staging_table(*args)
+    monkeypatch.setattr(db, "_load_into_staging_table", fail_second_batch)
+
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        db.bulk_load_dataframe("vehicle_locations", df, batch_size=2)
+
+    # The first batch is rolled back, and the staging table dropped.
+    assert db.query("SELECT * FROM vehicle_locations").empty
+    assert db.query("SELECT name FROM sqlite_temp_master").empty
+
+    db.bulk_load_dataframe("vehicle_locations", df, batch_size=2)
+    assert len(db.query("SELECT * FROM vehicle_locations")) == 3
+
+
+def test_refresh_vehicle_locations_hourly(db):
+
+    read_time = datetime.datetime(2021, 12, 21, 21, 17, 54)
+    df = pd.concat([
+        make_vehicle_locations_df(read_time, ["4516", "4470"], ["506_0_506", None]),
+        make_vehicle_locations_df(read_time + datetime.timedelta(minutes=45),
+                                  ["4516", "4470"], ["506_0_506", "506_1_506"]),
+        make_vehicle_locations_df(read_time + datetime.timedelta(minutes=50),
+                                  ["4516"], ["506_1_506"]),
+    ])
+    df.loc[df.key == "4470_2021-12-21 21:17", "route_tag"] = "504"
+    db.insert_dataframe_in_table("vehicle_locations", df)
+    db.refresh_vehicle_locations_hourly(df.read_time)
+
+    # Refreshing again replaces the rows of each hour instead of adding to them.
+    db.refresh_vehicle_locations_hourly(df.read_time)
+
+    df_hourly = db.query("SELECT * FROM vehicle_locations_hourly ORDER BY hour, direction_tag")
+    assert df_hourly.direction_tag.to_list() == ["", "506_0_506", "506_0_506", "506_1_506"]
+    assert df_hourly.route_tag.to_list() == ["504", "506", "506", "506"]
+    assert df_hourly.reads_taken.to_list() == [1, 1, 1, 2]
+    assert pd.to_datetime(df_hourly.hour).dt.hour.to_list() == [21, 21, 22, 22]
+    assert (pd.to_datetime(df_hourly.first_read_time).dt.minute == [17, 17, 2, 2]).all()
+
+    # Vehicle 4516 ran in both directions of the 506 from 22:00: distinct 
+    # counts of the route and of the hour count it once.
+    assert df_hourly.vehicles_seen.to_list() == [1, 1, 1, 2]
+    assert df_hourly.route_vehicles_seen.to_list() == [1, 1, 2, 2]
+    assert df_hourly.hour_vehicles_seen.to_list() == [2, 2, 2, 2]
+
+
+def test_refresh_tables_merges_and_deletes_within_scope(db):
+
+    def make_stops_df(route_tag, stop_tags, lat=43.65):
+        return pd.DataFrame({
+            "tag": stop_tags, "title": stop_tags, "lat": lat, "lon": -79.38,
+            "route_tag": route_tag, "direction_tag": route_tag + "_0",
+            "stop_along_direction": range(1, len(stop_tags) + 1),
+            "key": [route_tag + "_0_" + tag for tag in stop_tags],
+            "agency_tag": "ttc",
+        })
+
+    db.refresh_tables({"stops": pd.concat([make_stops_df("5", ["1", "2", "3"]),
+                                           make_stops_df("6", ["4", "5"])])},
+                      scope_columns={"stops": "route_tag"})
+
+    # Route 5 drops stop 3 and moves its stops, route 6 is not refreshed.
+    db.refresh_tables({"stops": make_stops_df("5", ["1", "2"], lat=43.66)},
+                      scope_columns={"stops": "route_tag"})
+
+    df_stops = db.query("SELECT * FROM stops ORDER BY `key`")
+    assert df_stops.key.to_list() == ["5_0_1", "5_0_2", "6_0_4", "6_0_5"]
+    assert df_stops.lat.round(2).to_list() == [43.66, 43.66, 43.65, 43.65]
+
+
+def test_migrate_none_strings_to_null(db):
+
+    read_time = datetime.datetime(2021, 12, 21, 21, 17, 54)
+    df = make_vehicle_locations_df(read_time, ["4516", "4470"], ["506_0_506", "None"])
+    db.insert_dataframe_in_table("vehicle_locations", df)
+    with db.connect() as conn:
+        conn.execute(sqlalchemy.text("INSERT INTO direction_dim (tag) VALUES ('None')"))
+        conn.execute(sqlalchemy.text(
+            "INSERT INTO vehicle_dim (vehicle_int, id, agency_tag) VALUES (1, '4470', 'ttc')"))
+        conn.execute(sqlalchemy.text(
+            "INSERT INTO vehicle_locations_compact (vehicle_int, read_time_bucket, direction_int) "
+            "VALUES (1, 0, 1)"))
+
+    num_updated = migrate_none_strings_to_null(db.session.get_bind())
+
+    assert num_updated["vehicle_locations.direction_tag"] == 1
+    assert num_updated["direction_dim.tag"] == 1
+    df_loaded = db.query("SELECT * FROM vehicle_locations ORDER BY id")
+    assert df_loaded.direction_tag.isna().to_list() == [True, False]
+    assert db.query("SELECT * FROM direction_dim").empty
+    assert db.query("SELECT * FROM vehicle_locations_compact").direction_int.isna().all()
+
+
+def test_delete_vehicle_locations_before(db):
+
+    read_times = [datetime.datetime(2021, 12, 20, 23, 59), datetime.datetime(2021, 12, 21, 0, 1)]
+    for read_time in read_times:
+        df = make_vehicle_locations_df(read_time, ["4516"], ["506_0_506"])
+        db.insert_dataframe_in_table("vehicle_locations", df)
+        db.insert_vehicle_locations_compact(df)
+
+    db.delete_vehicle_locations_before("2021-12-21", source="vehicle_locations_compact")
+    assert len(db.query("SELECT * FROM vehicle_locations_compact")) == 1
+    assert len(db.query("SELECT * FROM vehicle_locations")) == 2
+
+    db.delete_vehicle_locations_before("2021-12-21")
+    assert len(db.query("SELECT * FROM vehicle_locations")) == 1
+
+
+def test_seed_recent_keys_reads_keys_of_recent_readings(db):
+
+    now = datetime.datetime.now().replace(microsecond=0)
+    df_old = make_vehicle_locations_df(now - datetime.timedelta(minutes=20), ["4516"], ["506_0_506"])
+    df_new = make_vehicle_locations_df(now - datetime.timedelta(minutes=2), ["4470"], [None])
+    for df in [df_old, df_new]:
+        db.insert_dataframe_in_table("vehicle_locations", df)
+        db.insert_vehicle_locations_compact(df)
+
+    since = now - datetime.timedelta(minutes=5)
+    for source in ["vehicle_locations", "vehicle_locations_compact"]:
+        assert db.get_vehicle_location_keys_since(since, source=source).to_list() \
+               == df_new.key.to_list()
+
+    loader = DataLoader(db, db.session)
+    loader.set_vehicle_locations_layout("compact")
+    loader._seed_recent_keys(num_seconds=300)
+    assert loader.recent_keys_seeded
+    assert df_new.key[0] in loader.recent_keys and df_old.key[0] not in loader.recent_keys
+    assert loader.recent_keys.is_new(pd.concat([df_old.key, df_new.key])) == [True, False]
+
+
+def test_iter_query_streams_chunks_with_dtypes(db):
+
+    read_time = datetime.datetime(2021, 12, 21, 21, 17, 54)
+    df = make_vehicle_locations_df(read_time, [f"{i:02d}" for i in range(25)], ["506_0_506"] * 25)
+    df.loc[:9, "route_tag"] = "504"
+    db.insert_dataframe_in_table("vehicle_locations", df)
+
+    stmt = "SELECT * FROM vehicle_locations ORDER BY id"
+    chunks = list(db.iter_query(stmt, chunksize=10, dtypes=VEHICLE_LOCATIONS_DTYPES))
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    for chunk in chunks:
+        assert chunk.route_tag.dtype == "category"
+        assert chunk.id.dtype == "category"
+        assert chunk.lat.dtype == "float32"
+        assert chunk.read_time.dtype == "datetime64[ns]"
+        assert chunk.predictable.dtype == "boolean"
+
+    records = list(db.iter_query(stmt, chunksize=10, as_records=True))
+    assert [len(chunk) for chunk in records] == [10, 10, 5]
+    assert records[0].id[0] == "00" and records[2].id[-1] == "24"
+
+    # The categories of the first chunk (504) and the others (506) differ, 
+    # and are merged back into a single categorical column.
+    df_query = db.query(stmt, chunksize=10, dtypes=VEHICLE_LOCATIONS_DTYPES)
+    assert len(df_query) == 25
+    assert df_query.route_tag.dtype == "category"
+    assert sorted(df_query.route_tag.cat.categories) == ["504", "506"]
+    assert df_query.lat.dtype == "float32"
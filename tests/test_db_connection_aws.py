@@ -0,0 +1,95 @@
+"""
+Unit tests for the process-wide SSH tunnel and engine of remote connections,
+with a fake tunnel and engine.
+"""
+import pytest
+
+pytest.importorskip("sshtunnel")
+import db_connection_aws
+from db_connection_aws import TunnelManager, get_tunnel_manager
+
+
+class FakeTunnel:
+    """Stands in for sshtunnel.SSHTunnelForwarder."""
+
+    instances = []
+
+    def __init__(self, **kwargs):
+        self.local_bind_port = 40000 + len(self.instances)
+        self.is_active = False
+        self.tunnel_is_up = {}
+        self.num_checks = 0
+        self.instances.append(self)
+
+    def start(self):
+        self.is_active = True
+        self.tunnel_is_up = {("127.0.0.1", self.local_bind_port): True}
+
+    def stop(self):
+        self.is_active = False
+
+    def check_tunnels(self):
+        self.num_checks += 1
+
+
+class FakeEngine:
+
+    def __init__(self, url, **kwargs):
+        self.url = url
+        self.disposed = False
+
+    def dispose(self):
+        self.disposed = True
+
+
+@pytest.fixture
+def tunnels(monkeypatch):
+    FakeTunnel.instances = []
+    monkeypatch.setattr(db_connection_aws, "SSHTunnelForwarder", FakeTunnel)
+    monkeypatch.setattr(db_connection_aws.sqlalchemy, "create_engine", FakeEngine)
+    monkeypatch.setattr(db_connection_aws, "get_ssh_tunnel_config", dict)
+    monkeypatch.setattr(db_connection_aws, "get_db_config", lambda: {
+        "db_type": "mysql", "con": "pymysql", "usr": "usr", "pw": "pw",
+        "host": "127.0.0.1", "db": "TTC"})
+    return FakeTunnel.instances
+
+
+def test_tunnel_manager_rebuilds_dead_tunnel_once(tunnels):
+
+    manager = TunnelManager(health_check_interval=30)
+
+    # The tunnel is opened on first use, and its engine handed out again.
+    engine = manager.get_engine()
+    assert manager.get_engine() is engine
+    assert len(tunnels) == 1
+    assert engine.url.endswith("@127.0.0.1:40000/TTC")
+
+    # Health checks are throttled.
+    assert manager._is_healthy()
+    assert tunnels[0].num_checks == 0
+
+    # A dead tunnel is replaced once, along with its engine.
+    tunnels[0].is_active = False
+    new_engine = manager.get_engine()
+    assert new_engine is not engine
+    assert engine.disposed and not tunnels[0].is_active
+    assert manager.get_engine() is new_engine
+    assert len(tunnels) == 2
+    assert new_engine.url.endswith("@127.0.0.1:40001/TTC")
+
+    # So is a tunnel whose forwarding is found down once the interval passed.
+    manager._last_health_check -= 60
+    tunnels[1].tunnel_is_up = {("127.0.0.1", 40001): False}
+    assert manager.get_engine() is not new_engine
+    assert tunnels[1].num_checks == 1
+    assert len(tunnels) == 3
+
+    manager.close()
+    assert manager.engine is None and not tunnels[2].is_active
+
+
+def test_get_tunnel_manager_is_process_wide():
+
+    assert isinstance(get_tunnel_manager(), TunnelManager)
+    assert get_tunnel_manager() is get_tunnel_manager()
+    assert db_connection_aws.Connection().tunnel_manager is get_tunnel_manager()
@@ -0,0 +1,113 @@
+"""
+Unit tests for map matching readings onto direction geometry.
+"""
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+from map_matching import MapMatcher
+from route_geometry import RouteGeometry, project_to_meters
+
+
+@pytest.fixture
+def geometry():
+    # Direction A heads north then east, B heads east. Both start at the same point.
+    return RouteGeometry.compile(pd.DataFrame({
+        "direction_tag": ["A"] * 3 + ["B"] * 2,
+        "path_along_direction": [1] * 5,
+        "point_along_path": [1, 2, 3, 1, 2],
+        "lat": [43.650, 43.660, 43.660, 43.650, 43.650],
+        "lon": [-79.380, -79.380, -79.370, -79.380, -79.370],
+    }))
+
+
+def test_match(geometry):
+
+    matcher = MapMatcher(geometry, cell_size_meters=200, max_distance_meters=100)
+    _, _, distance_a = geometry.get_polyline("A")
+    meters_per_degree = distance_a[1] / 0.01
+
+    df = pd.DataFrame({
+        "direction_tag": ["A", "A", "A", "B", "B", "C", None],
+        "lat": [43.655, 43.6603, 43.655, 43.6501, 43.650, 43.655, 43.655],
+        "lon": [-79.3801, -79.375, -79.370, -79.375, -79.390, -79.380, -79.380],
+    })
+    df = matcher.match_dataframe(df)
+
+    # Halfway up A, then halfway along its eastern leg, 33m off to the north.
+    assert df.distance_along_meters[0] == pytest.approx(0.005 * meters_per_degree, abs=1)
+    assert df.distance_along_meters[1] == pytest.approx(
+        distance_a[1] + (distance_a[2] - distance_a[1]) / 2, abs=1)
+    assert df.distance_to_route_meters[1] == pytest.approx(0.0003 * meters_per_degree, abs=1)
+
+    # Readings far from their direction, or of unknown directions, are not matched.
+    assert df.distance_along_meters[[2, 4, 5, 6]].isna().all()
+    assert df.distance_to_route_meters[[2, 4, 5, 6]].isna().all()
+
+    # Halfway along B, 11m off.
+    _, _, distance_b = geometry.get_polyline("B")
+    assert df.distance_along_meters[3] == pytest.approx(distance_b[1] / 2, abs=1)
+
+
+def test_match_agrees_with_brute_force(geometry):
+
+    rng = np.random.default_rng(0)
+    num_points = 2000
+    lat = rng.uniform(43.649, 43.661, size=num_points)
+    lon = rng.uniform(-79.381, -79.369, size=num_points)
+    direction_tags = rng.choice(["A", "B"], size=num_points)
+
+    matcher = MapMatcher(geometry, cell_size_meters=150, max_distance_meters=100)
+    along, to_route = matcher.match(direction_tags, lat, lon)
+
+    for tag in ["A", "B"]:
+        is_tag = direction_tags == tag
+        poly_lat, poly_lon, distance_meters = geometry.get_polyline(tag)
+        x, y = project_to_meters(lat[is_tag], lon[is_tag], matcher._lat0, matcher._lon0)
+        px, py = project_to_meters(poly_lat, poly_lon, matcher._lat0, matcher._lon0)
+
+        dx, dy = np.diff(px), np.diff(py)
+        t = np.clip(((x[:, None] - px[:-1]) * dx + (y[:, None] - py[:-1]) * dy)
+                    / (dx * dx + dy * dy), 0, 1)
+        distance = np.hypot(px[:-1] + t * dx - x[:, None], py[:-1] + t * dy - y[:, None])
+        nearest = distance.argmin(axis=1)
+        rows = np.arange(len(nearest))
+        expected_to_route = distance[rows, nearest]
+        expected_along = distance_meters[nearest] + t[rows, nearest] * np.diff(distance_meters)[nearest]
+
+        is_close = expected_to_route <= 100
+        np.testing.assert_allclose(to_route[is_tag][is_close], expected_to_route[is_close])
+        np.testing.assert_allclose(along[is_tag][is_close], expected_along[is_close])
+        assert np.isnan(along[is_tag][~is_close]).all()
+
+
+def test_get_times_at_stops_df(geometry):
+
+    matcher = MapMatcher(geometry)
+    start = datetime.datetime(2022, 1, 4, 8, 0)
+
+    # A vehicle heads north on A at constant speed, with a reading every minute.
+    trips_df = pd.DataFrame({
+        "vehicle_id": "4516",
+        "direction_tag": "A",
+        "lat": [43.651, 43.653, 43.655, 43.657],
+        "lon": -79.380,
+        "read_time": [start + datetime.timedelta(minutes=i) for i in range(4)],
+        "trip_id": start,
+    })
+    stops_df = pd.DataFrame({
+        "direction_tag": ["A"] * 4 + ["B"],
+        "stop_tag": ["1", "2", "3", "4", "5"],
+        "lat": [43.650, 43.652, 43.656, 43.660, 43.650],
+        "lon": [-79.380] * 5,
+        "stop_order": [1, 2, 3, 4, 1],
+    })
+
+    times_df = matcher.get_times_at_stops_df(trips_df, stops_df)
+
+    # Stops 1 and 4 are outside the stretch covered by the trip.
+    assert times_df.stop_tag.to_list() == ["2", "3"]
+    assert times_df.read_time.to_list() == [start + datetime.timedelta(seconds=30),
+                                            start + datetime.timedelta(seconds=150)]
+    assert list(times_df.columns) == ["stop_tag", "lat", "lon", "stop_order", "read_time",
+                                      "vehicle_id", "direction_tag", "trip_id"]
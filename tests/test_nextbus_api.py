@@ -0,0 +1,290 @@
+"""
+Unit tests for the NextBus API request handling (retries, circuit breaker,
+sessions and transfer stats).
+"""
+import gzip
+import io
+import json
+import pytest
+import requests
+import urllib3
+import nextbus_api
+from nextbus_api import NextBusAPI, NextBusAPIError, TransferStats, create_session
+
+
+class FakeResponse:
+
+    def __init__(self, payload, status_code=200):
+        self.content = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.raw = io.BytesIO(self.content)
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error", response=self)
+
+    def close(self):
+        pass
+
+
+class GzipResponse(FakeResponse):
+    """Response whose body is sent gzip encoded, read through urllib3."""
+
+    def __init__(self, payload):
+        self.wire_content = gzip.compress(json.dumps(payload).encode())
+        self.raw = urllib3.HTTPResponse(body=io.BytesIO(self.wire_content),
+                                        headers={"Content-Encoding": "gzip"},
+                                        status=200, preload_content=False)
+        self.status_code = 200
+
+    @property
+    def content(self):
+        return self.raw.read(decode_content=True)
+
+
+class FakeSession:
+    """Returns the given outcomes in order, one per get call."""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.num_calls = 0
+        self.urls = []
+
+    def get(self, url, timeout=None, stream=False):
+        self.num_calls += 1
+        self.urls.append(url)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, requests.RequestException):
+            raise outcome
+        if isinstance(outcome, int):
+            return FakeResponse(b"", status_code=outcome)
+        if isinstance(outcome, FakeResponse):
+            return outcome
+        return FakeResponse(outcome)
+
+
+def test_get_response_dict_from_web_retries_transient_errors():
+
+    session = FakeSession([requests.Timeout(), b"<html>Not json</html>", {"route": []}])
+    api = NextBusAPI(session=session, max_retries=3, backoff_base=0)
+
+    response = api.get_response_dict_from_web("routeList", agency_tag="ttc")
+
+    assert response == {"route": []}
+    assert session.num_calls == 3
+
+
+def test_get_response_dict_from_web_raises_after_retries():
+
+    session = FakeSession([requests.ConnectionError()] * 3)
+    api = NextBusAPI(session=session, max_retries=2, backoff_base=0)
+
+    with pytest.raises(NextBusAPIError):
+        api.get_response_dict_from_web("routeList", agency_tag="ttc")
+    assert session.num_calls == 3
+
+
+def test_api_error_in_body_is_retried_only_when_allowed():
+
+    retry_error = {"Error": {"content": "Too much data", "shouldRetry": "true"}}
+    final_error = {"Error": {"content": "Bad route", "shouldRetry": "false"}}
+    session = FakeSession([retry_error, final_error])
+    api = NextBusAPI(session=session, max_retries=3, backoff_base=0)
+
+    with pytest.raises(NextBusAPIError):
+        api.get_response_dict_from_web("routeList", agency_tag="ttc")
+    assert session.num_calls == 2
+
+
+def test_client_errors_are_not_retried_nor_open_the_circuit():
+
+    unknown_vehicle = {"Error": {"content": "Vehicle not found", "shouldRetry": "false"}}
+    session = FakeSession([unknown_vehicle] * 3 + [404, 503, {"vehicle": []}])
+    api = NextBusAPI(session=session, max_retries=3, backoff_base=0, failure_threshold=2)
+
+    for _ in range(4):
+        with pytest.raises(NextBusAPIError):
+            api.get_response_dict_from_web("vehicleLocation", agency_tag="ttc", vehicle_id="1")
+    assert session.num_calls == 4
+
+    # Server errors are retried, and the circuit is still closed.
+    assert api.get_response_dict_from_web("vehicleLocation", agency_tag="ttc",
+                                          vehicle_id="1") == {"vehicle": []}
+    assert session.num_calls == 6
+
+
+def test_circuit_breaker_pauses_failing_endpoint():
+
+    session = FakeSession([requests.Timeout()] * 2 + [{"route": []}])
+    api = NextBusAPI(session=session, max_retries=0, backoff_base=0,
+                     failure_threshold=2, reset_timeout=60)
+
+    for _ in range(2):
+        with pytest.raises(NextBusAPIError):
+            api.get_response_dict_from_web("routeList", agency_tag="ttc")
+
+    # Circuit is now open: the request is refused without calling the API.
+    with pytest.raises(NextBusAPIError):
+        api.get_response_dict_from_web("routeList", agency_tag="ttc")
+    assert session.num_calls == 2
+
+    # Other endpoints are unaffected. 
+    assert api.get_response_dict_from_web("agencyList") == {"route": []}
+
+
+def test_iter_response_items_from_web():
+
+    schedules = [{"serviceClass": "wkd", "tr": []}, {"serviceClass": "sat", "tr": []}]
+    session = FakeSession([{"route": schedules}, {"route": schedules[0]}])
+    api = NextBusAPI(session=session)
+
+    items = api.iter_response_items_from_web(
+                "schedule", prefix="route.item", agency_tag="ttc", route_tag="7")
+    assert list(items) == schedules
+
+    # A single schedule is sent as a dict rather than a list. 
+    items = api.iter_response_items_from_web(
+                "schedule", prefix="route.item", agency_tag="ttc", route_tag="7")
+    assert list(items) == schedules[:1]
+
+
+def test_iter_response_items_from_web_raises_api_errors():
+
+    schedules = [{"serviceClass": "wkd", "tr": []}]
+    retry_error = {"Error": {"content": "Too much data", "shouldRetry": "true"}}
+    final_error = {"Error": {"content": "Bad route", "shouldRetry": "false"}}
+    session = FakeSession([retry_error, {"route": schedules}, final_error])
+    api = NextBusAPI(session=session, max_retries=3, backoff_base=0, failure_threshold=1)
+
+    # A retryable error is retried, and the items of the next response yielded.
+    items = api.iter_response_items_from_web(
+                "schedule", prefix="route.item", agency_tag="ttc", route_tag="7")
+    assert list(items) == schedules
+    assert session.num_calls == 2
+
+    items = api.iter_response_items_from_web(
+                "schedule", prefix="route.item", agency_tag="ttc", route_tag="8")
+    with pytest.raises(NextBusAPIError, match="Bad route"):
+        list(items)
+    assert session.num_calls == 3
+    assert not api.circuit_breakers["schedule"].is_open()
+
+
+def test_iter_response_items_from_web_shares_one_attempt_budget():
+
+    retry_error = {"Error": {"content": "Too much data", "shouldRetry": "true"}}
+    session = FakeSession([requests.ConnectionError(), retry_error, 503, retry_error,
+                           {"route": []}])
+    api = NextBusAPI(session=session, max_retries=3, backoff_base=0, failure_threshold=1)
+
+    # Transport and body errors count against the same retries.
+    items = api.iter_response_items_from_web(
+                "schedule", prefix="route.item", agency_tag="ttc", route_tag="7")
+    with pytest.raises(NextBusAPIError, match="Too much data"):
+        list(items)
+    assert session.num_calls == 4
+    assert api.circuit_breakers["schedule"].is_open()
+
+
+def test_iter_response_items_from_web_records_success_after_stream():
+
+    session = FakeSession([b'{"route": [{"serviceClass": "wkd"}, {"serviceC'])
+    api = NextBusAPI(session=session, max_retries=0, failure_threshold=1)
+    breaker = api._get_circuit_breaker("schedule")
+    breaker.failures = 1
+
+    items = api.iter_response_items_from_web(
+                "schedule", prefix="route.item", agency_tag="ttc", route_tag="7")
+    assert next(items) == {"serviceClass": "wkd"}
+    assert breaker.failures == 1      # headers alone are not a success
+
+    with pytest.raises(NextBusAPIError):
+        list(items)
+    assert breaker.is_open()
+
+
+def test_get_route_config_response_dicts_from_web_requests_batches():
+
+    route_tags = [str(i) for i in range(250)]
+    session = FakeSession([{"route": [{"tag": "0"}, {"tag": "1"}]}, 500, {"route": {"tag": "249"}},
+                           {"route": []}, 500])
+    api = NextBusAPI(session=session, max_retries=0)
+
+    # Up to 100 routes per request, and a failed batch is skipped.
+    errors = []
+    responses = list(api.get_route_config_response_dicts_from_web(
+                        "ttc", route_tags, on_error=errors.append))
+    assert session.num_calls == 3
+    assert [url.count("&r=") for url in session.urls] == [100, 100, 50]
+    assert "&r=100&" in session.urls[1] and "&r=199&" in session.urls[1]
+    assert responses == [{"route": [{"tag": "0"}, {"tag": "1"}]}, {"route": {"tag": "249"}}]
+    assert len(errors) == 1
+
+    # Without on_error, a failed batch raises.
+    responses = api.get_route_config_response_dicts_from_web("ttc", route_tags)
+    assert next(responses) == {"route": []}
+    with pytest.raises(NextBusAPIError):
+        next(responses)
+
+
+def test_create_session():
+
+    session = create_session(pool_size=2)
+    adapter = session.get_adapter("https://retro.umoiq.com/service/publicJSONFeed")
+
+    assert adapter is session.get_adapter("http://retro.umoiq.com")
+    assert adapter._pool_maxsize == 2
+    assert adapter.max_retries.total == 0     # retries are left to NextBusAPI
+    assert "gzip" in session.headers["Accept-Encoding"]
+    assert session.headers["Connection"] == "keep-alive"
+
+
+def test_transfer_stats_window(monkeypatch):
+
+    now = [100.0]
+    monkeypatch.setattr(nextbus_api.time, "monotonic", lambda: now[0])
+
+    stats = TransferStats(window_seconds=20)
+    stats.record(wire_bytes=1000, content_bytes=5000)
+    now[0] += 15
+    stats.record(wire_bytes=500, content_bytes=2000)
+    assert stats.get_wire_bytes_in_window() == 1500
+
+    now[0] += 10
+    assert stats.get_wire_bytes_in_window() == 500
+    assert (stats.num_requests, stats.wire_bytes, stats.content_bytes) == (2, 1500, 7000)
+
+
+def test_gzip_responses_count_wire_bytes():
+
+    payload = {"route": [{"serviceClass": "wkd", "tr": [{"blockID": str(i)} for i in range(100)]}]}
+    content_length = len(json.dumps(payload).encode())
+    responses = [GzipResponse(payload), GzipResponse(payload)]
+    api = NextBusAPI(session=FakeSession(responses))
+
+    assert api.get_response_dict_from_web("routeList", agency_tag="ttc") == payload
+    items = api.iter_response_items_from_web(
+                "schedule", prefix="route.item", agency_tag="ttc", route_tag="7")
+    assert list(items) == payload["route"]
+
+    # Wire bytes are the compressed bytes read, content bytes the decoded ones.
+    wire_length = len(responses[0].wire_content)
+    assert wire_length < content_length
+    assert api.stats.wire_bytes == 2 * wire_length
+    assert api.stats.content_bytes == 2 * content_length
+
+
+def test_get_connection_stats():
+
+    api = NextBusAPI(session=create_session())
+    pool = api.session.get_adapter("https://retro.umoiq.com") \
+                      .poolmanager.connection_from_url("https://retro.umoiq.com")
+    pool.num_connections = 1
+    for _ in range(3):
+        api.stats.record(wire_bytes=100, content_bytes=400)
+
+    stats = api.get_connection_stats()
+    assert stats["requests"] == 3
+    assert stats["new_connections"] == 1 and stats["reused_connections"] == 2
+    assert stats["wire_bytes"] == stats["wire_bytes_in_window"] == 300
+    assert stats["content_bytes"] == 1200
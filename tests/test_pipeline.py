@@ -0,0 +1,199 @@
+"""
+Unit tests for the DataLoader collection cycle, with a fake API client.
+"""
+import datetime
+import json
+import re
+import pandas as pd
+import requests
+from nextbus_api import NextBusAPI, NextBusAPIError
+from pipeline import DataLoader
+
+
+class FakeClient:
+    """Context manager standing in for NextBusAPIClient, answering each
+    vehicleLocations request from a dict of responses by route tag. Routes
+    missing from it fail."""
+
+    def __init__(self):
+        self.responses = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def get_response_dict_from_web(self, endpoint_name, agency_tag, route_tag, **kwargs):
+        if route_tag not in self.responses:
+            raise NextBusAPIError("Request to endpoint 'vehicleLocations' failed.")
+        return self.responses[route_tag]
+
+
+class FakeResponse:
+
+    def __init__(self, payload, status_code=200):
+        self.content = json.dumps(payload).encode()
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error", response=self)
+
+
+class FakeWebSession:
+    """Session answering each GET request with respond(command, params), the 
+    params being the list of values of each query parameter. An int answer 
+    is returned as an error status."""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.urls = []
+
+    def get(self, url, timeout=None, stream=False):
+        self.urls.append(url)
+        params = {}
+        for name, value in re.findall(r"[?&](\w+)=([^&]*)", url):
+            params.setdefault(name, []).append(value)
+        answer = self.respond(params["command"][0], params)
+        if isinstance(answer, int):
+            return FakeResponse(None, status_code=answer)
+        return FakeResponse(answer)
+
+
+class FakeWebClient:
+    """Context manager standing in for NextBusAPIClient, handing out an API
+    over a FakeWebSession, without retries."""
+
+    def __init__(self, respond):
+        self.session = FakeWebSession(respond)
+
+    def __enter__(self):
+        return NextBusAPI(session=self.session, max_retries=0)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def make_vehicle(vehicle_id, route_tag, secs_since_report):
+    return {"id": vehicle_id, "routeTag": route_tag, "dirTag": f"{route_tag}_0_{route_tag}",
+            "lat": "43.65", "lon": "-79.38", "heading": "90", "speedKmHr": "0",
+            "predictable": "true", "secsSinceReport": str(secs_since_report)}
+
+
+def test_run_collection_cycle_keeps_old_readings(db):
+
+    db.insert_dataframe_in_table("agencies", pd.DataFrame({"id": [1], "tag": ["ttc"]}))
+    db.insert_dataframe_in_table("routes", pd.DataFrame({
+        "tag": ["504", "506"], "title": ["504", "506"],
+        "latmin": [43.6] * 2, "latmax": [43.7] * 2, "lonmin": [-79.5] * 2, "lonmax": [-79.3] * 2,
+        "agency_tag": ["ttc"] * 2}))
+
+    loader = DataLoader(db, db.session)
+    loader.nextbus_client = FakeClient()
+
+    # The request for the 504 fails; vehicle 4470 last reported 15 minutes ago.
+    loader.nextbus_client.responses["506"] = {"vehicle": [make_vehicle("4516", "506", 10),
+                                                         make_vehicle("4470", "506", 900)]}
+    loader.run_collection_cycle(max_report_age_seconds=300)
+
+    df_vehicles = db.query("SELECT * FROM vehicles ORDER BY id")
+    assert df_vehicles.id.to_list() == ["4470", "4516"]
+    last_seen = pd.to_datetime(df_vehicles.last_seen_active)
+    age = (pd.Timestamp(datetime.datetime.now()) - last_seen).dt.total_seconds()
+    assert age.round(-1).to_list() == [900, 10]
+
+    # Next cycle, the 504 answers with a reading missed by the failed request,
+    # and the 506 repeats the same readings.
+    loader.nextbus_client.responses["504"] = {"vehicle": make_vehicle("1234", "504", 60)}
+    loader.run_collection_cycle(max_report_age_seconds=300)
+
+    df_locations = db.query("SELECT * FROM vehicle_locations ORDER BY id")
+    assert df_locations.id.to_list() == ["1234", "4470", "4516"]
+    assert df_locations.key.is_unique
+    assert loader.recent_keys.num_dropped == 2
+
+    df_quality = db.get_vehicle_locations_quality_dataframe(since=datetime.datetime(2000, 1, 1))
+    assert df_quality.readings.sum() == 5
+    assert df_quality.stale_readings.sum() == 2
+
+
+def make_route_config(route_tag):
+    return {"tag": route_tag, "title": route_tag, "latMin": "43.6", "latMax": "43.7",
+            "lonMin": "-79.5", "lonMax": "-79.3",
+            "stop": {"tag": f"s{route_tag}", "title": route_tag, "lat": "43.65", 
+                     "lon": "-79.4", "stopId": route_tag},
+            "direction": {"tag": f"{route_tag}_0", "title": route_tag, "name": "East",
+                          "branch": route_tag, "stop": {"tag": f"s{route_tag}"}}}
+
+
+def test_populate_transit_config_tables_from_API_batches_routes(db):
+
+    db.insert_dataframe_in_table("agencies", pd.DataFrame({"id": [1], "tag": ["ttc"]}))
+    db.insert_dataframe_in_table("directions", pd.DataFrame({
+        "tag": ["150_old"], "title": ["150"], "name": ["East"], "route_tag": ["150"],
+        "branch": ["150"], "agency_tag": ["ttc"]}))
+
+    route_tags = [str(i) for i in range(250)]
+    def respond(command, params):
+        if command == "routeList":
+            return {"route": [{"tag": tag, "title": tag} for tag in route_tags]}
+        if "150" in params["r"]:
+            return 500
+        return {"route": [make_route_config(tag) for tag in params["r"]]}
+
+    loader = DataLoader(db, db.session)
+    loader.nextbus_client = FakeWebClient(respond)
+    loader.populate_transit_config_tables_from_API()
+
+    # One request for the list of routes, then one per 100 routes.
+    urls = loader.nextbus_client.session.urls
+    assert len(urls) == 4
+    assert [url.count("&r=") for url in urls[1:]] == [100, 100, 50]
+
+    # Multi-route responses are split by route, and the routes of the failed
+    # batch are left as they are.
+    stored = [tag for tag in route_tags if not 100 <= int(tag) < 200]
+    df_routes = db.query("SELECT * FROM routes")
+    df_directions = db.query("SELECT * FROM directions")
+    df_stops = db.query("SELECT * FROM stops")
+    assert sorted(df_routes.tag) == sorted(stored)
+    assert sorted(df_directions.tag) == sorted([f"{tag}_0" for tag in stored] + ["150_old"])
+    assert (df_stops.direction_tag == df_stops.route_tag + "_0").all()
+    assert len(df_stops) == len(stored)
+
+
+def test_fetch_predictions_from_API_batches_stops(db):
+
+    db.insert_dataframe_in_table("agencies", pd.DataFrame({"id": [1], "tag": ["ttc"]}))
+    stop_counts = {"504": 320, "506": 3}
+    db.insert_dataframe_in_table("stops", pd.DataFrame([
+        {"tag": f"{route_tag}-{i}", "title": str(i), "lat": 43.65, "lon": -79.38,
+         "route_tag": route_tag, "direction_tag": f"{route_tag}_0", 
+         "stop_along_direction": i, "key": f"{route_tag}-{i}_{route_tag}_0", "agency_tag": "ttc"}
+        for route_tag, num_stops in stop_counts.items() for i in range(num_stops)]))
+
+    def respond(command, params):
+        assert command == "predictionsForMultiStops"
+        predictions = []
+        for stop in params["stops"]:
+            route_tag, stop_tag = stop.split("|")
+            predictions.append({"routeTag": route_tag, "stopTag": stop_tag, 
+                                "direction": {"prediction": {
+                                    "dirTag": f"{route_tag}_0", "vehicle": "4516",
+                                    "seconds": "120", "epochTime": "1640139474000"}}})
+        return {"predictions": predictions}
+
+    loader = DataLoader(db, db.session)
+    loader.nextbus_client = FakeWebClient(respond)
+    loader.fetch_predictions_from_API()
+
+    # Up to 150 stops per request, each on a single route.
+    urls = loader.nextbus_client.session.urls
+    assert [url.count("&stops=") for url in urls] == [150, 150, 20, 3]
+    assert all(url.count("&stops=504|") in (0, url.count("&stops=")) for url in urls)
+
+    df_predictions = db.query("SELECT * FROM predictions")
+    assert len(df_predictions) == sum(stop_counts.values())
+    assert df_predictions.key.is_unique
+    assert df_predictions.groupby("route_tag").size().to_dict() == stop_counts
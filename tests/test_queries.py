@@ -0,0 +1,48 @@
+"""
+Unit tests for the registry of named queries and the .sql files loader.
+"""
+import os
+import pytest
+from sqlalchemy.dialects import mysql, sqlite
+from utils.queries import NAMED_QUERIES, get_named_query, load_sql_file, load_sql_files
+
+
+@pytest.fixture
+def queries_path(tmp_path, monkeypatch):
+    monkeypatch.setenv("QUERIES_PATH", str(tmp_path))
+    load_sql_files.cache_clear()
+    yield tmp_path
+    load_sql_files.cache_clear()
+
+
+@pytest.mark.parametrize("name", sorted(NAMED_QUERIES))
+def test_named_queries_compile(name):
+
+    stmt = get_named_query(name)
+    assert get_named_query(name) is stmt    # built once
+
+    for dialect in [mysql.dialect(), sqlite.dialect()]:
+        compiled = stmt.compile(dialect=dialect)
+        assert set(compiled.params) == set(stmt._bindparams)
+
+
+def test_load_sql_file_reads_from_queries_path(queries_path):
+
+    (queries_path / "fleet_size.sql").write_text("SELECT 1")
+    (queries_path / "notes.txt").write_text("not a query")
+
+    assert load_sql_file("fleet_size.sql") == "SELECT 1"
+    assert list(load_sql_files()) == ["fleet_size.sql"]
+
+    # Files are read once, on first use.
+    (queries_path / "fleet_size.sql").write_text("SELECT 2")
+    assert load_sql_file("fleet_size.sql") == "SELECT 1"
+
+
+def test_load_sql_files_reads_repository_queries(queries_path, monkeypatch):
+
+    repo_queries_path = os.path.join(os.path.dirname(__file__), os.pardir, "queries")
+    monkeypatch.setenv("QUERIES_PATH", repo_queries_path)
+
+    assert "get_all_stops_data.sql" in load_sql_files()
+    assert all(text.strip() for text in load_sql_files().values())
@@ -6256,6 +6256,120 @@ def test_parse_route_config_response_into_df_dict():
     pd.testing.assert_frame_equal(df_directions, df_directions_answer)
     pd.testing.assert_frame_equal(df_stops, df_stops_answer)
 
+def test_parse_multi_route_config_response_into_df_dict():
+    """Responses for multiple routes hold a list of routes under the 'route'
+    key. These are split by route, and the dataframes concatenated."""
+
+    parser = ResponseParser()
+
+    #------------------- Test multi-route response --------------------------
+    response = {
+        'copyright': 'All data copyright Toronto Transit Commission 2021.',
+        'route': [{'tag': '7',
+                'title': '7-Bathurst',
+                'latMin': '43.6364499',
+                'latMax': '43.7878499',
+                'lonMin': '-79.44893',
+                'lonMax': '-79.4015699',
+                'stop': [{'tag': '1001', 'title': 'Bathurst St At Steeles Ave West',
+                        'lat': '43.7878499', 'lon': '-79.44893', 'stopId': '2'},
+                        {'tag': '1002', 'title': 'Bathurst Station',
+                        'lat': '43.6652399', 'lon': '-79.4114', 'stopId': '3'}],
+                'direction': {'tag': '7_0_7', 
+                        'title': 'South - 7 Bathurst towards Bathurst Station',
+                        'name': 'South',
+                        'branch': '7',
+                        'stop': [{'tag': '1001'}, {'tag': '1002'}]}},
+            {'tag': '8',
+                'title': '8-Broadview',
+                'latMin': '43.6766599',
+                'latMax': '43.6866999',
+                'lonMin': '-79.35833',
+                'lonMax': '-79.3481099',
+                'stop': [{'tag': '2001', 'title': 'Broadview Station',
+                        'lat': '43.6766599', 'lon': '-79.35833', 'stopId': '4'}],
+                'direction': [{'tag': '8_1_8',
+                        'title': 'North - 8 Broadview towards Coxwell Station',
+                        'name': 'North',
+                        'branch': '8',
+                        'stop': [{'tag': '2001'}]}]}]
+    }
+
+    route_responses = parser.split_route_config_response(response) 
+    assert [tag for tag, _ in route_responses] == ['7', '8']
+
+    df_dict = parser.parse_route_config_response_into_df_dict(
+                                        response_dict=response,
+                                        route_tag=None,
+                                        agency_tag="ttc" 
+                                        )
+    df_routes = df_dict['routes']
+    df_directions = df_dict['directions']
+    df_stops = df_dict['stops'] 
+
+    # Expected answer. 
+    routes_answer = [{'tag': '7',
+                    'title': '7-Bathurst',
+                    'latmin': 43.6364499,
+                    'latmax': 43.7878499,
+                    'lonmin': -79.44893,
+                    'lonmax': -79.4015699,
+                    'agency_tag': 'ttc'},
+                    {'tag': '8',
+                    'title': '8-Broadview',
+                    'latmin': 43.6766599,
+                    'latmax': 43.6866999,
+                    'lonmin': -79.35833,
+                    'lonmax': -79.3481099,
+                    'agency_tag': 'ttc'}]
+    directions_answer = [{'tag': '7_0_7',
+                        'title': 'South - 7 Bathurst towards Bathurst Station',
+                        'name': 'South',
+                        'route_tag': '7',
+                        'branch': '7',
+                        'agency_tag': 'ttc'},
+                        {'tag': '8_1_8',
+                        'title': 'North - 8 Broadview towards Coxwell Station',
+                        'name': 'North',
+                        'route_tag': '8',
+                        'branch': '8',
+                        'agency_tag': 'ttc'}]
+    stops_answer = [{'tag': '1001',
+                    'title': 'Bathurst St At Steeles Ave West',
+                    'lat': 43.7878499,
+                    'lon': -79.44893,
+                    'route_tag': '7',
+                    'direction_tag': '7_0_7',
+                    'stop_along_direction': 1,
+                    'key': '1001_7_0_7',
+                    'agency_tag': 'ttc'},
+                    {'tag': '1002',
+                    'title': 'Bathurst Station',
+                    'lat': 43.6652399,
+                    'lon': -79.4114,
+                    'route_tag': '7',
+                    'direction_tag': '7_0_7',
+                    'stop_along_direction': 2,
+                    'key': '1002_7_0_7',
+                    'agency_tag': 'ttc'},
+                    {'tag': '2001',
+                    'title': 'Broadview Station',
+                    'lat': 43.6766599,
+                    'lon': -79.35833,
+                    'route_tag': '8',
+                    'direction_tag': '8_1_8',
+                    'stop_along_direction': 1,
+                    'key': '2001_8_1_8',
+                    'agency_tag': 'ttc'}]
+
+    df_routes_answer = pd.DataFrame(routes_answer)
+    df_directions_answer = pd.DataFrame(directions_answer)
+    df_stops_answer = pd.DataFrame(stops_answer)
+
+    pd.testing.assert_frame_equal(df_routes, df_routes_answer) 
+    pd.testing.assert_frame_equal(df_directions, df_directions_answer)
+    pd.testing.assert_frame_equal(df_stops, df_stops_answer)
+
 def test_parse_schedule_response_into_df_dict():
 
     parser = ResponseParser() 
@@ -13945,9 +14059,9 @@ def test_parse_vehicle_locations_response_into_df_dict():
                     'key': '4516_2021-12-21 21:17'}]
     vehicle_locations_types = {
         "route_tag": "str",
-        "predictable": "bool",
-        "heading": "int",
-        "speed_kmhr": "int",
+        "predictable": "boolean",
+        "heading": "Int64",
+        "speed_kmhr": "Int64",
         "lat": "float",
         "lon": "float",
         "id": "str",
@@ -13996,9 +14110,9 @@ def test_parse_vehicle_locations_response_into_df_dict():
                                 'key': '4470_2021-12-21 21:17'}]
     vehicle_locations_types = {
         "route_tag": "str",
-        "predictable": "bool",
-        "heading": "int",
-        "speed_kmhr": "int",
+        "predictable": "boolean",
+        "heading": "Int64",
+        "speed_kmhr": "Int64",
         "lat": "float",
         "lon": "float",
         "id": "str",
@@ -14012,3 +14126,208 @@ def test_parse_vehicle_locations_response_into_df_dict():
     df_vehicle_locations_answer = df_vehicle_locations_answer.astype(vehicle_locations_types)  
 
     pd.testing.assert_frame_equal(df_vehicle_locations, df_vehicle_locations_answer)
+
+    #------------------- Test missing values -------------------------------
+    # Fields missing from a vehicle are null, not 'None' strings.
+    response = {'vehicle': [{'routeTag': '510',
+                'predictable': 'false',
+                'speedKmHr': '0',
+                'lon': '-79.4002151',
+                'id': '4470',
+                'lat': '43.6585044',
+                'secsSinceReport': '31'},
+                {'routeTag': '510',
+                'predictable': 'true',
+                'heading': '338',
+                'speedKmHr': '0',
+                'lon': '-79.4002151',
+                'id': '4497',
+                'dirTag': '510_1_510A',
+                'lat': '43.6585044',
+                'secsSinceReport': '31'}]}
+
+    df_dict = parser.parse_vehicle_locations_response_into_df_dict(
+                                        response_dict=response,
+                                        agency_tag='ttc',
+                                        time_of_extraction=time_tested)
+    df_vehicle_locations = df_dict["vehicle_locations"]
+
+    assert df_vehicle_locations["direction_tag"].to_list() == [None, '510_1_510A']
+    assert df_vehicle_locations["heading"].isna().to_list() == [True, False]
+    assert df_vehicle_locations["predictable"].to_list() == [False, True]
+
+def test_parse_predictions_response_into_df_dict():
+    """Test the predictions parse method, on a predictionsForMultiStops 
+    response. Stops, directions and predictions are either lists of dicts
+    or single dicts, depending on the number of elements."""
+
+    parser = ResponseParser()
+
+    #------------------- Test actual response ----------------------------
+    response = {'copyright': 'All data copyright Toronto Transit Commission 2021.',
+                'predictions': [{'agencyTitle': 'Toronto Transit Commission',
+                'routeTag': '506',
+                'routeTitle': '506-Carlton',
+                'stopTitle': 'Carlton St At Yonge St',
+                'stopTag': '3246',
+                'direction': {'title': 'East - 506 Carlton towards Main Street Station',
+                    'prediction': [{'epochTime': '1640139536432',
+                    'seconds': '59',
+                    'minutes': '0',
+                    'isDeparture': 'false',
+                    'affectedByLayover': 'true',
+                    'branch': '506',
+                    'dirTag': '506_0_506',
+                    'vehicle': '4516',
+                    'block': '506_6_60',
+                    'tripTag': '42411806'},
+                    {'epochTime': '1640139897012',
+                    'seconds': '420',
+                    'minutes': '7',
+                    'isDeparture': 'false',
+                    'branch': '506',
+                    'dirTag': '506_0_506',
+                    'vehicle': '4470',
+                    'block': '506_12_120',
+                    'tripTag': '42411807'}]}},
+                {'agencyTitle': 'Toronto Transit Commission',
+                'routeTag': '506',
+                'routeTitle': '506-Carlton',
+                'stopTitle': 'Main Street Station',
+                'stopTag': '14260',
+                'dirTitleBecauseNoPredictions': 'East - 506 Carlton towards Main Street Station'}]}
+
+    time_tested = datetime.datetime(2021, 12, 21, 21, 18, 24, 686691)
+
+    df_dict = parser.parse_predictions_response_into_df_dict(
+                                        response_dict=response, 
+                                        agency_tag='ttc', 
+                                        time_of_extraction=time_tested)
+    df_predictions = df_dict["predictions"]
+
+    # Expected answer.
+    predictions_answer = [{'route_tag': '506',
+                    'stop_tag': '3246',
+                    'direction_tag': '506_0_506',
+                    'vehicle_id': '4516',
+                    'block_id': '506_6_60',
+                    'trip_tag': '42411806',
+                    'is_departure': False,
+                    'affected_by_layover': True,
+                    'seconds': 59,
+                    'epoch_time': 1640139536432,
+                    'predicted_time': Timestamp('2021-12-21 21:19:23.686691'),
+                    'agency_tag': 'ttc',
+                    'read_time': Timestamp('2021-12-21 21:18:24.686691'),
+                    'key': '3246_506_0_506_4516_2021-12-21 21:18'},
+                    {'route_tag': '506',
+                    'stop_tag': '3246',
+                    'direction_tag': '506_0_506',
+                    'vehicle_id': '4470',
+                    'block_id': '506_12_120',
+                    'trip_tag': '42411807',
+                    'is_departure': False,
+                    'affected_by_layover': False,
+                    'seconds': 420,
+                    'epoch_time': 1640139897012,
+                    'predicted_time': Timestamp('2021-12-21 21:25:24.686691'),
+                    'agency_tag': 'ttc',
+                    'read_time': Timestamp('2021-12-21 21:18:24.686691'),
+                    'key': '3246_506_0_506_4470_2021-12-21 21:18'}]
+    predictions_types = {
+        "route_tag": "str",
+        "stop_tag": "str",
+        "direction_tag": "str",
+        "vehicle_id": "str",
+        "block_id": "str",
+        "trip_tag": "str",
+        "is_departure": "boolean",
+        "affected_by_layover": "bool",
+        "seconds": "Int64",
+        "epoch_time": "Int64",
+        "predicted_time": "datetime64[ns]",
+        "agency_tag": "str",
+        "read_time": "datetime64[ns]",
+        "key": "str"
+    }
+
+    df_predictions_answer = pd.DataFrame(predictions_answer)
+    df_predictions_answer = df_predictions_answer.astype(predictions_types)  
+
+    pd.testing.assert_frame_equal(df_predictions, df_predictions_answer)
+
+    #------------------- Test response without predictions -----------------
+    response = {'copyright': 'All data copyright Toronto Transit Commission 2021.',
+                'predictions': {'agencyTitle': 'Toronto Transit Commission',
+                'routeTag': '506',
+                'stopTag': '14260',
+                'dirTitleBecauseNoPredictions': 'East - 506 Carlton towards Main Street Station'}}
+
+    df_dict = parser.parse_predictions_response_into_df_dict(
+                                        response_dict=response, 
+                                        agency_tag='ttc', 
+                                        time_of_extraction=time_tested)
+
+    assert df_dict["predictions"] is None
+
+    #------------------- Test predictions with missing values --------------
+    # Predictions missing seconds or vehicle are kept, with distinct keys.
+    response = {'predictions': {'routeTag': '506', 'stopTag': '3246',
+                'direction': {'prediction': [
+                    {'epochTime': '1640139536432', 'dirTag': '506_0_506',
+                     'vehicle': '4516', 'tripTag': '42411806'},
+                    {'epochTime': '1640139897012', 'seconds': '420', 
+                     'dirTag': '506_0_506', 'tripTag': '42411807'},
+                    {'seconds': '600', 'tripTag': '42411808'}]}}}
+
+    df_predictions = parser.parse_predictions_response_into_df_dict(
+                                        response_dict=response, 
+                                        agency_tag='ttc', 
+                                        time_of_extraction=time_tested)["predictions"]
+
+    assert df_predictions.seconds.isna().to_list() == [True, False, False]
+    assert df_predictions.epoch_time.isna().to_list() == [False, False, True]
+    assert df_predictions.predicted_time.isna().to_list() == [True, False, False]
+    assert df_predictions.vehicle_id.isna().to_list() == [False, True, True]
+    assert df_predictions.key.to_list() == ['3246_506_0_506_4516_2021-12-21 21:18',
+                                            '3246_506_0_506_42411807_2021-12-21 21:18',
+                                            '3246__42411808_2021-12-21 21:18']
+
+def test_parse_route_config_response_paths_into_df(): 
+
+    parser = ResponseParser()
+
+    # Paths shared by directions are listed once per id, and single points or
+    # tags come as dicts. The last path matches no direction of the route.
+    response = {
+        'route': {'tag': '506',
+            'stop': [{'tag': '1', 'title': 'A', 'lat': '43.64', 'lon': '-79.45'},
+                     {'tag': '2', 'title': 'B', 'lat': '43.65', 'lon': '-79.44'}],
+            'direction': [{'tag': '506_1_506', 'title': 'East', 'name': 'East',
+                           'branch': '506', 'stop': [{'tag': '1'}, {'tag': '2'}]},
+                          {'tag': '506_1_506hp', 'title': 'East', 'name': 'East',
+                           'branch': '506', 'stop': {'tag': '2'}}],
+            'path': [{'tag': [{'id': '506_1_506hp_8_1_2'}, {'id': '506_1_506_8_1_2'}],
+                      'point': [{'lon': '-79.45', 'lat': '43.64'},
+                                {'lon': '-79.44', 'lat': '43.65'}]},
+                     {'tag': {'id': '506_1_506_12_2_3_ar'},
+                      'point': {'lon': '-79.44', 'lat': '43.65'}},
+                     {'tag': {'id': '505_0_505_1_4_5'},
+                      'point': {'lon': '-79.40', 'lat': '43.66'}}]}
+    }
+
+    df_dict = parser.parse_route_config_response_into_df_dict(
+                        response_dict=response, route_tag="506", agency_tag="ttc")
+    df_route_paths = df_dict["route_paths"]
+
+    assert df_route_paths.key.to_list() == ["506_1_506hp_8_1_2_1", "506_1_506hp_8_1_2_2",
+                                            "506_1_506_8_1_2_1", "506_1_506_8_1_2_2",
+                                            "506_1_506_12_2_3_ar_1"]
+    assert df_route_paths.direction_tag.to_list() == ["506_1_506hp"] * 2 + ["506_1_506"] * 3
+    assert df_route_paths.path_along_direction.to_list() == [8, 8, 8, 8, 12]
+    assert df_route_paths.point_along_path.to_list() == [1, 2, 1, 2, 1]
+    assert df_route_paths.lat.to_list() == [43.64, 43.65, 43.64, 43.65, 43.65]
+    assert (df_route_paths.route_tag == "506").all()
+    assert list(df_route_paths.columns) == ["key", "path_id", "direction_tag", 
+                                            "path_along_direction", "point_along_path",
+                                            "lat", "lon", "route_tag", "agency_tag"]
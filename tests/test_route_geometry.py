@@ -0,0 +1,48 @@
+"""
+Unit tests for the simplified route geometry.
+"""
+import numpy as np
+import pandas as pd
+from route_geometry import RouteGeometry, project_to_meters, simplify_polyline
+
+
+def test_simplify_polyline():
+
+    # A straight line with a 2m wiggle, then a 50m detour.
+    x = np.arange(0, 1100, 100, dtype=float)
+    y = np.array([0, 2, 0, -2, 0, 50, 0, 0, 0, 0, 0], dtype=float)
+
+    assert simplify_polyline(x, y, tolerance=5).tolist() == [0, 4, 5, 6, 10]
+    assert simplify_polyline(x, y, tolerance=1).tolist() == [0, 1, 3, 4, 5, 6, 10]
+    assert simplify_polyline(x, y, tolerance=100).tolist() == [0, 10]
+    assert simplify_polyline(x[:2], y[:2], tolerance=5).tolist() == [0, 1]
+
+
+def test_compile_save_load(tmp_path):
+
+    # Two paths along a meridian, sharing their junction point, listed out of order.
+    lat = [43.650, 43.651, 43.652, 43.652, 43.653, 43.654]
+    paths_df = pd.DataFrame({
+        "direction_tag": ["A"] * 6,
+        "path_id": ["A_3_2_3"] * 3 + ["A_1_1_2"] * 3,
+        "path_along_direction": [3] * 3 + [1] * 3,
+        "point_along_path": [1, 2, 3] * 2,
+        "lat": lat[3:] + lat[:3],
+        "lon": [-79.38] * 6,
+    })
+
+    geometry = RouteGeometry.compile(paths_df, tolerance_meters=5)
+    lat, lon, distance_meters = geometry.get_polyline("A")
+
+    # Collinear points are simplified away.
+    assert lat.tolist() == [43.650, 43.654]
+    assert np.isclose(distance_meters[-1], 0.004 * np.pi / 180 * 6373000)
+
+    geometry.save(tmp_path)
+    loaded = RouteGeometry.load(tmp_path)
+    assert loaded.direction_tags == ["A"]
+    for expected, actual in zip(geometry.get_polyline("A"), loaded.get_polyline("A")):
+        np.testing.assert_array_equal(expected, actual)
+
+    x, y = project_to_meters(lat, lon, lat[0], lon[0])
+    assert np.isclose(y[-1], distance_meters[-1]) and np.isclose(x[-1], 0)
@@ -0,0 +1,111 @@
+"""
+Unit tests for the point to route index.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from route_geometry import RouteGeometry
+from route_index import RouteIndex
+
+
+@pytest.fixture
+def routes_df():
+    # Route 1 runs north-south, route 2 east-west; their boxes cross downtown.
+    return pd.DataFrame({
+        "tag": ["1", "2", "3"],
+        "latmin": [43.60, 43.645, np.nan],
+        "latmax": [43.70, 43.655, np.nan],
+        "lonmin": [-79.385, -79.45, np.nan],
+        "lonmax": [-79.375, -79.30, np.nan],
+    })
+
+
+@pytest.fixture
+def geometry():
+    # Each route has two opposite directions on the same street.
+    return RouteGeometry.compile(pd.DataFrame({
+        "direction_tag": ["1_0", "1_0", "1_1", "1_1", "2_0", "2_0", "2_1", "2_1"],
+        "path_along_direction": [1] * 8,
+        "point_along_path": [1, 2] * 4,
+        "lat": [43.60, 43.70, 43.70, 43.60, 43.65, 43.65, 43.65, 43.65],
+        "lon": [-79.38, -79.38, -79.38, -79.38, -79.45, -79.30, -79.30, -79.45],
+    }))
+
+
+@pytest.fixture
+def directions_df():
+    return pd.DataFrame({"tag": ["1_0", "1_1", "2_0", "2_1"],
+                         "route_tag": ["1", "1", "2", "2"]})
+
+
+def test_get_candidate_routes(routes_df):
+
+    index = RouteIndex(routes_df, cell_size_degrees=0.01)
+
+    rng = np.random.default_rng(0)
+    lat = rng.uniform(43.55, 43.75, size=5000)
+    lon = rng.uniform(-79.50, -79.25, size=5000)
+    lat[0] = np.nan
+
+    point, route_tags = index.get_candidate_routes(lat, lon)
+
+    df = routes_df.dropna()
+    is_inside = (df.latmin.to_numpy() <= lat[:, None]) & (lat[:, None] <= df.latmax.to_numpy()) \
+                & (df.lonmin.to_numpy() <= lon[:, None]) & (lon[:, None] <= df.lonmax.to_numpy())
+    expected_point, expected_route = np.nonzero(is_inside)
+
+    assert sorted(zip(point.tolist(), route_tags.tolist())) == \
+        sorted(zip(expected_point.tolist(), df.tag.to_numpy()[expected_route].tolist()))
+    assert (np.diff(point) >= 0).all()
+
+
+def test_locate(routes_df, geometry, directions_df):
+
+    index = RouteIndex(routes_df, directions_df=directions_df, geometry=geometry)
+
+    located = index.locate(
+        lat=[43.6201, 43.6201, 43.6499, 43.6499, 43.6201, 43.80],
+        lon=[-79.3801, -79.3801, -79.40, -79.40, -79.3801, -79.38],
+        heading=[0, 180, 270, -1, 0, 0],
+        route_tags=[None, None, None, None, "2", None])
+
+    # Northbound and southbound on route 1, westbound on route 2. Without a
+    # heading the nearest direction wins, a tie between opposite directions.
+    assert located.direction_tag.to_list()[:3] == ["1_0", "1_1", "2_1"]
+    assert located.route_tag.to_list()[:4] == ["1", "1", "2", "2"]
+    assert located.distance_to_route_meters[0] == pytest.approx(8, abs=1)
+
+    # Known to be on route 2, the fifth point is too far from it, and the last
+    # point is outside all routes.
+    assert located.loc[4:, "direction_tag"].isna().all()
+    assert located.loc[5, "route_tag"] is None
+
+
+def test_repair_tags_and_off_route_mask(routes_df, geometry, directions_df):
+
+    df = pd.DataFrame({
+        "route_tag": [None, "1", "1", "2", "2"],
+        "direction_tag": [None, None, "1_0", "2_0", "2_0"],
+        "lat": [43.6201, 43.6201, 43.6201, 43.6499, 43.62],
+        "lon": [-79.3801, -79.3801, -79.3801, -79.40, -79.40],
+        "heading": pd.array([0, 180, 0, 90, 90], dtype="Int64"),
+    })
+
+    index = RouteIndex(routes_df, directions_df=directions_df, geometry=geometry)
+    repaired, num_repaired = index.repair_tags(df)
+
+    assert num_repaired == 2
+    assert repaired.route_tag.to_list() == ["1", "1", "1", "2", "2"]
+    assert repaired.direction_tag.to_list() == ["1_0", "1_1", "1_0", "2_0", "2_0"]
+
+    is_off_route, distance = index.get_off_route_mask(repaired)
+    assert is_off_route.tolist() == [False, False, False, False, True]
+    assert np.isnan(distance[4])
+
+    # Without geometry, routes come from single bounding boxes only.
+    index = RouteIndex(routes_df)
+    repaired, num_repaired = index.repair_tags(df)
+    assert num_repaired == 1
+    assert repaired.direction_tag.to_list() == df.direction_tag.to_list()
+    is_off_route, _ = index.get_off_route_mask(df.assign(lon=[-79.3801, -79.3801, -79.50, -79.40, -79.40]))
+    assert is_off_route.tolist() == [False, False, True, False, True]
@@ -0,0 +1,92 @@
+"""
+Unit tests for the time-dependent router over the transit graph. 
+"""
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+from routing import TransitRouter, get_seconds_of_week
+from transit_statistics import TransitStatistics
+
+
+def make_graph_df(edges):
+    rows = []
+    for stop1, stop2, direction_tag, is_connection in edges:
+        key = "_".join([stop1, stop2] + ([direction_tag] if direction_tag else []))
+        rows.append({"key": key, "stop_tag1": stop1, "stop_tag2": stop2,
+                     "node1": stop1.replace("_ar", ""), "node2": stop2.replace("_ar", ""),
+                     "direction_tag": direction_tag, "is_connection": is_connection})
+    return pd.DataFrame(rows)
+
+
+@pytest.fixture
+def router():
+    # Line A: 1 -> 2 -> 3_ar, line B: 1 -> 4 -> 3, and a walk from 2 to 4.
+    graph_df = make_graph_df([
+        ("1", "2", "A", None), ("2", "3_ar", "A", None),
+        ("1", "4", "B", None), ("4", "3", "B", None),
+        ("2", "4", None, True),
+    ])
+    stops_df = pd.DataFrame({
+        "tag": ["1", "2", "3", "3_ar", "4"],
+        "lat": [43.650, 43.655, 43.660, 43.660, 43.652],
+        "lon": [-79.380, -79.380, -79.380, -79.380, -79.375],
+    })
+
+    # Line A is fast at 8:00 on Tuesdays (hour of week 32), slow otherwise.
+    stats = TransitStatistics()
+    df_segments = pd.DataFrame({
+        "edge_key": ["1_2_A", "2_3_ar_A"] * 2 + ["1_4_B", "4_3_B"] * 2,
+        "hour_of_week": [32, 32, 33, 33] * 2,
+        "seconds": [60, 60, 900, 900, 300, 300, 300, 300],
+    })
+    stats.add_segment_times(df_segments)
+
+    return TransitRouter.from_dataframes(graph_df, stops_df, stats=stats)
+
+
+def test_earliest_arrival_depends_on_departure_time(router):
+
+    departure_time = datetime.datetime(2022, 2, 8, 8, 0)   # a Tuesday
+    arrival_time, path = router.earliest_arrival("1", "3", departure_time)
+    assert path == ["1", "2", "3"]
+    assert (arrival_time - departure_time).total_seconds() == pytest.approx(120, rel=0.05)
+
+    departure_time = datetime.datetime(2022, 2, 8, 9, 0)
+    arrival_time, path = router.earliest_arrival("1", "3", departure_time)
+    assert path == ["1", "4", "3"]
+    assert (arrival_time - departure_time).total_seconds() == pytest.approx(600, rel=0.05)
+
+
+def test_earliest_arrival_with_closed_edge(router):
+
+    router.set_edge_travel_time("4_3_B", np.inf)
+    departure_time = datetime.datetime(2022, 2, 8, 9, 0)
+    arrival_time, path = router.earliest_arrival("1", "3", departure_time)
+    assert path == ["1", "2", "3"]
+
+    arrival_time, path = router.earliest_arrival("3", "1", departure_time)
+    assert arrival_time is None and path == []
+
+    times = router.earliest_arrival_times("1", departure_time)
+    assert times.index[0] == "1" and set(times.index) == {"1", "2", "3", "4"}
+    assert get_seconds_of_week(departure_time) == 33 * 3600
+
+
+def test_earliest_arrival_is_fifo_across_hour_boundary(router):
+
+    # Line A takes 900s per edge at 9:00 but 60s from 10:00: leaving just
+    # before 10:00 must not arrive later than leaving at 10:00.
+    router.set_edge_travel_time("1_4_B", np.inf)
+    router.set_edge_travel_time("1_2_A", 60, hours_of_week=[34])
+    router.set_edge_travel_time("2_3_ar_A", 60, hours_of_week=[34])
+
+    arrivals = [router.earliest_arrival("1", "3", datetime.datetime(2022, 2, 8, 9, minute))[0]
+                for minute in [30, 50, 59]]
+    arrival_at_hour, path = router.earliest_arrival("1", "3", datetime.datetime(2022, 2, 8, 10, 0))
+    assert path == ["1", "2", "3"]
+
+    assert arrivals == sorted(arrivals) and arrivals[-1] <= arrival_at_hour
+
+    # Leaving at 9:59, the first edge is entered at 10:00 rather than at 9:59.
+    assert arrivals[-1] == arrival_at_hour == datetime.datetime(2022, 2, 8, 10, 2)
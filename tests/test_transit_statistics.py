@@ -0,0 +1,62 @@
+"""
+Unit tests for the travel time sketches and their incremental updates. 
+"""
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+from transit_statistics import SegmentTimeHistogram, TransitStatistics
+
+
+def test_histogram_quantiles_merge_and_serialize():
+
+    rng = np.random.default_rng(0)
+    samples = rng.lognormal(mean=np.log(120), sigma=0.3, size=20000)
+
+    sketch = SegmentTimeHistogram()
+    sketch.add(samples[:10000])
+    other = SegmentTimeHistogram()
+    other.add(samples[10000:])
+    sketch.merge(other)
+
+    assert sketch.num_samples == 20000
+    for q in (0.1, 0.5, 0.9):
+        assert sketch.quantile(q) == pytest.approx(np.quantile(samples, q), rel=0.03)
+
+    restored = SegmentTimeHistogram.from_bytes(sketch.to_bytes())
+    assert np.array_equal(restored.counts, sketch.counts)
+    assert np.isnan(SegmentTimeHistogram().quantile(0.5))
+
+
+def test_transit_statistics_update_and_persist(db):
+
+    # Two trips over stops 1 -> 2 -> 3 on Tuesday at 8:xx (hour of week 32).
+    start = datetime.datetime(2022, 2, 8, 8, 0)
+    rows = []
+    for trip_id, offsets in enumerate([(0, 60, 180), (600, 660, 780)]):
+        for stop_order, offset in enumerate(offsets, start=1):
+            rows.append({"vehicle_id": "4516", "direction_tag": "506_0_506",
+                         "trip_id": trip_id, "stop_tag": str(stop_order),
+                         "stop_order": stop_order,
+                         "read_time": start + datetime.timedelta(seconds=offset)})
+    times_df = pd.DataFrame(rows)
+
+    stats = TransitStatistics(db)
+    df_segments = stats.get_segment_times_df(times_df)
+    assert sorted(df_segments.edge_key.unique()) == ["1_2_506_0_506", "2_3_506_0_506"]
+    assert (df_segments.hour_of_week == 32).all()
+
+    stats.add_segment_times(df_segments)
+    stats.save()
+
+    # A second update is merged into the persisted distributions.
+    stats = TransitStatistics(db)
+    stats.load(hours_of_week=[32])
+    stats.add_segment_times(df_segments)
+    stats.save()
+
+    stats = TransitStatistics(db)
+    stats.load()
+    assert stats.get_sketch("1_2_506_0_506", 32).num_samples == 4
+    assert stats.quantile("2_3_506_0_506", 32, 0.5) == pytest.approx(120, rel=0.05)
+    assert np.isnan(stats.quantile("2_3_506_0_506", 33, 0.5))
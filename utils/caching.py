@@ -0,0 +1,68 @@
+"""
+Bounded in-memory record of recently written keys.
+"""
+from collections import OrderedDict
+
+
+class RecentKeyFilter:
+    """
+    Least recently used (LRU) set of keys, bounded to max_size keys.
+
+    Used to drop rows whose primary key was written recently before they
+    reach the database, e.g. the repeated readings of vehicles that have not
+    reported since the last poll. Counters keep track of the keys checked
+    and of the repeats dropped.
+
+    Usage:
+        key_filter = RecentKeyFilter(max_size=100000)
+        df = df[key_filter.is_new(df.key)]
+        ...  # write df
+        key_filter.add(df.key)
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.num_checked = 0
+        self.num_dropped = 0
+        self._keys = OrderedDict()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def is_new(self, keys):
+        """Check which keys were not written recently. Keys found are marked
+        as recently used.
+
+        Args:
+            keys (iterable): Keys to check, e.g. a column of primary keys.
+
+        Returns:
+            List[bool]: Whether each key is new.
+        """
+        mask = []
+        for key in keys:
+            is_new = key not in self._keys
+            if not is_new:
+                self._keys.move_to_end(key)
+            mask.append(is_new)
+
+        self.num_checked += len(mask)
+        self.num_dropped += len(mask) - sum(mask)
+        return mask
+
+    def add(self, keys):
+        """Record keys as written, evicting the least recently used keys
+        beyond max_size.
+
+        Args:
+            keys (iterable): Keys written.
+        """
+        for key in keys:
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+
+        while len(self._keys) > self.max_size:
+            self._keys.popitem(last=False)
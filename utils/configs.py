@@ -22,6 +22,15 @@ def get_transit_config():
 def get_pipeline_config():
     config = {} 
     config["vehicle_locations_retention_days"] = int(os.environ["PIPELINE_CONFIG_VEHICLE_LOCATIONS_RETENTION_DAYS"])
+
+    # Storage layout for vehicle locations: 'legacy', 'compact' or 'both'.
+    config["vehicle_locations_layout"] = os.environ.get("PIPELINE_CONFIG_VEHICLE_LOCATIONS_LAYOUT", "legacy")
+
+    # Directory of the compiled connection timetables, one subdirectory per service class.
+    config["timetables_path"] = os.environ.get("PIPELINE_CONFIG_TIMETABLES_PATH", "timetables")
+
+    # Directory of the simplified route geometry, one .npz file per direction.
+    config["route_geometry_path"] = os.environ.get("PIPELINE_CONFIG_ROUTE_GEOMETRY_PATH", "route_geometry")
     return config 
 
 def get_ssh_tunnel_config():
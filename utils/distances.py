@@ -2,6 +2,7 @@
 Function to calculate distances between points in (lat, lon) coordinates.
 """
 import math
+import numpy as np
 
 def calculate_distance_from_lat_lon_coords(p1, p2):    
     """Calculate meter distances between two points p1, p2 
@@ -40,3 +41,29 @@ def calculate_distance_from_lat_lon_coords(p1, p2):
     distance = distance_km*1000 
     return distance
 
+
+
+def calculate_distances_from_lat_lon_arrays(lat1, lon1, lat2, lon2):
+    """Vectorized version of calculate_distance_from_lat_lon_coords, for 
+    arrays of point pairs (lat1[i], lon1[i]), (lat2[i], lon2[i]).
+
+    Args:
+        lat1, lon1, lat2, lon2 (array-like): Coordinates in degrees.
+
+    Returns:
+        distances (np.ndarray): Distances in meters.
+    """
+
+    R = 6373.0  # Earth's radius in km
+
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=np.float64)) 
+                              for x in (lat1, lon1, lat2, lon2))
+
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1 
+
+    # Haversine Formula
+    a = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a)) 
+
+    return R * c * 1000 
@@ -1,7 +1,306 @@
 """ 
 Utility methods for running SQL queries.
+
+Queries run by the pipeline are kept in a registry of named statements with
+bound parameters. Each statement is built once as a sqlalchemy text() 
+object, so sqlalchemy can cache its compiled form and reuse it across calls
+with different values. The .sql files under the queries directory are read 
+once, on first use, and cached.  
 """
+import functools
 import os
+from sqlalchemy import text
 
 def get_queries_path():
-    return os.environ["QUERIES_PATH"]
\ No newline at end of file
+    return os.environ["QUERIES_PATH"]
+
+
+# Named statements, with parameters bound at execution (e.g. :agency_tag).
+NAMED_QUERIES = {
+    "agency_tag": """
+        SELECT tag FROM agencies
+        """,
+    "route_list": """
+        SELECT DISTINCT tag FROM routes WHERE agency_tag=:agency_tag
+        """,
+    "direction_list": """
+        SELECT DISTINCT tag FROM directions WHERE agency_tag=:agency_tag
+        """,
+    "stop_coords": """
+        SELECT DISTINCT tag, lat, lon
+          FROM stops
+         WHERE agency_tag=:agency_tag
+         ORDER BY 2,3
+        """,
+    "stops_along_direction": """
+        SELECT routes.title as route,
+               routes.tag as route_tag,
+               directions.title as direction,
+               directions.tag as direction_tag,
+               directions.name as heading,
+               stops.title as stop,
+               stops.tag as stop_tag,
+               stops.lat as stop_lat,
+               stops.lon as stop_long,
+               stops.stop_along_direction as stop_number
+
+          FROM routes
+          INNER JOIN directions ON directions.route_tag = routes.tag
+          INNER JOIN stops      ON stops.direction_tag = directions.tag
+
+         WHERE routes.agency_tag=:agency_tag
+           AND directions.tag=:direction_tag
+         ORDER BY stop_number
+        """,
+    "route_stop_tags": """
+        SELECT DISTINCT route_tag, tag AS stop_tag
+          FROM stops
+         WHERE agency_tag=:agency_tag
+         ORDER BY 1,2
+        """,
+    "connections": """
+        SELECT * FROM connections
+        """,
+    "service_classes": """
+        SELECT DISTINCT service_class FROM schedules
+        """,
+    "schedules_by_service_class": """
+        SELECT schedule_class, service_class, route_tag, direction_name,
+               block_id, stop_tag, epoch_time, `key`
+          FROM schedules
+         WHERE service_class=:service_class
+         ORDER BY `key`
+        """,
+    "transit_graph": """
+        SELECT * FROM transit_graph
+        """,
+    "known_vehicle_ids": """
+        SELECT DISTINCT id FROM vehicles WHERE agency_tag=:agency_tag
+        """,
+    "active_vehicle_ids": """
+        SELECT DISTINCT id
+          FROM vehicles
+         WHERE agency_tag=:agency_tag
+           AND last_seen_active >= SUBDATE(CURRENT_DATE(), INTERVAL :prior_days DAY)
+        """,
+    "validation_vehicle_ids": """
+        SELECT DISTINCT id FROM vehicles_validation
+        """,
+    "delete_old_vehicle_locations": """
+        DELETE FROM vehicle_locations WHERE read_time < :first_date_kept
+        """,
+    "delete_old_vehicle_locations_compact": """
+        DELETE FROM vehicle_locations_compact WHERE read_time < :first_date_kept
+        """,
+    "segment_time_distributions": """
+        SELECT edge_key, hour_of_week, num_samples, sketch
+          FROM segment_time_distributions
+        """,
+    "segment_time_distributions_by_hour": """
+        SELECT edge_key, hour_of_week, num_samples, sketch
+          FROM segment_time_distributions
+         WHERE hour_of_week IN :hours_of_week
+        """,
+    "anomalies_since": """
+        SELECT edge_key, detected_at, hour_of_week, live_seconds, expected_seconds,
+               threshold_seconds, z_score, num_samples
+          FROM anomalies
+         WHERE detected_at >= :since
+         ORDER BY detected_at
+        """,
+    "vehicle_locations_since": """
+        SELECT id, direction_tag, lat, lon, read_time
+          FROM vehicle_locations
+         WHERE read_time >= :since
+         ORDER BY id, read_time
+        """,
+    "vehicle_locations_keys_since": """
+        SELECT `key` FROM vehicle_locations WHERE read_time >= :since
+        """,
+    "vehicle_locations_compact_keys_since": """
+        SELECT vehicles.id AS id, loc.read_time_bucket AS read_time_bucket
+          FROM vehicle_locations_compact loc
+          INNER JOIN vehicle_dim vehicles ON vehicles.vehicle_int = loc.vehicle_int
+         WHERE loc.read_time >= :since
+        """,
+    "vehicle_locations_quality_since": """
+        SELECT * FROM vehicle_locations_quality WHERE hour >= :since ORDER BY hour
+        """,
+    "vehicle_locations_compact_since": """
+        SELECT vehicles.id AS id, directions.tag AS direction_tag,
+               loc.lat AS lat, loc.lon AS lon, loc.read_time AS read_time
+          FROM vehicle_locations_compact loc
+          INNER JOIN vehicle_dim vehicles ON vehicles.vehicle_int = loc.vehicle_int
+          LEFT JOIN direction_dim directions ON directions.direction_int = loc.direction_int
+         WHERE loc.read_time >= :since
+         ORDER BY 1, loc.read_time
+        """,
+    "routes": """
+        SELECT tag, title, latmin, latmax, lonmin, lonmax, agency_tag FROM routes
+        """,
+    "directions": """
+        SELECT tag, title, name, route_tag, branch, agency_tag FROM directions
+        """,
+    "stops": """
+        SELECT tag, title, lat, lon, route_tag, direction_tag, stop_along_direction,
+               `key`, agency_tag
+          FROM stops
+        """,
+    "route_paths": """
+        SELECT direction_tag, path_id, path_along_direction, point_along_path, lat, lon
+          FROM route_paths
+         ORDER BY direction_tag, path_along_direction, point_along_path
+        """,
+    "pending_transit_config_changes_connections": """
+        SELECT * FROM transit_config_changes WHERE connections_applied = :false
+        """,
+    "pending_transit_config_changes_graph": """
+        SELECT * FROM transit_config_changes WHERE graph_applied = :false
+        """,
+    "mark_transit_config_changes_connections": """
+        UPDATE transit_config_changes
+           SET connections_applied = :true
+         WHERE connections_applied = :false AND detected_at <= :until
+        """,
+    "mark_transit_config_changes_graph": """
+        UPDATE transit_config_changes
+           SET graph_applied = :true
+         WHERE graph_applied = :false AND detected_at <= :until
+        """,
+    "delete_connections_of_stops": """
+        DELETE FROM connections WHERE stop1 IN :stop_tags OR stop2 IN :stop_tags
+        """,
+    "delete_transit_graph_connections_of_stops": """
+        DELETE FROM transit_graph
+         WHERE is_connection = :true
+           AND (stop_tag1 IN :stop_tags OR stop_tag2 IN :stop_tags)
+        """,
+    "delete_transit_graph_directions": """
+        DELETE FROM transit_graph WHERE direction_tag IN :direction_tags
+        """,
+    "delete_vehicle_locations_hourly": """
+        DELETE FROM vehicle_locations_hourly WHERE hour = :hour
+        """,
+    "vehicle_locations_hourly_rollup": """
+        INSERT INTO vehicle_locations_hourly
+               (hour, route_tag, direction_tag, reads_taken, vehicles_seen,
+                route_vehicles_seen, hour_vehicles_seen,
+                first_read_time, last_read_time)
+        SELECT :hour,
+               directions.route_tag,
+               directions.direction_tag,
+               directions.reads_taken,
+               directions.vehicles_seen,
+               routes.vehicles_seen,
+               totals.vehicles_seen,
+               directions.first_read_time,
+               directions.last_read_time
+          FROM (SELECT COALESCE(route_tag, '') AS route_tag,
+                       COALESCE(direction_tag, '') AS direction_tag,
+                       COUNT(1) AS reads_taken,
+                       COUNT(DISTINCT id) AS vehicles_seen,
+                       MIN(read_time) AS first_read_time,
+                       MAX(read_time) AS last_read_time
+                  FROM vehicle_locations
+                 WHERE read_time >= :hour
+                   AND read_time < :next_hour
+                 GROUP BY COALESCE(route_tag, ''), COALESCE(direction_tag, '')) directions
+          INNER JOIN
+               (SELECT COALESCE(route_tag, '') AS route_tag,
+                       COUNT(DISTINCT id) AS vehicles_seen
+                  FROM vehicle_locations
+                 WHERE read_time >= :hour
+                   AND read_time < :next_hour
+                 GROUP BY COALESCE(route_tag, '')) routes
+            ON routes.route_tag = directions.route_tag
+          CROSS JOIN
+               (SELECT COUNT(DISTINCT id) AS vehicles_seen
+                  FROM vehicle_locations
+                 WHERE read_time >= :hour
+                   AND read_time < :next_hour) totals
+        """,
+    "vehicle_locations_compact_hourly_rollup": """
+        INSERT INTO vehicle_locations_hourly
+               (hour, route_tag, direction_tag, reads_taken, vehicles_seen,
+                route_vehicles_seen, hour_vehicles_seen,
+                first_read_time, last_read_time)
+        SELECT :hour,
+               directions.route_tag,
+               directions.direction_tag,
+               directions.reads_taken,
+               directions.vehicles_seen,
+               routes.vehicles_seen,
+               totals.vehicles_seen,
+               directions.first_read_time,
+               directions.last_read_time
+          FROM (SELECT COALESCE(route_dim.tag, '') AS route_tag,
+                       COALESCE(direction_dim.tag, '') AS direction_tag,
+                       COUNT(1) AS reads_taken,
+                       COUNT(DISTINCT loc.vehicle_int) AS vehicles_seen,
+                       MIN(loc.read_time) AS first_read_time,
+                       MAX(loc.read_time) AS last_read_time
+                  FROM vehicle_locations_compact loc
+                  LEFT JOIN route_dim ON route_dim.route_int = loc.route_int
+                  LEFT JOIN direction_dim ON direction_dim.direction_int = loc.direction_int
+                 WHERE loc.read_time >= :hour
+                   AND loc.read_time < :next_hour
+                 GROUP BY COALESCE(route_dim.tag, ''), COALESCE(direction_dim.tag, '')) directions
+          INNER JOIN
+               (SELECT COALESCE(route_dim.tag, '') AS route_tag,
+                       COUNT(DISTINCT loc.vehicle_int) AS vehicles_seen
+                  FROM vehicle_locations_compact loc
+                  LEFT JOIN route_dim ON route_dim.route_int = loc.route_int
+                 WHERE loc.read_time >= :hour
+                   AND loc.read_time < :next_hour
+                 GROUP BY COALESCE(route_dim.tag, '')) routes
+            ON routes.route_tag = directions.route_tag
+          CROSS JOIN
+               (SELECT COUNT(DISTINCT vehicle_int) AS vehicles_seen
+                  FROM vehicle_locations_compact
+                 WHERE read_time >= :hour
+                   AND read_time < :next_hour) totals
+        """,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_named_query(name):
+    """Get a named statement from the registry, built once and cached.
+
+    Args:
+        name (str): Name of the query in NAMED_QUERIES.
+
+    Returns:
+        TextClause: sqlalchemy text() statement, to execute with parameters.
+    """
+    return text(NAMED_QUERIES[name])
+
+
+@functools.lru_cache(maxsize=None)
+def load_sql_files():
+    """Read all .sql files from the queries directory, once.
+
+    Returns:
+        dict: Query text keyed by file name (e.g. 'get_all_stops_data.sql').
+    """
+    queries_path = get_queries_path()
+
+    sql_files = {}
+    for filename in sorted(os.listdir(queries_path)):
+        if filename.endswith(".sql"):
+            with open(os.path.join(queries_path, filename)) as f:
+                sql_files[filename] = f.read()
+
+    return sql_files
+
+
+def load_sql_file(filename):
+    """Get the text of a .sql file from the queries directory.
+
+    Args:
+        filename (str): Name of the file, e.g. 'get_all_stops_data.sql'.
+
+    Returns:
+        str: Query text.
+    """
+    return load_sql_files()[filename]